@@ -5,6 +5,7 @@ import sys
 import argparse
 import numpy as np
 from lensed_hosts_utils import LensedHostGenerator
+from sprinkler import truth_catalog_path
 
 # Have numpy raise exceptions for operations that would produce nan or inf.
 np.seterr(invalid='raise', divide='raise', over='raise')
@@ -20,8 +21,8 @@ parser.add_argument("--num_pix", type=int, default=1000,
                     help='Number of pixels in x- or y-direction')
 args = parser.parse_args()
 
-host_truth_file = os.path.join(args.datadir, 'host_truth.db')
-lens_truth_file = os.path.join(args.datadir, 'lens_truth.db')
+host_truth_file = truth_catalog_path(args.datadir, 'host_truth')
+lens_truth_file = truth_catalog_path(args.datadir, 'lens_truth')
 generator = LensedHostGenerator(host_truth_file, lens_truth_file, 'agn',
                                 args.outdir, pixel_size=args.pixel_size,
                                 num_pix=args.num_pix)
@@ -5,6 +5,7 @@ import sys
 import argparse
 import numpy as np
 from lensed_hosts_utils import LensedHostGenerator
+from sprinkler import truth_catalog_path
 
 # Have numpy raise exceptions for operations that would produce nan or inf.
 np.seterr(invalid='raise', divide='raise', over='raise')
@@ -22,8 +23,8 @@ parser.add_argument("--seed", type=int, default=42,
                     help='Seed for random draw of galaxy locations.')
 args = parser.parse_args()
 
-host_truth_file = os.path.join(args.datadir, 'host_truth.db')
-lens_truth_file = os.path.join(args.datadir, 'lens_truth.db')
+host_truth_file = truth_catalog_path(args.datadir, 'host_truth')
+lens_truth_file = truth_catalog_path(args.datadir, 'lens_truth')
 if args.seed != -1:
     rng = np.random.RandomState(args.seed)
 else:
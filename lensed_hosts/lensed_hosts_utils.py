@@ -1,11 +1,13 @@
 import os
-import sqlite3
+import sys
 import numpy as np
 import scipy.special as ss
 import pylab as pl
 import pandas as pd
 from astropy.io import fits
 import om10_lensing_equations as ole
+sys.path.append('..')
+from sprinkler import TruthCatalogReader
 
 __all__ = ['LensedHostGenerator', 'generate_lensed_host',
            'lensed_sersic_2d', 'random_location']
@@ -263,11 +265,10 @@ class LensedHostGenerator:
     """Class to generate lensed hosts."""
     def __init__(self, host_truth_file, lens_truth_file, obj_type, outdir,
                  pixel_size=0.04, num_pix=250, rng=None):
-        with sqlite3.connect(host_truth_file) as conn:
-            host_df = pd.read_sql(f'select * from {obj_type}_hosts', conn) \
-                        .query('image_number==0')
-        with sqlite3.connect(lens_truth_file) as conn:
-            lens_df = pd.read_sql(f'select * from {obj_type}_lens', conn)
+        # Truth files are sqlite files or Parquet directories
+        host_df = TruthCatalogReader(host_truth_file).read(f'{obj_type}_hosts') \
+                    .query('image_number==0')
+        lens_df = TruthCatalogReader(lens_truth_file).read(f'{obj_type}_lens')
         self.df = pd.merge(host_df, lens_df, on='lens_cat_sys_id', how='inner')
         self.obj_type = obj_type
         self.outdir = outdir
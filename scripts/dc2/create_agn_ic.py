@@ -10,12 +10,14 @@ import multiprocessing
 import json as json
 import pandas as pd
 import numpy as np
+import sys
+sys.path.append('../..')
 from lsst.sims.catalogs.decorators import register_method, compound
-from sqlalchemy import create_engine
 from lsst.sims.photUtils import Sed, BandpassDict
 from lsst.sims.catUtils.utils import ObservationMetaDataGenerator
 from desc.sims.GCRCatSimInterface import get_obs_md
 from dc2_utils import ExtraGalacticVariabilityModels, instCatUtils
+from sprinkler import TruthCatalogReader
 
 
 class lensedAgnCat(instCatUtils):
@@ -81,7 +83,7 @@ if __name__ == "__main__":
     parser.add_argument('--obs_id', type=int, default=None,
                         help='obsHistID to generate InstanceCatalog for')
     parser.add_argument('--agn_truth_cat', type=str,
-                        help='path to lensed AGN truth catalog')
+                        help='path to lensed AGN truth catalog (sqlite file or Parquet directory)')
     parser.add_argument('--file_out', type=str,
                         help='filename of instance catalog written')
 
@@ -90,8 +92,7 @@ if __name__ == "__main__":
     obs_gen = ObservationMetaDataGenerator(database=args.obs_db,
                                            driver='sqlite')
 
-    agn_truth_db = create_engine('sqlite:///%s' % args.agn_truth_cat, echo=False)
-    agn_truth_cat = pd.read_sql_table('lensed_agn', agn_truth_db)
+    agn_truth_cat = TruthCatalogReader(args.agn_truth_cat).read('lensed_agn')
     lensed_agn_ic = lensedAgnCat(agn_truth_cat)
 
     obs_md = get_obs_md(obs_gen, args.obs_id, 2, dither=True)
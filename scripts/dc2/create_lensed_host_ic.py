@@ -2,12 +2,14 @@ import os
 import numpy as np
 import pandas as pd
 import argparse
+import sys
+sys.path.append('../..')
 from astropy.io import fits
-from sqlalchemy import create_engine
 from lsst.sims.catUtils.utils import ObservationMetaDataGenerator
 from desc.sims.GCRCatSimInterface import get_obs_md
 from lsst.sims.utils import angularSeparation
 from dc2_utils import instCatUtils
+from sprinkler import TruthCatalogReader, sed_file_name
 
 __all__ = ['hostImage']
 
@@ -59,11 +61,7 @@ class hostImage(instCatUtils):
         elif gal_type == 'disk':
             sys_id = lens_id + '_d'
 
-        sed_file = df_line['sed_%s_host' % gal_type]
-        if isinstance(sed_file, bytes):
-            sed_file = sed_file.decode('utf-8')
-        else:
-            sed_file = sed_file.lstrip('b').strip("'")
+        sed_file = sed_file_name(df_line['sed_%s_host' % gal_type])
         cat_str = 'object %s %f %f %f %s %f 0 0 0 0 0 %s %f 0 CCM %f %f CCM %f %f\n'\
                   % (sys_id,
                      df_line['ra_lens'],
@@ -150,13 +148,24 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    host_truth_db = create_engine('sqlite:///%s' % args.host_truth_cat, echo=False)
-    agn_host_truth_cat = pd.read_sql_table('agn_hosts', host_truth_db)
-    sne_host_truth_cat = pd.read_sql_table('sne_hosts', host_truth_db)
-
     obs_gen = ObservationMetaDataGenerator(database=args.obs_db,
                                            driver='sqlite')
     obs_md = get_obs_md(obs_gen, args.obs_id, 2, dither=True)
+
+    # Parquet truth catalogs only need the partitions inside the field of view
+    host_truth = TruthCatalogReader(args.host_truth_cat)
+    host_columns = ['unique_id', 'ra_lens', 'dec_lens', 'redshift',
+                    'sed_disk_host', 'sed_bulge_host',
+                    'av_internal_disk', 'rv_internal_disk',
+                    'av_internal_bulge', 'rv_internal_bulge', 'av_mw', 'rv_mw']
+    agn_healpix, sne_healpix = None, None
+    if host_truth.output_format == 'parquet':
+        agn_healpix = host_truth.healpix_in_disc('agn_hosts', obs_md.pointingRA,
+                                                 obs_md.pointingDec, args.fov)
+        sne_healpix = host_truth.healpix_in_disc('sne_hosts', obs_md.pointingRA,
+                                                 obs_md.pointingDec, args.fov)
+    agn_host_truth_cat = host_truth.read('agn_hosts', columns=host_columns, healpix=agn_healpix)
+    sne_host_truth_cat = host_truth.read('sne_hosts', columns=host_columns, healpix=sne_healpix)
     obs_time = obs_md.mjd.TAI
     obs_filter = obs_md.bandpass
     print('Writing Instance Catalog for Visit: %i at MJD: %f in Bandpass: %s' % (args.obs_id,
@@ -6,13 +6,15 @@ import shutil
 import copy
 import json
 import argparse
-from sqlalchemy import create_engine
+import sys
+sys.path.append('../..')
 from lsst.utils import getPackageDir
 from lsst.sims.photUtils import Bandpass
 from lsst.sims.catUtils.supernovae import SNObject
 from lsst.sims.catUtils.utils import ObservationMetaDataGenerator
 from desc.sims.GCRCatSimInterface import get_obs_md
 from dc2_utils import instCatUtils
+from sprinkler import get_bandpass_registry, TruthCatalogReader
 
 
 class lensedSneCat(instCatUtils):
@@ -21,8 +23,7 @@ class lensedSneCat(instCatUtils):
                  sed_folder_name, write_sn_sed=True):
 
         self.truth_cat = truth_cat
-        self.imSimBand = Bandpass()
-        self.imSimBand.imsimBandpass()
+        self.imSimBand = get_bandpass_registry().imsim_bandpass
         self.sed_folder_name = sed_folder_name
         self.out_dir = out_dir
         self.sed_dir = os.path.join(out_dir, sed_folder_name)
@@ -119,7 +120,7 @@ if __name__ == "__main__":
     parser.add_argument('--obs_id', type=int, default=None,
                         help='obsHistID to generate InstanceCatalog for')
     parser.add_argument('--sne_truth_cat', type=str,
-                        help='path to lensed AGN truth catalog')
+                        help='path to lensed SNe truth catalog (sqlite file or Parquet directory)')
     parser.add_argument('--output_dir', type=str,
                         help='output directory for catalog and sed folder')
     parser.add_argument('--cat_file_name', type=str,
@@ -132,8 +133,7 @@ if __name__ == "__main__":
     obs_gen = ObservationMetaDataGenerator(database=args.obs_db,
                                            driver='sqlite')
 
-    sne_truth_db = create_engine('sqlite:///%s' % args.sne_truth_cat, echo=False)
-    sne_truth_cat = pd.read_sql_table('lensed_sne', sne_truth_db)
+    sne_truth_cat = TruthCatalogReader(args.sne_truth_cat).read('lensed_sne')
     lensed_sne_ic = lensedSneCat(sne_truth_cat, args.output_dir,
                                  args.cat_file_name, args.sed_folder)
 
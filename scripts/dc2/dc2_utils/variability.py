@@ -7,6 +7,7 @@ import os
 import gzip
 import numbers
 import multiprocessing
+from multiprocessing import shared_memory
 import json as json
 import numpy as np
 from lsst.sims.catalogs.decorators import register_method, compound
@@ -14,6 +15,199 @@ from lsst.sims.catUtils.mixins import Variability
 
 __all__ = ["ExtraGalacticVariabilityModels", "VariabilityAGN"]
 
+
+def simulate_agn(expmjd, tau, time_dilation, sf_filt, seed, walk_start_date):
+    """
+    Damped random walk light curve of one AGN. See
+    `ExtraGalacticVariabilityModels._simulate_agn`.
+    """
+    expmjd_is_number = isinstance(expmjd, numbers.Number)
+    mjds = np.array([expmjd]) if expmjd_is_number else np.array(expmjd)
+
+    if min(mjds) < walk_start_date:
+        raise RuntimeError(f'mjds must start after {walk_start_date}')
+
+    t_obs = np.arange(walk_start_date, max(mjds + 1), dtype=float)
+    t_rest = t_obs/time_dilation/tau
+
+    rng = np.random.RandomState(seed)
+    nbins = len(t_rest)
+    steps = rng.normal(0, 1, nbins)
+    delta_mag_norm = np.zeros(nbins)
+    delta_mag_norm[0] = steps[0]*sf_filt
+    for i in range(1, nbins):
+        dt = t_rest[i] - t_rest[i - 1]
+        delta_mag_norm[i] = (delta_mag_norm[i - 1]*(1. - dt)
+                             + np.sqrt(2*dt)*sf_filt*steps[i])
+    dm_out = np.interp(mjds, t_obs, delta_mag_norm)
+    return dm_out if not expmjd_is_number else dm_out[0]
+
+
+def agn_n_bins(expmjd, walk_start_date, time_step=1.0):
+    """
+    Number of points on the walk time grid needed to reach each epoch in
+    `expmjd`. This is the length of the grid `simulate_agn` uses when
+    `time_step` is one day.
+    """
+    return np.ceil((np.asarray(expmjd, dtype=float) + time_step
+                    - walk_start_date)/time_step).astype(np.int64)
+
+
+def simulate_agn_array(expmjd, tau, time_dilation, sf_filt, seed, walk_start_date,
+                       method='euler', time_step=1.0, chunk_size=1000):
+    """
+    Damped random walk delta mag_norm values of many AGN, one epoch each.
+
+    The walks of a chunk of AGN are advanced together as arrays along the
+    time axis. Each AGN still draws its own unit normal steps from
+    `np.random.RandomState(seed)`, so a given seed always gives the same
+    light curve whatever else is simulated with it. The steps are drawn
+    once and shared by all filters.
+
+    Parameters
+    ----------
+    expmjd: np.array
+        Observer frame MJD of each AGN
+    tau: np.array
+        Variability time scale in days. Either (n_obj,) or (n_filt, n_obj)
+        to simulate several filters at once.
+    time_dilation: np.array
+        1 + redshift of each AGN
+    sf_filt: np.array
+        Structure function parameter, same shape as `tau`
+    seed: np.array
+        Random number seed of each AGN
+    walk_start_date: float
+        MJD at which the walks start
+    method: str, default='euler'
+        'euler' repeats the update of `simulate_agn`, so with a one day
+        `time_step` the output is identical to it. It is only stable while
+        a step is shorter than twice the rest frame tau. 'exact' uses the
+        exact Ornstein-Uhlenbeck transition over each step, which is
+        stable and unbiased for any `time_step`.
+    time_step: float, default=1.0
+        Spacing of the walk time grid in observer frame days. With 'exact'
+        the value at each epoch is drawn from the exact bridge between the
+        grid points around it instead of being interpolated linearly.
+    chunk_size: int, default=1000
+        Number of AGN integrated together, to bound memory
+
+    Returns
+    -------
+    np.array of delta mag_norm values with the shape of `tau`.
+    """
+    if method not in ('euler', 'exact'):
+        raise ValueError('method must be euler or exact, not %s' % method)
+
+    expmjd = np.atleast_1d(np.asarray(expmjd, dtype=float))
+    time_dilation = np.atleast_1d(np.asarray(time_dilation, dtype=float))
+    seed = np.atleast_1d(np.asarray(seed))
+    tau = np.asarray(tau, dtype=float)
+    sf_filt = np.asarray(sf_filt, dtype=float)
+    tau_2d = np.atleast_2d(tau)
+    sf_2d = np.atleast_2d(sf_filt)
+
+    dm_out = np.zeros(tau_2d.shape)
+    if len(expmjd) == 0:
+        return dm_out.reshape(tau.shape)
+
+    if np.min(expmjd) < walk_start_date:
+        raise RuntimeError(f'mjds must start after {walk_start_date}')
+
+    n_bins = agn_n_bins(expmjd, walk_start_date, time_step)
+    # Chunk AGN with similar walk lengths together to limit padding
+    order = np.argsort(n_bins, kind='stable')
+    for i_start in range(0, len(order), chunk_size):
+        chunk = order[i_start:i_start+chunk_size]
+        n_max = n_bins[chunk[-1]]
+        t_obs = walk_start_date + np.arange(n_max)*time_step
+
+        # Rows are time steps and columns AGN so each update is contiguous
+        steps = np.zeros((n_max, len(chunk)))
+        for i_col, i_obj in enumerate(chunk):
+            rng = np.random.RandomState(seed[i_obj])
+            steps[:n_bins[i_obj], i_col] = rng.normal(0, 1, n_bins[i_obj])
+
+        # Position of each epoch on the grid, as found by np.interp
+        j_lo = np.searchsorted(t_obs, expmjd[chunk], side='right') - 1
+        j_hi = np.minimum(j_lo + 1, n_bins[chunk] - 1)
+        cols = np.arange(len(chunk))
+
+        if method == 'exact':
+            # One draw per AGN and grid interval from a stream separate from
+            # the walk steps, so it is also fixed by the seed
+            bridge_steps = np.array([np.random.RandomState([seed[i_obj], j]).normal()
+                                     for i_obj, j in zip(chunk, j_lo)])
+
+        for i_filt in range(tau_2d.shape[0]):
+            t_rest = t_obs[:, None]/time_dilation[chunk]/tau_2d[i_filt, chunk]
+            dt = np.diff(t_rest, axis=0)
+            sf_chunk = sf_2d[i_filt, chunk]
+            if method == 'euler':
+                decay = 1. - dt
+                walk = steps.copy()
+                walk[0] *= sf_chunk
+                walk[1:] *= np.sqrt(2*dt)*sf_chunk
+            else:
+                decay = np.exp(-dt)
+                walk = steps*sf_chunk
+                walk[1:] *= np.sqrt(-np.expm1(-2*dt))
+
+            # walk[i] holds the step noise and becomes the walk itself
+            step_decay = np.empty(len(chunk))
+            for i in range(1, n_max):
+                np.multiply(walk[i - 1], decay[i - 1], out=step_decay)
+                walk[i] += step_decay
+
+            dm_lo = walk[j_lo, cols]
+            dm_hi = walk[j_hi, cols]
+            on_grid = (j_hi == j_lo) | (expmjd[chunk] == t_obs[j_lo])
+            if method == 'euler':
+                # Linear interpolation in the same form as np.interp
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    slope = (dm_hi - dm_lo)/(t_obs[j_hi] - t_obs[j_lo])
+                dm_interp = np.where(on_grid, dm_lo,
+                                     slope*(expmjd[chunk] - t_obs[j_lo]) + dm_lo)
+            else:
+                # Sample the Ornstein-Uhlenbeck bridge between the grid points
+                # on either side of the epoch, so the light curve keeps its
+                # full variance whatever the step size.
+                rest_scale = time_dilation[chunk]*tau_2d[i_filt, chunk]
+                dt_lo = (expmjd[chunk] - t_obs[j_lo])/rest_scale
+                dt_hi = (t_obs[j_hi] - expmjd[chunk])/rest_scale
+                var_lo = -np.expm1(-2*dt_lo)
+                var_hi = -np.expm1(-2*dt_hi)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    var_both = -np.expm1(-2*(dt_lo + dt_hi))
+                    bridge_mean = (np.exp(-dt_lo)*var_hi*dm_lo
+                                   + np.exp(-dt_hi)*var_lo*dm_hi)/var_both
+                    bridge_sd = sf_chunk*np.sqrt(var_lo*var_hi/var_both)
+                dm_interp = np.where(on_grid, dm_lo,
+                                     bridge_mean + bridge_sd*bridge_steps)
+            dm_out[i_filt, chunk] = dm_interp
+
+    return dm_out.reshape(tau.shape)
+
+
+def _simulate_agn_batch(shm_name, out_shape, filt_rows, out_start,
+                        expmjd, tau_arr, time_dilation_arr, sf_filt_arr,
+                        seed_arr, walk_start_date, method, time_step):
+    """
+    Pool worker: simulate a contiguous batch of AGN in the filters
+    `filt_rows` and write the results straight into the shared output array.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out_arr = np.ndarray(out_shape, dtype=np.float64, buffer=shm.buf)
+        out_arr[filt_rows, out_start:out_start+len(seed_arr)] = \
+            simulate_agn_array(expmjd, tau_arr, time_dilation_arr, sf_filt_arr,
+                               seed_arr, walk_start_date, method=method,
+                               time_step=time_step)
+        del out_arr
+    finally:
+        shm.close()
+    return len(seed_arr)
+
 class ExtraGalacticVariabilityModels(Variability):
     """
     A mixin providing the model for AGN variability.
@@ -21,6 +215,10 @@ class ExtraGalacticVariabilityModels(Variability):
 
     _agn_walk_start_date = 58350.0
     _agn_threads = 1
+    # 'euler' reproduces the original daily walk exactly while 'exact' uses
+    # the exact Ornstein-Uhlenbeck update and allows any _agn_time_step.
+    _agn_integrator = 'euler'
+    _agn_time_step = 1.0
     # Make the following class attribute a list so that we can modify
     # it globally for all subclasses from the top-level code.
     filters_to_simulate = ['u', 'g', 'r', 'i', 'z', 'y']
@@ -62,93 +260,18 @@ class ExtraGalacticVariabilityModels(Variability):
                                "in applyAgn variability method")
 
         if self._agn_threads == 1 or len(valid_dexes[0])==1:
-            for filt_num, filt_name in list(enumerate(['u', 'g', 'r', 'i', 'z', 'y'])):
-                if filt_name not in self.filters_to_simulate:
-                    continue
-                tau_arr = params['agn_tau_%s' % filt_name].astype(float)
-                sf_arr = params['agn_sf_%s' % filt_name].astype(float)
-                for i_obj in valid_dexes[0]:
-                    seed = seed_arr[i_obj]
-                    tau_filt = tau_arr[i_obj]
-                    time_dilation = 1.0+redshift_arr[i_obj]
-                    sf_filt = sf_arr[i_obj]
-                    obj_mjd = expmjd[i_obj]
-                    dMags[filt_num][i_obj] = self._simulate_agn(obj_mjd, tau_filt, time_dilation, sf_filt, seed)
+            dexes = valid_dexes[0]
+            filt_nums, tau_arr, sf_arr = self._agn_filter_params(params, dexes)
+            if len(filt_nums) > 0:
+                dMags[np.ix_(filt_nums, dexes)] = \
+                    simulate_agn_array(np.asarray(expmjd)[dexes], tau_arr,
+                                       1.0+np.asarray(redshift_arr)[dexes], sf_arr,
+                                       np.asarray(seed_arr)[dexes], self._agn_walk_start_date,
+                                       method=self._agn_integrator,
+                                       time_step=self._agn_time_step)
         else:
-            p_list = []
-
-            mgr = multiprocessing.Manager()
-            #if mjd_is_number:
-            out_struct = mgr.Array('d', [0]*len(valid_dexes[0]))
-            #else:
-            #    out_struct = mgr.dict()
-
-            #################
-            # Try to subdivide the AGN into batches such that the number
-            # of time steps simulated by each thread is close to equal
-
-            for filt_num, filt_name in list(enumerate(['u', 'g', 'r', 'i', 'z', 'y'])):
-                if filt_name not in self.filters_to_simulate:
-                    continue
-                tot_steps = 0
-                n_steps = []
-                tau_arr = params['agn_tau_%s' % filt_name].astype(float)
-                sf_arr = params['agn_sf_%s' % filt_name].astype(float)
-
-                for tt, zz in zip(tau_arr[valid_dexes], redshift_arr[valid_dexes]):
-                    dilation = 1.0+zz
-                    dt = tt/100.0
-                    dur = (duration_observer_frame/dilation)
-                    nt = dur/dt
-                    tot_steps += nt
-                    n_steps.append(nt)
-
-                batch_target = tot_steps/self._agn_threads
-                i_start_arr = [0]
-                i_end_arr = []
-                current_batch = n_steps[0]
-                for ii in range(1,len(n_steps),1):
-                    current_batch += n_steps[ii]
-                    if ii == len(n_steps)-1:
-                        i_end_arr.append(len(n_steps))
-                    elif len(i_start_arr)<self._agn_threads:
-                        if current_batch>=batch_target:
-                            i_end_arr.append(ii)
-                            i_start_arr.append(ii)
-                            current_batch = n_steps[ii]
-
-                if len(i_start_arr) != len(i_end_arr):
-                    raise RuntimeError('len i_start %d len i_end %d; dexes %d' %
-                                    (len(i_start_arr),
-                                        len(i_end_arr),
-                                        len(valid_dexes[0])))
-                assert len(i_start_arr) <= self._agn_threads
-                ############
-
-                # Actually simulate the AGN on the the number of threads allotted
-                for i_start, i_end in zip(i_start_arr, i_end_arr):
-                    dexes = valid_dexes[0][i_start:i_end]
-                    if mjd_is_number:
-                        out_dexes = range(i_start,i_end,1)
-                    else:
-                        out_dexes = dexes
-                    p = multiprocessing.Process(target=self._threaded_simulate_agn,
-                                                args=(expmjd[dexes], tau_arr[dexes],
-                                                    1.0+redshift_arr[dexes],
-                                                    sf_arr[dexes],
-                                                    seed_arr[dexes],
-                                                    out_dexes,
-                                                    out_struct))
-                    p.start()
-                    p_list.append(p)
-                for p in p_list:
-                    p.join()
-
-                #if mjd_is_number:
-                dMags[filt_num][valid_dexes] = out_struct[:]
-                #else:
-                #    for i_obj in out_struct.keys():
-                #        dMags[filt_num][i_obj] = out_struct[i_obj]
+            dMags[:, valid_dexes[0]] = self._parallel_simulate_agn(valid_dexes, params,
+                                                                   expmjd, redshift_arr)
 
         # for i_filter, filter_name in enumerate(('g', 'r', 'i', 'z', 'y')):
         #     for i_obj in valid_dexes[0]:
@@ -156,19 +279,98 @@ class ExtraGalacticVariabilityModels(Variability):
 
         return dMags
 
-    def _threaded_simulate_agn(self, expmjd, tau_arr,
-                               time_dilation_arr, sf_filt_arr,
-                               seed_arr, dex_arr, out_struct):
+    def _agn_filter_params(self, params, dexes):
+        """
+        Stack the tau and structure function parameters of the AGN in
+        `dexes` for the filters in `filters_to_simulate`.
 
-        if isinstance(expmjd, numbers.Number):
-            mjd_is_number = True
-        else:
-            mjd_is_number = False
+        Returns
+        -------
+        List of filter row numbers and two (n_filt, len(dexes)) arrays of
+        tau and structure function values.
+        """
+        filt_nums = []
+        tau_arr = []
+        sf_arr = []
+        for filt_num, filt_name in list(enumerate(['u', 'g', 'r', 'i', 'z', 'y'])):
+            if filt_name not in self.filters_to_simulate:
+                continue
+            filt_nums.append(filt_num)
+            tau_arr.append(np.asarray(params['agn_tau_%s' % filt_name]).astype(float)[dexes])
+            sf_arr.append(np.asarray(params['agn_sf_%s' % filt_name]).astype(float)[dexes])
+        return filt_nums, np.array(tau_arr), np.array(sf_arr)
+
+    def _agn_batches(self, n_steps, n_batches):
+        """
+        Split AGN into contiguous batches with about the same number of
+        random walk steps in each.
+
+        Parameters
+        ----------
+        n_steps: np.array
+            Number of time steps simulated for each AGN
+        n_batches: int
+            Number of batches wanted
 
-        for tau, time_dilation, sf_filt, seed, dex in \
-        zip(tau_arr, time_dilation_arr, sf_filt_arr, seed_arr, dex_arr):
-            out_struct[dex] = self._simulate_agn(expmjd, tau, time_dilation,
-                                                 sf_filt, seed)
+        Returns
+        -------
+        List of (start, end) index pairs
+        """
+        cum_steps = np.cumsum(n_steps)
+        targets = cum_steps[-1]*np.arange(1, n_batches)/n_batches
+        bounds = np.unique(np.concatenate([[0],
+                                           np.searchsorted(cum_steps, targets, side='right'),
+                                           [len(n_steps)]]))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _parallel_simulate_agn(self, valid_dexes, params, expmjd, redshift_arr):
+        """
+        Simulate the AGN in `valid_dexes` on a pool of `_agn_threads`
+        processes. Every worker writes into one shared memory array so
+        results are not sent back through pipes.
+
+        Returns
+        -------
+        (6, len(valid_dexes[0])) array of delta mag_norm values. Rows of
+        filters not in `filters_to_simulate` are zero.
+        """
+        dexes = valid_dexes[0]
+        n_obj = len(dexes)
+        seed_arr = np.asarray(params['seed'])[dexes]
+        obj_mjd = np.asarray(expmjd)[dexes]
+        time_dilation = 1.0+np.asarray(redshift_arr)[dexes]
+        filt_nums, tau_arr, sf_arr = self._agn_filter_params(params, dexes)
+
+        # The walk has one point per time step from the start date to the
+        # epoch so balance the batches on that rather than on the number of
+        # AGN. Use several batches per process so the pool can even out the rest.
+        n_steps = agn_n_bins(obj_mjd, self._agn_walk_start_date, self._agn_time_step)
+        batches = self._agn_batches(n_steps, 4*self._agn_threads)
+
+        out_shape = (6, n_obj)
+        shm = shared_memory.SharedMemory(create=True, size=8*6*max(n_obj, 1))
+        try:
+            out_arr = np.ndarray(out_shape, dtype=np.float64, buffer=shm.buf)
+            out_arr[:] = 0.
+            tasks = []
+            if len(filt_nums) > 0:
+                for i_start, i_end in batches:
+                    tasks.append((shm.name, out_shape, filt_nums, i_start,
+                                  obj_mjd[i_start:i_end], tau_arr[:, i_start:i_end],
+                                  time_dilation[i_start:i_end], sf_arr[:, i_start:i_end],
+                                  seed_arr[i_start:i_end], self._agn_walk_start_date,
+                                  self._agn_integrator, self._agn_time_step))
+
+            with multiprocessing.Pool(processes=self._agn_threads) as pool:
+                pool.starmap(_simulate_agn_batch, tasks, chunksize=1)
+
+            d_mags = out_arr.copy()
+            del out_arr
+        finally:
+            shm.close()
+            shm.unlink()
+
+        return d_mags
 
     def _simulate_agn(self, expmjd, tau, time_dilation, sf_filt, seed):
         """
@@ -200,26 +402,8 @@ class ExtraGalacticVariabilityModels(Variability):
         This code is based on/stolen from
         https://github.com/astroML/astroML/blob/master/astroML/time_series/generate.py
         """
-        expmjd_is_number = isinstance(expmjd, numbers.Number)
-        mjds = np.array([expmjd]) if expmjd_is_number else np.array(expmjd)
-
-        if min(mjds) < self._agn_walk_start_date:
-            raise RuntimeError(f'mjds must start after {self._agn_walk_start_date}')
-
-        t_obs = np.arange(self._agn_walk_start_date, max(mjds + 1), dtype=float)
-        t_rest = t_obs/time_dilation/tau
-
-        rng = np.random.RandomState(seed)
-        nbins = len(t_rest)
-        steps = rng.normal(0, 1, nbins)
-        delta_mag_norm = np.zeros(nbins)
-        delta_mag_norm[0] = steps[0]*sf_filt
-        for i in range(1, nbins):
-            dt = t_rest[i] - t_rest[i - 1]
-            delta_mag_norm[i] = (delta_mag_norm[i - 1]*(1. - dt)
-                                 + np.sqrt(2*dt)*sf_filt*steps[i])
-        dm_out = np.interp(mjds, t_obs, delta_mag_norm)
-        return dm_out if not expmjd_is_number else dm_out[0]
+        return simulate_agn(expmjd, tau, time_dilation, sf_filt, seed,
+                            self._agn_walk_start_date)
 
 
 class VariabilityAGN(ExtraGalacticVariabilityModels):
@@ -17,6 +17,7 @@ from tqdm import tqdm
 import pandas as pd
 import lensing_utils
 import io_utils
+from sprinkler import TruthCatalogReader, truth_catalog_path
 
 # Have numpy raise exceptions for operations that would produce nan or inf.
 np.seterr(invalid='raise', divide='raise', over='raise')
@@ -29,7 +30,7 @@ def parse_args():
     parser.add_argument("object_type", type=str,
                         help="Type of object the source galaxy hosts ('agn' or 'sne')")
     parser.add_argument("--datadir", type=str, default='truth_tables',
-                    help='Location of directory containing truth tables')
+                    help='Location of directory containing truth tables, either sqlite files or Parquet directories')
     parser.add_argument("--outdir", type=str, default='outputs',
                         help='Output location for FITS stamps')
     parser.add_argument("--pixel_size", type=float, default=0.04,
@@ -45,10 +46,10 @@ def main():
     output_dir = args.outdir
     object_type = args.object_type
     # Convert to dataframes for easy manipulation
-    lens_df = pd.read_sql('%s_lens' % object_type,
-                          os.path.join('sqlite:///', input_dir, 'lens_truth.db'), index_col=0)
-    src_light_df = pd.read_sql('%s_hosts' % object_type,
-                               os.path.join('sqlite:///', input_dir, 'host_truth.db'), index_col=0)
+    lens_df = TruthCatalogReader(truth_catalog_path(input_dir, 'lens_truth')).read('%s_lens' % object_type,
+                                                                                  index_col='index')
+    src_light_df = TruthCatalogReader(truth_catalog_path(input_dir, 'host_truth')).read('%s_hosts' % object_type,
+                                                                                        index_col='index')
     # Instantiate tool for imaging our hosts
     lensed_host_imager = lensing_utils.LensedHostImager(args.pixel_size, args.num_pix)
     sys_ids = lens_df['lens_cat_sys_id'].unique()
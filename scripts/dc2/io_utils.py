@@ -4,12 +4,14 @@
 """
 
 import os
+import sys
 import copy
 import numpy as np
 import sqlite3
-from sqlalchemy import create_engine
 from astropy.io import fits
 import pandas as pd
+sys.path.append('../..')
+from sprinkler import get_truth_writer
 
 __all__ = ['to_csv', 'export_db']
 
@@ -33,7 +35,8 @@ def to_csv(truth_db_path, dest_dir='.', table_suffix=''):
     cursor.close()
     db.close()
 
-def export_db(dataframe, out_dir, out_fname, table_name, overwrite=False):
+def export_db(dataframe, out_dir, out_fname, table_name, overwrite=False,
+              output_format='sqlite', lens_position=None):
     """Export a DB from a Pandas DataFrame
 
     Parameters
@@ -42,14 +45,20 @@ def export_db(dataframe, out_dir, out_fname, table_name, overwrite=False):
     out_fname : str
     table_name : str
     overwrite_existing : bool
+    output_format : str
+        'sqlite' or 'parquet'. Parquet tables are written as a directory
+        partitioned by healpix of the lens position.
+    lens_position : tuple of arrays
+        (ra, dec) of the lens for every row in degrees. Only needed for
+        Parquet output of tables without `ra_lens` and `dec_lens` columns.
 
     """
     out_path = os.path.join(out_dir, out_fname)
-    if overwrite is True and os.path.exists(out_path):
-        os.remove(out_path)
-    engine = create_engine('sqlite:///{:s}'.format(out_path), echo=False)
-    dataframe.to_sql(table_name, con=engine, index=False)
-    engine.dispose()
+    truth_writer = get_truth_writer(out_path, output_format=output_format,
+                                    overwrite_existing=overwrite)
+    lens_positions = None if lens_position is None else {table_name: lens_position}
+    truth_writer.write({table_name: dataframe}, index=False,
+                       lens_positions=lens_positions)
     return None
 
 def boundary_max(data):
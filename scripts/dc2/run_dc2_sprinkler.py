@@ -1,37 +1,42 @@
 import argparse
+import glob
+import inspect
+import multiprocessing
 import os
 import numpy as np
 import pandas as pd
 import sys
 sys.path.append('../..')
-from sprinkler import OM10Reader, GoldsteinSNeCatReader, DC2Reader, DC2Sprinkler
+from sprinkler import OM10Reader, GoldsteinSNeCatReader, DC2Reader, DC2Sprinkler, id_uniform
+from sprinkler.lens_catalog_readers import native_byteorder, image_slot_columns
+from sprinkler import PhotometryEngine, SedCache, FluxLookup, truth_catalog_path
+import sprinkler
+from sprinkler import CatalogCheckpoint, hash_inputs, StagePipeline
 from lsst.sims.catUtils.dust.EBV import EBVbase
-from copy import deepcopy
 import healpy
 import h5py
 from lsst.sims.photUtils import Sed, BandpassDict, getImsimFluxNorm, Bandpass
 from lsst.utils import getPackageDir
-from astropy.io import fits
+
+# Philox stream used to deal lens catalog systems and hosts out to sky tiles
+TILE_RNG_STREAM = 1
 
 def load_dc2_lenses(catalog_version, agn_db):
 
-    # Load DC2 lens catalogs
     dc2_reader = DC2Reader(catalog_version)
-    lens_cat_filters = ['ra < 53.755', 'ra > 52.495',
-                        'dec < -27.55', 'dec > -28.65']
-    lens_galaxy_df = dc2_reader.load_galaxy_catalog(lens_cat_filters)
-    trim_lens_df = dc2_reader.trim_catalog(lens_galaxy_df)
 
-    # Load DC2 AGN
-    ddf_agn_query = 'ra < 53.755 and ra > 52.495 and dec < -27.55 and dec > -28.65'
-    ddf_agn_df = dc2_reader.load_agn_catalog(agn_db, ddf_agn_query)
+    # Load DC2 AGN. Only the ids are needed to remove lens galaxies with an AGN.
+    ddf_agn_df = dc2_reader.load_agn_catalog(agn_db, ra_range=(52.495, 53.755),
+                                             dec_range=(-28.65, -27.55),
+                                             columns=['galaxy_id'])
 
-    # Remove any potential lens galaxies with AGN
-    lens_id_list = list(trim_lens_df['galaxy_id'].values)
-    ddf_agn_id_set = set(ddf_agn_df['galaxy_id'])
-    drop_lens_gals = [idx for idx, gal_id in \
-                      enumerate(lens_id_list) if gal_id in ddf_agn_id_set]
-    lens_galaxy_df = trim_lens_df.drop(drop_lens_gals).reset_index(drop=True)
+    # Load DC2 lens catalogs healpix chunk by chunk keeping only the
+    # elliptical galaxies that do not host an AGN
+    lens_cat_filters = ['ra < 53.755', 'ra > 52.495',
+                        'dec < -27.55', 'dec > -28.65']
+    lens_galaxy_df = dc2_reader.load_galaxy_catalog(lens_cat_filters, chunked=True,
+                                                    ellipticals_only=True,
+                                                    exclude_ids=ddf_agn_df['galaxy_id'].values)
 
     # Load av_mw, rv_mw for truth catalogs
     ebvObj = EBVbase()
@@ -45,8 +50,8 @@ def load_dc2_lenses(catalog_version, agn_db):
 
     return lens_galaxy_df
 
-def get_healpix_id(ra, dec):
-    pix_id = healpy.ang2pix(32, ra, dec, nest=False, lonlat=True)
+def get_healpix_id(ra, dec, nside=32):
+    pix_id = healpy.ang2pix(nside, ra, dec, nest=False, lonlat=True)
     return pix_id
 
 def load_dc2_hosts(catalog_version, agn_db, sed_dir):
@@ -54,13 +59,14 @@ def load_dc2_hosts(catalog_version, agn_db, sed_dir):
     # Load DC2 lens and host catalogs
     dc2_reader = DC2Reader(catalog_version)
     host_cat_filters = ['ra < 75.', 'ra > 72.5',
-                        'dec < -42.5', 'dec > -45.',
-                        'redshift_true > 0.25']
-    host_galaxy_df = dc2_reader.load_galaxy_catalog(host_cat_filters)
+                        'dec < -42.5', 'dec > -45.']
+    host_galaxy_df = dc2_reader.load_galaxy_catalog(host_cat_filters, chunked=True,
+                                                    min_redshift=0.25)
 
     # Load DC2 AGN
-    host_agn_query = 'ra > 72.5 and ra < 75. and dec > -45 and dec < -42.5 and redshift > 0.25'
-    host_agn_df = dc2_reader.load_agn_catalog(agn_db, host_agn_query)
+    host_agn_df = dc2_reader.load_agn_catalog(agn_db, ra_range=(72.5, 75.),
+                                              dec_range=(-45., -42.5),
+                                              redshift_range=(0.25, None))
 
     # Load healpix ids so we can get SED information
     healpix_ids_hosts = get_healpix_id(host_galaxy_df['ra'],
@@ -87,21 +93,12 @@ def load_dc2_hosts(catalog_version, agn_db, sed_dir):
     sne_host_full_df = host_full_df.iloc[np.where(np.isnan(host_full_df['M_i'].values))]
 
     # Load i-band mags for AGN so we can match to OM10
-    lsst_bp_dict = BandpassDict.loadTotalBandpassesFromFiles()
-    agn_sed = Sed()
-    agn_sed.readSED_flambda(os.path.join(getPackageDir('SIMS_SED_LIBRARY'),
-                                         'agnSED', 'agn.spec.gz'))
-    mag_i_agn = []
-    for agn_data in agn_host_full_df[['magNorm_agn', 'redshift_true']].values:
-        agn_mag, agn_redshift = agn_data
-        if np.isnan(agn_mag):
-            mag_i_agn.append(np.nan)
-            continue
-        agn_copy = deepcopy(agn_sed)
-        flux_norm = getImsimFluxNorm(agn_copy, agn_mag)
-        agn_copy.multiplyFluxNorm(flux_norm)
-        agn_copy.redshiftSED(agn_redshift, dimming=True)
-        mag_i_agn.append(agn_copy.calcMag(lsst_bp_dict['i']))
+    phot_engine = PhotometryEngine(sed_cache=SedCache(sed_dir=getPackageDir('SIMS_SED_LIBRARY')))
+    agn_flux, _ = phot_engine.calc_fluxes(os.path.join('agnSED', 'agn.spec.gz'),
+                                          agn_host_full_df['redshift_true'].values,
+                                          agn_host_full_df['magNorm_agn'].values)
+    # NaN magNorm values give NaN magnitudes
+    mag_i_agn = Sed().magFromFlux(agn_flux[:, phot_engine.bandpass_names.index('i')])
     agn_host_full_df['mag_i_agn'] = mag_i_agn
 
     sed_df = pd.DataFrame([], columns=['bulge_av', 'bulge_rv', 'bulge_sed',
@@ -159,66 +156,169 @@ def load_dc2_hosts(catalog_version, agn_db, sed_dir):
 
     return agn_host_final, sne_host_final
 
-def merge_catalog(df_sys, df_img):
+def sprinkler_code_version():
+
+    # Hash of the sprinkler package sources. The loaders call into the
+    # package readers so a change there has to invalidate saved outputs too.
+    return hash_inputs(*sorted(glob.glob(os.path.join(os.path.dirname(sprinkler.__file__),
+                                                      '*.py'))))
+
+def load_dc2_lenses_checkpointed(checkpoint_dir, catalog_version, agn_db):
+
+    # Checkpoints are rebuilt when the catalogs or the loading code change
+    lens_ckpt = CatalogCheckpoint(checkpoint_dir, 'dc2_lens_ckpt',
+                                  hash_inputs(catalog_version, agn_db,
+                                              inspect.getsource(load_dc2_lenses),
+                                              sprinkler_code_version()))
+    if lens_ckpt.is_valid():
+        return lens_ckpt.load()
+
+    dc2_lenses = load_dc2_lenses(catalog_version, agn_db)
+    lens_ckpt.save(dc2_lenses)
+
+    return dc2_lenses
+
+def load_dc2_hosts_checkpointed(checkpoint_dir, catalog_version, agn_db, sed_dir):
+
+    host_hash = hash_inputs(catalog_version, agn_db, sed_dir,
+                            inspect.getsource(load_dc2_hosts),
+                            sprinkler_code_version())
+    agn_host_ckpt = CatalogCheckpoint(checkpoint_dir, 'dc2_agn_host_ckpt', host_hash)
+    sne_host_ckpt = CatalogCheckpoint(checkpoint_dir, 'dc2_sne_host_ckpt', host_hash)
+    if agn_host_ckpt.is_valid() & sne_host_ckpt.is_valid():
+        return agn_host_ckpt.load(), sne_host_ckpt.load()
 
-    img_pivot = df_img.pivot(index='sysno', columns='imno')
-    img_df = pd.DataFrame([])
-    img_df['sysno'] = img_pivot.index.values
-    img_df['n_img'] = np.sum(~np.isnan(img_pivot['td']), axis=1).values
-    img_df['x_img'] = list(img_pivot['x'].values)
-    img_df['y_img'] = list(img_pivot['y'].values)
-    img_df['t_delay_img'] = list(img_pivot['td'].values)
-    img_df['magnification_img'] = list(img_pivot['mu'].values)
+    dc2_agn_hosts, dc2_sne_hosts = load_dc2_hosts(catalog_version, agn_db, sed_dir)
+    agn_host_ckpt.save(dc2_agn_hosts)
+    sne_host_ckpt.save(dc2_sne_hosts)
 
-    df_merged = df_sys.merge(img_df, on='sysno')
+    return dc2_agn_hosts, dc2_sne_hosts
 
-    return df_merged
+def load_om10(input_dir):
+
+    # Load AGN Lens Cat. Columns are read from the memory-mapped
+    # table and keyed as in OM10Reader.config.
+    om10_cat = OM10Reader(os.path.join(input_dir, 'om10_qso_mock.fits')).load_catalog(memmap=True)
+    # Only keep om10 systems where the host galaxy is within the redshift range of cosmoDC2
+    om10_data = select_systems(om10_cat, np.where(om10_cat['z_src'] <= 3.0)[0])
+    om10_cat.close()
+
+    return om10_data
+
+def select_systems(lens_cat, rows):
+
+    # Select rows of every column of a lens catalog held as a dict of arrays
+    return {key: lens_cat[key][rows] for key in lens_cat}
+
+def load_glsne(input_dir):
+
+    # Load SNe Lens Cat. Image quantities are kept as dense columns,
+    # e.g. x_img_0, x_img_1, ..., all the way to the truth catalog output.
+    glsne_reader = GoldsteinSNeCatReader(os.path.join(input_dir, 'glsne_dc2_v2.h5'))
+    glsne_df_system = pd.read_hdf(glsne_reader.filename, key='system')
+    glsne_df_image = pd.read_hdf(glsne_reader.filename, key='image')
+    glsne_merged_df = glsne_reader.merge_dense_catalog(glsne_df_system, glsne_df_image)
+    # Remove objects where the host galaxy is more than 1.25 arcseconds
+    # from the source so we can image it with postage stamp code
+    glsne_query = 'host_x < 1.25 and host_y < 1.25 and host_x > -1.25 and host_y > -1.25'
+    glsne_merged_df = glsne_merged_df.query(glsne_query).reset_index(drop=True)
+
+    return glsne_merged_df
 
 def fits_to_pandas(input_fits_table):
 
+    # Columns are converted to native byte order once. Each 2-D image column
+    # becomes one float column per image slot, e.g. x_img_0, x_img_1, ...,
+    # as for the GLSNe, so no per-system arrays are made.
     cat_dict = {}
 
-    for key in input_fits_table.columns.names:
-        cat_vals = input_fits_table[key]
-        cat_vals = cat_vals.byteswap().newbyteorder()
-        if len(np.shape(cat_vals)) == 1:
+    for key in input_fits_table:
+        cat_vals = native_byteorder(np.asarray(input_fits_table[key]))
+        if cat_vals.ndim == 1:
             cat_dict[key] = cat_vals
         else:
-            cat_dict[key] = list(cat_vals)
+            for col_name, col_vals in zip(image_slot_columns(key, cat_vals.shape[1]), cat_vals.T):
+                cat_dict[col_name] = col_vals
 
     return pd.DataFrame(cat_dict)
 
-def run_dc2_sprinkler(dc2_lenses, dc2_agn_hosts, dc2_sne_hosts,
-                      om10_data, glsne_merged_df, output_dir):
+def add_fp_vel_disp(dc2_sprinkler, dc2_lenses, rng_mode='legacy'):
 
-    # Match Lenses
-    dc2_sprinkler = DC2Sprinkler()
-
-    # Add velocity dispersion estimates to lens cats
+    # Add velocity dispersion estimates to lens cats. In philox mode the
+    # scatter is keyed on galaxy_id so it does not depend on catalog order.
     gal_radius = dc2_lenses['morphology/spheroidHalfLightRadius'].values
     gal_radius_arcsec = dc2_lenses['morphology/spheroidHalfLightRadiusArcsec'].values
     sigma_fp = dc2_sprinkler.calc_velocity_dispersion(gal_radius,
                                                       dc2_sprinkler.calc_mu_e(dc2_lenses['mag_true_r_lsst'].values,
                                                                               gal_radius_arcsec,
-                                                                              dc2_lenses['redshift_true'].values))
+                                                                              dc2_lenses['redshift_true'].values),
+                                                      galaxy_id=dc2_lenses['galaxy_id'].values,
+                                                      rng_mode=rng_mode)
     dc2_lenses['fp_vel_disp'] = sigma_fp
 
+    return dc2_lenses
+
+def fp_vel_disp_stage(dc2_lenses, rng_mode='legacy'):
+
+    return add_fp_vel_disp(DC2Sprinkler(), dc2_lenses.copy(), rng_mode=rng_mode)
+
+def sncosmo_params_stage(glsne_merged_df):
+
+    return DC2Sprinkler().add_sncosmo_params(glsne_merged_df.copy())
+
+def host_match_stage(agn_lens_match, sne_lens_match, dc2_hosts, rng_mode='legacy'):
+
+    dc2_agn_hosts, dc2_sne_hosts = dc2_hosts
 
+    return match_dc2_hosts(agn_lens_match, sne_lens_match, dc2_agn_hosts, dc2_sne_hosts,
+                           rng_mode=rng_mode)
+
+def match_agn_lenses(dc2_lenses, om10_data, agn_density=0.09, rng_mode='legacy',
+                     assignment='greedy', assignment_seed=0,
+                     max_candidates=64):
+
+    """
+    Match lens galaxies to OM10 systems. Returns a dict with the matched
+    lenses, the matched OM10 systems and the lens galaxies left for the SNe.
+    """
+
+    dc2_sprinkler = DC2Sprinkler()
+    sigma_fp = dc2_lenses['fp_vel_disp'].values
 
     # Match OM10 Lenses
     om10_match_idx, lens_gal_match_idx, om10_lensid = dc2_sprinkler.match_to_lenscat_agn(sigma_fp,
                                                                                         dc2_lenses['redshift_true'],
-                                                                                        om10_data, density=0.09)
+                                                                                        om10_data, density=agn_density,
+                                                                                        rng_mode=rng_mode,
+                                                                                        assignment=assignment,
+                                                                                        assignment_seed=assignment_seed,
+                                                                                        max_candidates=max_candidates)
     agn_matched_ddf_lenses = dc2_lenses.iloc[lens_gal_match_idx].reset_index(drop=True)
-    agn_matched_ddf_lenses['LENSID'] = np.array(om10_data['LENSID'][om10_match_idx], dtype=np.int)
+    agn_matched_ddf_lenses['LENSID'] = np.array(om10_data['system_id'][om10_match_idx], dtype=np.int64)
     dc2_lenses_post_agn_matches = dc2_lenses.drop(lens_gal_match_idx).reset_index(drop=True)
-    om10_ddf_systems = om10_data[om10_match_idx]
+    om10_ddf_systems = select_systems(om10_data, om10_match_idx)
+
+    return {'agn_lenses': agn_matched_ddf_lenses,
+            'agn_systems': om10_ddf_systems,
+            'remaining_lenses': dc2_lenses_post_agn_matches}
+
+def match_sne_lenses(agn_lens_match, glsne_merged_df, sne_density=0.85, rng_mode='legacy',
+                     assignment='greedy', sne_weight_norm=None, assignment_seed=0,
+                     max_candidates=64):
+
+    """
+    Match the lens galaxies left after the AGN matching to GLSNe systems.
+    `glsne_merged_df` must already have the sncosmo parameters. When it only
+    holds part of the catalog `sne_weight_norm` must be the largest weight in
+    the whole catalog so the match probabilities do not change.
+    """
+
+    dc2_sprinkler = DC2Sprinkler()
+    dc2_lenses_post_agn_matches = agn_lens_match['remaining_lenses']
 
-    # Add SNCosmo Parameters
-    glsne_merged_df = dc2_sprinkler.add_sncosmo_params(glsne_merged_df)
     # Discard dc2 galaxies that won't match no matter what because they are outside redshift, vel. disp range of lens catalog lenses
-    max_z_glsne_lens = np.power(10, np.log10(np.max(glsne_merged_df['zl'])) + 0.03)
-    min_vel_disp = np.power(10, np.log10(np.min(glsne_merged_df['sigma'])) - 0.03)
+    max_z_glsne_lens = np.power(10, np.log10(np.max(glsne_merged_df['zl'].values, initial=0.)) + 0.03)
+    min_vel_disp = np.power(10, np.log10(np.min(glsne_merged_df['sigma'].values, initial=np.inf)) - 0.03)
     dc2_lenses_sne_set = dc2_lenses_post_agn_matches.query('redshift_true < %f and fp_vel_disp > %f' % (max_z_glsne_lens,
                                                                                                             min_vel_disp)).reset_index(drop=True)
     glsne_match_idx, lens_gal_sne_match_idx, glsne_sysno = dc2_sprinkler.match_to_lenscat_sne(dc2_lenses_sne_set['fp_vel_disp'].values,
@@ -227,29 +327,54 @@ def run_dc2_sprinkler(dc2_lenses, dc2_agn_hosts, dc2_sne_hosts,
                                                                                               glsne_merged_df['sigma'].values,
                                                                                               glsne_merged_df['sysno'].values,
                                                                                               glsne_merged_df['weight'].values,
-                                                                                              density=0.85)
+                                                                                              density=sne_density,
+                                                                                              rng_mode=rng_mode,
+                                                                                              assignment=assignment,
+                                                                                              assignment_seed=assignment_seed,
+                                                                                              weight_norm=sne_weight_norm,
+                                                                                              max_candidates=max_candidates)
     sne_matched_ddf_lenses = dc2_lenses_sne_set.iloc[lens_gal_sne_match_idx].reset_index(drop=True)
-    sne_matched_ddf_lenses['LENSID'] = np.array(glsne_merged_df['sysno'][glsne_match_idx], dtype=np.int)
+    sne_matched_ddf_lenses['LENSID'] = np.array(glsne_merged_df['sysno'].values[glsne_match_idx], dtype=np.int64)
     glsne_ddf_systems = glsne_merged_df.iloc[glsne_match_idx]
 
+    return {'sne_lenses': sne_matched_ddf_lenses,
+            'sne_systems': glsne_ddf_systems}
+
+def match_dc2_hosts(agn_lens_match, sne_lens_match, dc2_agn_hosts, dc2_sne_hosts,
+                    rng_mode='legacy'):
+
+    """
+    Match host galaxies to the matched OM10 and GLSNe systems. Returns a dict
+    with the matched lenses, hosts and lens catalog systems for the AGN and
+    SNe ready for the truth catalog outputs.
+    """
+
+    dc2_sprinkler = DC2Sprinkler()
+    agn_matched_ddf_lenses = agn_lens_match['agn_lenses']
+    om10_ddf_systems = agn_lens_match['agn_systems']
+    sne_matched_ddf_lenses = sne_lens_match['sne_lenses']
+    glsne_ddf_systems = sne_lens_match['sne_systems']
+
     # Match hosts
     om10_index, agn_host_gal_index, om10_matched_lensid = dc2_sprinkler.match_hosts_om10(dc2_agn_hosts['redshift_true'],
                                                                                          dc2_agn_hosts['mag_i_agn'],
-                                                                                         om10_ddf_systems)
+                                                                                         om10_ddf_systems,
+                                                                                         rng_mode=rng_mode)
     agn_final_ddf_lenses = agn_matched_ddf_lenses.iloc[om10_index]
     agn_final_ddf_hosts = dc2_agn_hosts.iloc[agn_host_gal_index].reset_index(drop=True)
-    agn_final_ddf_hosts['LENSID'] = np.array(om10_matched_lensid, dtype=np.int)
-    om10_fits_final = om10_ddf_systems[om10_index]
-    om10_ddf_final = fits_to_pandas(om10_fits_final)
+    agn_final_ddf_hosts['LENSID'] = np.array(om10_matched_lensid, dtype=np.int64)
+    # OM10 columns are already keyed with the sprinkler names
+    om10_ddf_sprinkler_cat = fits_to_pandas(select_systems(om10_ddf_systems, om10_index))
 
     glsne_index, sne_host_gal_index, glsne_matched_lensid = dc2_sprinkler.match_hosts_glsne(dc2_sne_hosts['redshift_true'],
                                                                                             dc2_sne_hosts['size_true'],
                                                                                             glsne_ddf_systems['zs'].values,
                                                                                             glsne_ddf_systems['host_reff'],
-                                                                                            glsne_ddf_systems['sysno'].values)
+                                                                                            glsne_ddf_systems['sysno'].values,
+                                                                                            rng_mode=rng_mode)
     sne_final_ddf_lenses = sne_matched_ddf_lenses.iloc[glsne_index]
     sne_final_ddf_hosts = dc2_sne_hosts.iloc[sne_host_gal_index].reset_index(drop=True)
-    sne_final_ddf_hosts['LENSID'] = np.array(glsne_matched_lensid, dtype=np.int)
+    sne_final_ddf_hosts['LENSID'] = np.array(glsne_matched_lensid, dtype=np.int64)
     glsne_ddf_final = glsne_ddf_systems.iloc[glsne_index]
 
     agn_final_ddf_lenses = agn_final_ddf_lenses.rename(columns={'shear_1': 'gamma_1',
@@ -265,20 +390,6 @@ def run_dc2_sprinkler(dc2_lenses, dc2_agn_hosts, dc2_sne_hosts,
                                                                 'convergence':'kappa',
                                                                 'position_angle_true':'position_angle',})
 
-    om10_ddf_sprinkler_cat = om10_ddf_final.rename(columns={'ZLENS':'z_lens',
-                                                            'PHIE':'phie_lens',
-                                                            'GAMMA':'gamma',
-                                                            'PHIG':'phi_gamma',
-                                                            'ELLIP':'ellip_lens',
-                                                            'LENSID':'system_id',
-                                                            'NIMG':'n_img',
-                                                            'XSRC':'x_src',
-                                                            'YSRC':'y_src',
-                                                            'XIMG':'x_img',
-                                                            'YIMG':'y_img',
-                                                            'ZSRC':'z_src',
-                                                            'MAG':'magnification_img',
-                                                            'DELAY':'t_delay_img'})
     glsne_ddf_final = glsne_ddf_final.rename(columns={'zl':'z_lens',
                                                       'sysno':'system_id',
                                                       'theta_gamma': 'phi_gamma',
@@ -288,11 +399,6 @@ def run_dc2_sprinkler(dc2_lenses, dc2_agn_hosts, dc2_sne_hosts,
                                                       'e':'ellip_lens',
                                                       'theta_e':'phie_lens'})
 
-    agn_lens_truth, sne_lens_truth = dc2_sprinkler.output_lens_galaxy_truth(agn_final_ddf_lenses, om10_ddf_sprinkler_cat,
-                                                                            sne_final_ddf_lenses, glsne_ddf_final,
-                                                                            os.path.join(output_dir, 'lens_truth.db'),
-                                                                            return_df=True, overwrite_existing=True)
-
     agn_final_ddf_hosts = agn_final_ddf_hosts.rename(columns={'size_disk_true':'semi_major_axis_disk',
                                                             'size_bulge_true':'semi_major_axis_bulge',
                                                             'size_minor_disk_true':'semi_minor_axis_disk',
@@ -321,29 +427,250 @@ def run_dc2_sprinkler(dc2_lenses, dc2_agn_hosts, dc2_sne_hosts,
                                                             'disk_sed':'sed_disk',
                                                             'bulge_sed':'sed_bulge'})
 
+    return {'agn_lenses': agn_final_ddf_lenses,
+            'agn_hosts': agn_final_ddf_hosts,
+            'agn_systems': om10_ddf_sprinkler_cat,
+            'sne_lenses': sne_final_ddf_lenses,
+            'sne_hosts': sne_final_ddf_hosts,
+            'sne_systems': glsne_ddf_final}
+
+def match_dc2_systems(dc2_lenses, dc2_agn_hosts, dc2_sne_hosts,
+                      om10_data, glsne_merged_df, agn_density=0.09,
+                      sne_density=0.85, rng_mode='legacy', assignment='greedy',
+                      sne_weight_norm=None, assignment_seed=0, max_candidates=64):
+
+    """
+    Match lens galaxies and host galaxies to the lens catalog systems.
+
+    `dc2_lenses` must already have `fp_vel_disp` and `glsne_merged_df` the
+    sncosmo parameters. Returns a dict with the matched lenses, hosts and lens
+    catalog systems for the AGN and SNe ready for the truth catalog outputs.
+    """
+
+    agn_lens_match = match_agn_lenses(dc2_lenses, om10_data, agn_density=agn_density,
+                                      rng_mode=rng_mode, assignment=assignment,
+                                      assignment_seed=assignment_seed, max_candidates=max_candidates)
+    sne_lens_match = match_sne_lenses(agn_lens_match, glsne_merged_df,
+                                      sne_density=sne_density, rng_mode=rng_mode,
+                                      assignment=assignment, sne_weight_norm=sne_weight_norm,
+                                      assignment_seed=assignment_seed, max_candidates=max_candidates)
+
+    return match_dc2_hosts(agn_lens_match, sne_lens_match, dc2_agn_hosts, dc2_sne_hosts,
+                           rng_mode=rng_mode)
+
+def output_truth_catalogs(matched, output_dir, flux_grid_dir=None, output_format='sqlite'):
+
+    dc2_sprinkler = DC2Sprinkler()
+    # Interpolate fluxes from saved flux grids if requested otherwise integrate the SEDs
+    phot_engine = PhotometryEngine()
+    if flux_grid_dir is not None:
+        phot_engine = FluxLookup(grid_dir=flux_grid_dir, phot_engine=phot_engine)
+
+    agn_final_ddf_lenses = matched['agn_lenses']
+    agn_final_ddf_hosts = matched['agn_hosts']
+    om10_ddf_sprinkler_cat = matched['agn_systems']
+    sne_final_ddf_lenses = matched['sne_lenses']
+    sne_final_ddf_hosts = matched['sne_hosts']
+    glsne_ddf_final = matched['sne_systems']
+
+    truth_paths = {truth_name: truth_catalog_path(output_dir, truth_name, output_format=output_format)
+                   for truth_name in ['lens_truth', 'host_truth', 'lensed_agn_truth', 'lensed_sne_truth']}
+
+    agn_lens_truth, sne_lens_truth = dc2_sprinkler.output_lens_galaxy_truth(agn_final_ddf_lenses, om10_ddf_sprinkler_cat,
+                                                                            sne_final_ddf_lenses, glsne_ddf_final,
+                                                                            truth_paths['lens_truth'],
+                                                                            return_df=True, overwrite_existing=True,
+                                                                            output_format=output_format)
+
     agn_host_truth, sne_host_truth = dc2_sprinkler.output_host_galaxy_truth(agn_final_ddf_lenses, agn_final_ddf_hosts,
                                                                             om10_ddf_sprinkler_cat,
                                                                             sne_final_ddf_lenses, sne_final_ddf_hosts,
                                                                             glsne_ddf_final,
-                                                                            os.path.join(output_dir, 'host_truth.db'),
-                                                                            return_df=True, overwrite_existing=True)
+                                                                            truth_paths['host_truth'],
+                                                                            return_df=True, overwrite_existing=True,
+                                                                            phot_engine=phot_engine,
+                                                                            output_format=output_format)
 
     lensed_agn_truth = dc2_sprinkler.output_lensed_agn_truth(agn_final_ddf_hosts,
                                                              agn_final_ddf_lenses,
                                                              om10_ddf_sprinkler_cat,
-                                                             os.path.join(output_dir, 'lensed_agn_truth.db'),
-                                                             return_df=True, overwrite_existing=True)
+                                                             truth_paths['lensed_agn_truth'],
+                                                             return_df=True, overwrite_existing=True,
+                                                             phot_engine=phot_engine,
+                                                             output_format=output_format)
 
     lensed_sne_truth = dc2_sprinkler.output_lensed_sne_truth(sne_final_ddf_hosts,
                                                              sne_final_ddf_lenses,
                                                              glsne_ddf_final,
-                                                             os.path.join(output_dir, 'lensed_sne_truth.db'),
-                                                             return_df=True, overwrite_existing=True)
+                                                             truth_paths['lensed_sne_truth'],
+                                                             return_df=True, overwrite_existing=True,
+                                                             output_format=output_format)
+
+    return list(truth_paths.values())
+
+def truth_files_exist(truth_files):
+
+    return all([os.path.exists(truth_file) for truth_file in truth_files])
+
+def build_sprinkler_pipeline(input_dir, checkpoint_dir, output_dir, catalog_version,
+                             agn_db, sed_dir, cache_dir=None, rng_mode='legacy',
+                             agn_density=0.09, sne_density=0.85, flux_grid_dir=None,
+                             assignment='greedy', output_format='sqlite', assignment_seed=0,
+                             max_candidates=64):
+
+    """
+    The sprinkler as a chain of cached stages. Each stage output is cached in
+    `cache_dir` keyed on its code, parameters and the contents of its inputs so
+    a re-run only redoes the stages downstream of what changed, e.g. changing
+    `sne_density` reruns the SNe lens match, host match and truth output only.
+    The catalog loading stages use their own typed checkpoints in `checkpoint_dir`.
+    """
+
+    # Changes to the sprinkler package invalidate every cached stage. Each
+    # stage key also covers the helpers in this script the stage calls.
+    pipeline = StagePipeline(cache_dir=cache_dir, code_version=sprinkler_code_version())
+
+    pipeline.add_stage('load_lenses', load_dc2_lenses_checkpointed, cache=False,
+                       params={'checkpoint_dir': checkpoint_dir,
+                               'catalog_version': catalog_version, 'agn_db': agn_db})
+    pipeline.add_stage('load_hosts', load_dc2_hosts_checkpointed, cache=False,
+                       params={'checkpoint_dir': checkpoint_dir,
+                               'catalog_version': catalog_version, 'agn_db': agn_db,
+                               'sed_dir': sed_dir})
+    pipeline.add_stage('load_om10', load_om10, cache=False, params={'input_dir': input_dir})
+    pipeline.add_stage('load_glsne', load_glsne, cache=False, params={'input_dir': input_dir})
+    pipeline.add_stage('fp_vel_disp', fp_vel_disp_stage, inputs=['load_lenses'],
+                       params={'rng_mode': rng_mode})
+    pipeline.add_stage('sncosmo_params', sncosmo_params_stage, inputs=['load_glsne'])
+    pipeline.add_stage('agn_lens_match', match_agn_lenses, inputs=['fp_vel_disp', 'load_om10'],
+                       params={'agn_density': agn_density, 'rng_mode': rng_mode,
+                               'assignment': assignment, 'assignment_seed': assignment_seed,
+                               'max_candidates': max_candidates})
+    pipeline.add_stage('sne_lens_match', match_sne_lenses,
+                       inputs=['agn_lens_match', 'sncosmo_params'],
+                       params={'sne_density': sne_density, 'rng_mode': rng_mode,
+                               'assignment': assignment, 'assignment_seed': assignment_seed,
+                               'max_candidates': max_candidates})
+    pipeline.add_stage('host_match', host_match_stage,
+                       inputs=['agn_lens_match', 'sne_lens_match', 'load_hosts'],
+                       params={'rng_mode': rng_mode})
+    pipeline.add_stage('truth_output', output_truth_catalogs, inputs=['host_match'],
+                       params={'output_dir': output_dir, 'flux_grid_dir': flux_grid_dir,
+                               'output_format': output_format},
+                       is_current=truth_files_exist)
+
+    return pipeline
+
+def run_dc2_sprinkler(dc2_lenses, dc2_agn_hosts, dc2_sne_hosts,
+                      om10_data, glsne_merged_df, output_dir, rng_mode='legacy',
+                      agn_density=0.09, sne_density=0.85, flux_grid_dir=None,
+                      assignment='greedy', output_format='sqlite', assignment_seed=0,
+                      max_candidates=64):
+
+    dc2_sprinkler = DC2Sprinkler()
+
+    dc2_lenses = add_fp_vel_disp(dc2_sprinkler, dc2_lenses, rng_mode=rng_mode)
+    # Add SNCosmo Parameters
+    glsne_merged_df = dc2_sprinkler.add_sncosmo_params(glsne_merged_df)
+
+    matched = match_dc2_systems(dc2_lenses, dc2_agn_hosts, dc2_sne_hosts,
+                                om10_data, glsne_merged_df, agn_density=agn_density,
+                                sne_density=sne_density, rng_mode=rng_mode,
+                                assignment=assignment, assignment_seed=assignment_seed,
+                                max_candidates=max_candidates)
+
+    output_truth_catalogs(matched, output_dir, flux_grid_dir=flux_grid_dir,
+                          output_format=output_format)
+
+def deal_to_tiles(ids, n_tiles):
+
+    # Pseudo-randomly assign each id to exactly one tile.
+    # Depends only on the id so the assignment is reproducible.
+    tile_num = np.floor(id_uniform(ids, stream=TILE_RNG_STREAM) * n_tiles).astype(int)
+
+    return np.minimum(tile_num, n_tiles - 1)
+
+def merge_tile_matches(tile_matches):
+
+    # Without any tiles there is nothing matched, e.g. for an empty sky selection
+    if len(tile_matches) == 0:
+        return {key: pd.DataFrame() for key in ['agn_lenses', 'agn_hosts', 'agn_systems',
+                                                'sne_lenses', 'sne_hosts', 'sne_systems']}
+
+    matched = {}
+    for key in tile_matches[0].keys():
+        matched[key] = pd.concat([tile_match[key] for tile_match in tile_matches],
+                                 ignore_index=True, sort=False)
+
+    for key in ['agn_systems', 'sne_systems']:
+        if matched[key]['system_id'].duplicated().any():
+            raise RuntimeError('Lens catalog system assigned in more than one tile')
+
+    return matched
+
+def run_dc2_sprinkler_tiled(dc2_lenses, dc2_agn_hosts, dc2_sne_hosts,
+                            om10_data, glsne_merged_df, output_dir,
+                            n_processes=None, nside=32, rng_mode='legacy',
+                            agn_density=0.09, sne_density=0.85, flux_grid_dir=None,
+                            assignment='greedy', output_format='sqlite', assignment_seed=0,
+                            max_candidates=64):
+
+    """
+    Run the matching separately on each healpixel of the lens footprint in a
+    process pool and write a single set of truth catalogs.
+
+    Lens galaxies are split by healpixel. The OM10 and GLSNe systems and the
+    potential host galaxies are each dealt out to exactly one tile based on
+    their IDs, so no lens catalog system or host can be used by two tiles and
+    `agn_density`, `sne_density` keep their meaning as the fraction of lens
+    catalog systems we try to match. The GLSNe weights are normalized by the
+    largest weight in the whole catalog for the same reason. The tile results are concatenated before
+    writing so `dc2_sys_id` values are unique over the whole run.
+    """
+
+    dc2_sprinkler = DC2Sprinkler()
+
+    lens_hpix = get_healpix_id(dc2_lenses['ra'].values, dc2_lenses['dec'].values, nside=nside)
+    tile_hpix = np.unique(lens_hpix)
+    n_tiles = len(tile_hpix)
+    if n_tiles < 1:
+        raise ValueError('No lens galaxies to split into tiles')
+    print('Sprinkling %i healpixel tiles with nside %i' % (n_tiles, nside))
+
+    # Velocity dispersions and sncosmo parameters are computed once for the
+    # whole catalog so they do not depend on the tiling.
+    dc2_lenses = add_fp_vel_disp(dc2_sprinkler, dc2_lenses, rng_mode=rng_mode)
+    glsne_merged_df = dc2_sprinkler.add_sncosmo_params(glsne_merged_df)
+    sne_weight_norm = np.max(glsne_merged_df['weight'].values, initial=0.)
+
+    om10_tile = deal_to_tiles(om10_data['system_id'], n_tiles)
+    glsne_tile = deal_to_tiles(glsne_merged_df['sysno'].values, n_tiles)
+    agn_host_tile = deal_to_tiles(dc2_agn_hosts['galaxy_id'].values, n_tiles)
+    sne_host_tile = deal_to_tiles(dc2_sne_hosts['galaxy_id'].values, n_tiles)
+
+    tile_args = []
+    for tile_num, hpix in enumerate(tile_hpix):
+        tile_args.append((dc2_lenses[lens_hpix == hpix].reset_index(drop=True),
+                          dc2_agn_hosts[agn_host_tile == tile_num].reset_index(drop=True),
+                          dc2_sne_hosts[sne_host_tile == tile_num].reset_index(drop=True),
+                          select_systems(om10_data, om10_tile == tile_num),
+                          glsne_merged_df[glsne_tile == tile_num].reset_index(drop=True),
+                          agn_density, sne_density, rng_mode, assignment, sne_weight_norm,
+                          assignment_seed, max_candidates))
+
+    with multiprocessing.Pool(processes=n_processes) as pool:
+        tile_matches = pool.starmap(match_dc2_systems, tile_args)
+
+    matched = merge_tile_matches(tile_matches)
+
+    output_truth_catalogs(matched, output_dir, flux_grid_dir=flux_grid_dir,
+                          output_format=output_format)
 
 
 if __name__ == '__main__':
 
     catalog_version = 'cosmoDC2_v1.1.4_image_addon_knots'
+    # An index on agn_params (ra, dec) speeds up the AGN loading, see DC2Reader.load_agn_catalog
     agn_db = '/global/cfs/cdirs/lsst/projecta/lsst/groups/SSim/DC2/cosmoDC2_v1.1.4/agn_cosmoDC2_v1.1.4.db'
     sed_dir = '/global/projecta/projectdirs/lsst/groups/SSim/DC2/cosmoDC2_v1.1.4/sedLookup'
 
@@ -353,40 +680,69 @@ if __name__ == '__main__':
     parser.add_argument('--input_dir', type=str, help='Input Data Directory')
     parser.add_argument('--checkpoint_dir', type=str, help='Checkpoint File Directory')
     parser.add_argument('--output_dir', type=str, help='Output Data Directory')
+    parser.add_argument('--rng_mode', type=str, default='legacy', choices=['legacy', 'philox'],
+                        help='Random number generator for matching. ' +
+                             '`legacy` reproduces earlier runs, `philox` is batched and faster.')
+    parser.add_argument('--assignment', type=str, default='greedy', choices=['greedy', 'global'],
+                        help='How lens galaxies are assigned to lens catalog systems. ' +
+                             '`greedy` reproduces earlier runs, `global` matches all systems at once ' +
+                             'and is a maximum matching only with --assignment_max_candidates 0.')
+    parser.add_argument('--assignment_seed', type=int, default=0,
+                        help='Seed of the candidate pruning and tie-breaks of --assignment global')
+    parser.add_argument('--assignment_max_candidates', type=int, default=64,
+                        help='Candidates kept per system with --assignment global. ' +
+                             'Pass 0 to keep every candidate for an exact maximum matching.')
+    parser.add_argument('--agn_density', type=float, default=0.09,
+                        help='Fraction of OM10 systems to try to match')
+    parser.add_argument('--sne_density', type=float, default=0.85,
+                        help='Density scale for matching GLSNe systems')
+    parser.add_argument('--tiled', action='store_true',
+                        help='Split the lens footprint into healpixels and match each one in a process pool')
+    parser.add_argument('--tile_nside', type=int, default=32,
+                        help='Healpix nside of the tiles used with --tiled')
+    parser.add_argument('--n_processes', type=int, default=None,
+                        help='Number of processes used with --tiled. Defaults to the number of cpus.')
+    parser.add_argument('--stage_cache_dir', type=str, default=None,
+                        help='Directory for the cached outputs of the pipeline stages. ' +
+                             'Defaults to stage_cache inside the checkpoint directory.')
+    parser.add_argument('--flux_grid_dir', type=str, default=None,
+                        help='Interpolate truth catalog fluxes from flux grids saved in this directory ' +
+                             'instead of integrating every SED. Grids are built when missing.')
+    parser.add_argument('--output_format', type=str, default='sqlite', choices=['sqlite', 'parquet'],
+                        help='Format of the truth catalogs. `parquet` writes a directory per catalog ' +
+                             'partitioned by the healpix of the lens position.')
     args = parser.parse_args()
 
-    # Load DC2 catalogs
-    if os.path.exists(os.path.join(args.checkpoint_dir, 'dc2_lens_ckpt.csv')):
-        dc2_lenses = pd.read_csv(os.path.join(args.checkpoint_dir, 'dc2_lens_ckpt.csv'))
-    else:
-        dc2_lenses = load_dc2_lenses(catalog_version, agn_db)
-        dc2_lenses.to_csv(os.path.join(args.checkpoint_dir, 'dc2_lens_ckpt.csv'), index=False)
-
-    if (os.path.exists(os.path.join(args.checkpoint_dir, 'dc2_agn_host_ckpt.csv')) &
-        os.path.exists(os.path.join(args.checkpoint_dir, 'dc2_sne_host_ckpt.csv'))):
-        dc2_agn_hosts = pd.read_csv(os.path.join(args.checkpoint_dir, 'dc2_agn_host_ckpt.csv'))
-        dc2_sne_hosts = pd.read_csv(os.path.join(args.checkpoint_dir, 'dc2_sne_host_ckpt.csv'))
-    else:
-        dc2_agn_hosts, dc2_sne_hosts = load_dc2_hosts(catalog_version, agn_db, sed_dir)
-        dc2_agn_hosts.to_csv(os.path.join(args.checkpoint_dir, 'dc2_agn_host_ckpt.csv'), index=False)
-        dc2_sne_hosts.to_csv(os.path.join(args.checkpoint_dir, 'dc2_sne_host_ckpt.csv'), index=False)
-
-    # Load AGN Lens Cat
-    om10_hdu = fits.open(os.path.join(args.input_dir, 'om10_qso_mock.fits'))
-    om10_data = om10_hdu[1].data
-    # Only keep om10 systems where the host galaxy is within the redshift range of cosmoDC2
-    om10_data = om10_data[np.where(om10_data['ZSRC'] <= 3.0)]
-
-    # Load SNe Lens Cat
-    glsne_df_system = pd.read_hdf(os.path.join(args.input_dir, 'glsne_dc2_v2.h5'), key='system')
-    glsne_df_image = pd.read_hdf(os.path.join(args.input_dir, 'glsne_dc2_v2.h5'), key='image')
-    glsne_merged_df = merge_catalog(glsne_df_system, glsne_df_image)
-    # Remove objects where the host galaxy is more than 1.25 arcseconds
-    # from the source so we can image it with postage stamp code
-    glsne_query = 'host_x < 1.25 and host_y < 1.25 and host_x > -1.25 and host_y > -1.25'
-    glsne_merged_df = glsne_merged_df.query(glsne_query).reset_index(drop=True)
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    stage_cache_dir = args.stage_cache_dir
+    if stage_cache_dir is None:
+        stage_cache_dir = os.path.join(args.checkpoint_dir, 'stage_cache')
 
     os.makedirs(args.output_dir, exist_ok=True)
+    max_candidates = args.assignment_max_candidates
+    if max_candidates <= 0:
+        max_candidates = None
+    pipeline = build_sprinkler_pipeline(args.input_dir, args.checkpoint_dir, args.output_dir,
+                                        catalog_version, agn_db, sed_dir,
+                                        cache_dir=stage_cache_dir, rng_mode=args.rng_mode,
+                                        agn_density=args.agn_density,
+                                        sne_density=args.sne_density,
+                                        flux_grid_dir=args.flux_grid_dir,
+                                        assignment=args.assignment,
+                                        output_format=args.output_format,
+                                        assignment_seed=args.assignment_seed,
+                                        max_candidates=max_candidates)
+
     # Run Match and Truth Catalog Generation
-    run_dc2_sprinkler(dc2_lenses, dc2_agn_hosts, dc2_sne_hosts,
-                      om10_data, glsne_merged_df, args.output_dir)
+    if args.tiled:
+        catalogs = pipeline.run(['load_lenses', 'load_hosts', 'load_om10', 'load_glsne'])
+        dc2_agn_hosts, dc2_sne_hosts = catalogs['load_hosts']
+        run_dc2_sprinkler_tiled(catalogs['load_lenses'], dc2_agn_hosts, dc2_sne_hosts,
+                                catalogs['load_om10'], catalogs['load_glsne'], args.output_dir,
+                                n_processes=args.n_processes, nside=args.tile_nside,
+                                rng_mode=args.rng_mode, agn_density=args.agn_density,
+                                sne_density=args.sne_density, flux_grid_dir=args.flux_grid_dir,
+                                assignment=args.assignment, output_format=args.output_format,
+                                assignment_seed=args.assignment_seed, max_candidates=max_candidates)
+    else:
+        pipeline.run()
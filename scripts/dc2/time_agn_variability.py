@@ -0,0 +1,59 @@
+"""
+Time ExtraGalacticVariabilityModels.applyAgn for a range of process pool
+sizes on a synthetic set of AGN and check that every pool size gives the
+same dMags as the serial path.
+"""
+import argparse
+import time
+import numpy as np
+from dc2_utils.variability import ExtraGalacticVariabilityModels
+
+
+def time_apply_agn(n_threads, params, expmjd, redshift, n_repeat=3):
+
+    class AgnModel(ExtraGalacticVariabilityModels):
+        _agn_threads = n_threads
+
+    agn_model = AgnModel()
+    valid_dexes = [np.arange(len(expmjd))]
+    run_times = []
+    for i in range(n_repeat):
+        t_start = time.time()
+        d_mags = agn_model.applyAgn(valid_dexes, params, expmjd, redshift=redshift)
+        run_times.append(time.time() - t_start)
+
+    return min(run_times), d_mags
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=
+                'Time the AGN variability process pool')
+    parser.add_argument('--n_agn', type=int, default=10000,
+                        help='number of synthetic AGN to simulate')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='process pool sizes to time')
+    parser.add_argument('--n_repeat', type=int, default=3,
+                        help='repeats per pool size; the fastest is reported')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rand_state = np.random.RandomState(args.seed)
+    params = {'seed': rand_state.randint(0, 2**31, size=args.n_agn)}
+    for filt_name in ['u', 'g', 'r', 'i', 'z', 'y']:
+        params['agn_tau_%s' % filt_name] = rand_state.uniform(50., 500., size=args.n_agn)
+        params['agn_sf_%s' % filt_name] = rand_state.uniform(0.1, 0.5, size=args.n_agn)
+    redshift = rand_state.uniform(0.1, 3., size=args.n_agn)
+    expmjd = rand_state.uniform(59580., 60500., size=args.n_agn)
+
+    serial_time, serial_d_mags = time_apply_agn(1, params, expmjd, redshift,
+                                                n_repeat=args.n_repeat)
+    print('%d AGN, serial: %.2f s' % (args.n_agn, serial_time))
+    for n_threads in args.threads:
+        if n_threads == 1:
+            continue
+        run_time, d_mags = time_apply_agn(n_threads, params, expmjd, redshift,
+                                          n_repeat=args.n_repeat)
+        print('%d threads: %.2f s, speedup %.2f, identical to serial: %s' %
+              (n_threads, run_time, serial_time/run_time,
+               np.array_equal(d_mags, serial_d_mags)))
@@ -24,7 +24,7 @@ from lenstronomy.LensModel.lens_model import LensModel
 from lenstronomy.LensModel.Solver.lens_equation_solver import LensEquationSolver
 import lensing_utils
 import io_utils
-from sprinkler import DC2Sprinkler
+from sprinkler import PhotometryEngine, sed_file_name, TruthCatalogReader, truth_catalog_path
 
 def parse_args():
     """Parse command-line arguments
@@ -34,11 +34,13 @@ def parse_args():
     parser.add_argument("object_type", type=str,
                         help="Type of object the source galaxy hosts ('agn' or 'sne')")
     parser.add_argument("--datadir", type=str, default='truth_tables',
-                    help='Location of directory containing truth tables')
+                    help='Location of directory containing truth tables, either sqlite files or Parquet directories')
     parser.add_argument("--pixel_size", type=float, default=0.04,
                         help='Pixel size in arcseconds. Used to set the numerical precision of the lens equation solver.')
     parser.add_argument("--num_pix", type=int, default=250,
                         help='Number of pixels in x- or y-direction. Used to set the numerical precision of the lens equation solver.')
+    parser.add_argument("--output_format", type=str, default='sqlite', choices=['sqlite', 'parquet'],
+                        help='Write the updated truth tables as sqlite files or healpix partitioned Parquet datasets')
     args = parser.parse_args()
     return args
 
@@ -46,10 +48,11 @@ def main():
     args = parse_args()
     input_dir = args.datadir
     object_type = args.object_type
-    # Load DB files as dataframes
-    lens_df = pd.read_sql(f'{object_type}_lens', str('sqlite:///' + os.path.join(input_dir, 'lens_truth.db')), index_col=0)
-    ps_df = pd.read_sql(f'lensed_{object_type}', str('sqlite:///' + os.path.join(input_dir, f'lensed_{object_type}_truth.db')), index_col=0)
-    src_light_df = pd.read_sql(f'{object_type}_hosts', str('sqlite:///' + os.path.join(input_dir, 'host_truth.db')), index_col=0)
+    # Load truth tables as dataframes
+    # Either sqlite files or Parquet directories, whichever is in input_dir
+    lens_df = TruthCatalogReader(truth_catalog_path(input_dir, 'lens_truth')).read(f'{object_type}_lens', index_col='index')
+    ps_df = TruthCatalogReader(truth_catalog_path(input_dir, f'lensed_{object_type}_truth')).read(f'lensed_{object_type}', index_col='index')
+    src_light_df = TruthCatalogReader(truth_catalog_path(input_dir, 'host_truth')).read(f'{object_type}_hosts', index_col='index')
     # Init columns to add
     ps_df['total_magnification'] = np.nan 
     src_light_df['total_magnification_bulge'] = np.nan 
@@ -57,7 +60,8 @@ def main():
     for band in list('ugrizy'):
         src_light_df[f'lensed_flux_{band}'] = np.nan
         src_light_df[f'lensed_flux_{band}_noMW'] = np.nan
-    dc2_sprinkler = DC2Sprinkler() # utility class for flux integration
+    phot_engine = PhotometryEngine() # utility class for flux integration
+    bands = phot_engine.bandpass_names
 
     #####################
     # Model assumptions #
@@ -140,17 +144,16 @@ def main():
         #ps_df.update(ps_info) # inplace op doesn't work when n_img is different from OM10
         # FIXME: Check that the following works to update fluxes correctly
         if object_type == 'agn': # since AGN follow a single SED template
-            agn_magnorm = ps_info['magnorm'].iloc[0] # unlensed magnorm, same across images
-            for agn_idx, agn_magnorm in list(enumerate(ps_info['magnorm'].values)):
-                dmag = -2.5*np.log10(np.abs(ps_info['magnification'].iloc[agn_idx]))
-                magnorm_dict = {band: agn_magnorm + dmag for band in ['u', 'g', 'r', 'i', 'z', 'y']}
-                agn_flux_no_mw, agn_flux_mw = dc2_sprinkler.add_flux('agnSED/agn.spec.gz',
-                                                                    z_src,
-                                                                    magnorm_dict, lens_info['av_mw'],
-                                                                    lens_info['rv_mw'])
-                for band in list('ugrizy'):
-                    ps_info.loc[agn_idx, f'flux_{band}_agn'] = agn_flux_mw[band]
-                    ps_info.loc[agn_idx, f'flux_{band}_agn_noMW'] = agn_flux_no_mw[band]
+            agn_magnorm = ps_info['magnorm'].values # unlensed magnorm, same across images
+            dmag = -2.5*np.log10(np.abs(ps_info['magnification'].values))
+            agn_flux_no_mw, agn_flux_mw = phot_engine.calc_fluxes('agnSED/agn.spec.gz',
+                                                                  np.full(n_img, z_src),
+                                                                  agn_magnorm + dmag,
+                                                                  np.full(n_img, lens_info['av_mw']),
+                                                                  np.full(n_img, lens_info['rv_mw']))
+            for band_i, band in enumerate(bands):
+                ps_info[f'flux_{band}_agn'] = agn_flux_mw[:, band_i]
+                ps_info[f'flux_{band}_agn_noMW'] = agn_flux_no_mw[:, band_i]
 
         ps_info['total_magnification'] = np.sum(np.abs(magnification))
         ps_df = ps_df.append(ps_info, ignore_index=True, sort=False)
@@ -194,18 +197,17 @@ def main():
         src_light_info['total_magnification_bulge'] = bulge_features['total_magnification']
         src_light_info['total_magnification_disk'] = disk_features['total_magnification']
 
-        disk_flux_no_mw, disk_flux_mw = dc2_sprinkler.add_flux(src_light_read_only['sed_disk_host'][2:-1],
-                                                               z_src,
-                                                               disk_features['magnorms'], lens_info['av_mw'],
-                                                               lens_info['rv_mw'])
-
-        bulge_flux_no_mw, bulge_flux_mw = dc2_sprinkler.add_flux(src_light_read_only['sed_bulge_host'][2:-1],
-                                                               z_src,
-                                                               bulge_features['magnorms'], lens_info['av_mw'],
-                                                               lens_info['rv_mw'])
-        for band in list('ugrizy'):
-            src_light_info[f'lensed_flux_{band}'] = disk_flux_mw[band] + bulge_flux_mw[band]
-            src_light_info[f'lensed_flux_{band}_noMW'] = disk_flux_no_mw[band] + bulge_flux_no_mw[band]
+        # Disk and bulge fluxes in one batch
+        host_flux_no_mw, host_flux_mw = phot_engine.calc_fluxes([sed_file_name(src_light_read_only['sed_disk_host']),
+                                                                 sed_file_name(src_light_read_only['sed_bulge_host'])],
+                                                                [z_src, z_src],
+                                                                [[disk_features['magnorms'][band] for band in bands],
+                                                                 [bulge_features['magnorms'][band] for band in bands]],
+                                                                [lens_info['av_mw'], lens_info['av_mw']],
+                                                                [lens_info['rv_mw'], lens_info['rv_mw']])
+        for band_i, band in enumerate(bands):
+            src_light_info[f'lensed_flux_{band}'] = host_flux_mw[:, band_i].sum()
+            src_light_info[f'lensed_flux_{band}_noMW'] = host_flux_no_mw[:, band_i].sum()
 
         src_light_df = src_light_df.append(src_light_info, ignore_index=True, sort=False)
         src_light_df.reset_index(drop=True, inplace=True) # to prevent duplicate indices
@@ -219,8 +221,16 @@ def main():
     src_light_df.sort_values(['dc2_sys_id_int', 'image_number'], axis=0, inplace=True)
     src_light_df.drop(['dc2_sys_id_int'], axis=1, inplace=True)
     # Export lensed_ps and host truth tables to original file format
-    io_utils.export_db(ps_df, input_dir, f'updated_lensed_{object_type}_truth.db', f'lensed_{object_type}', overwrite=True)
-    io_utils.export_db(src_light_df, input_dir, f'updated_host_truth.db', f'{object_type}_hosts', overwrite=True)
+    out_ext = '.db' if args.output_format == 'sqlite' else ''
+    lens_position = None
+    if args.output_format == 'parquet':
+        # Parquet tables are partitioned on the lens position
+        lens_pos = lens_df.set_index('dc2_sys_id').loc[ps_df['dc2_sys_id'], ['ra_lens', 'dec_lens']]
+        lens_position = (lens_pos['ra_lens'].values, lens_pos['dec_lens'].values)
+    io_utils.export_db(ps_df, input_dir, f'updated_lensed_{object_type}_truth{out_ext}', f'lensed_{object_type}', overwrite=True,
+                       output_format=args.output_format, lens_position=lens_position)
+    io_utils.export_db(src_light_df, input_dir, f'updated_host_truth{out_ext}', f'{object_type}_hosts', overwrite=True,
+                       output_format=args.output_format)
     progress.close()
 
 if __name__ == '__main__':
@@ -1,4 +1,10 @@
 from .lens_catalog_readers import *
 from .galaxy_catalog_readers import *
+from .id_random import *
+from .match_index import *
+from .photometry import *
+from .truth_io import *
+from .checkpoint import *
+from .pipeline import *
 from .base_sprinkler import *
 from .dc2_sprinkler import *
\ No newline at end of file
@@ -1,7 +1,13 @@
 import numpy as np
+from .id_random import id_normal
 
 __all__ = ['BaseSprinkler']
 
+# Philox stream of the Fundamental Plane scatter. The lens matchers use stream 0,
+# the tile assignment stream 1 and the host matchers `HOST_CHOICE_STREAM`.
+FP_SCATTER_STREAM = 2
+HOST_CHOICE_STREAM = 3
+
 
 class BaseSprinkler():
 
@@ -34,7 +40,8 @@ class BaseSprinkler():
 
         return mu_e
 
-    def calc_velocity_dispersion(self, radius, mu_e):
+    def calc_velocity_dispersion(self, radius, mu_e, galaxy_id=None, rng_mode='legacy',
+                                 dtype=np.float64):
 
         """
         Calculate velocity dispersion using Fundamental Plane relation in
@@ -55,6 +62,19 @@ class BaseSprinkler():
         mu_e: float
         Mu_e parameter calculated using `calc_mu_e` function
 
+        galaxy_id: array-like of ints, default=None
+        Galaxy IDs in the same order as `radius`. Needed in philox mode.
+
+        rng_mode: str, default='legacy'
+        In 'legacy' mode the scatter is drawn in array order from
+        `np.random.RandomState(seed=88)`. In 'philox' mode the scatter of each
+        galaxy comes from a counter-based generator keyed on its ID so it is
+        the same however the catalog is ordered, chunked or split into tiles.
+
+        dtype: numpy dtype, default=np.float64
+        Precision of the calculation and of the output. np.float32 halves the
+        memory used for large catalogs.
+
         Returns
         -------
 
@@ -62,14 +82,25 @@ class BaseSprinkler():
         Velocity Dispersion in km/s for galaxies
         """
 
+        if rng_mode not in ('legacy', 'philox'):
+            raise ValueError("rng_mode must be 'legacy' or 'philox', not %s" % rng_mode)
+
         a = 1.4335
         b = 0.3150
         c = -8.8979
 
-        rand_state = np.random.RandomState(seed=88)
-
-        log_sigma_fp = (np.log10(radius) - b*mu_e - c)/a
-        orthog_r_err = rand_state.normal(scale=0.0578, size=len(log_sigma_fp))
-        log_sigma_fp += orthog_r_err
-
-        return np.power(10, log_sigma_fp)
+        dtype = np.dtype(dtype).type
+        radius = np.asarray(radius, dtype=dtype)
+        mu_e = np.asarray(mu_e, dtype=dtype)
+
+        log_sigma_fp = (np.log10(radius) - dtype(b)*mu_e - dtype(c))/dtype(a)
+        if rng_mode == 'philox':
+            if galaxy_id is None:
+                raise ValueError('galaxy_id is needed in philox mode')
+            orthog_r_err = id_normal(galaxy_id, stream=FP_SCATTER_STREAM)
+        else:
+            rand_state = np.random.RandomState(seed=88)
+            orthog_r_err = rand_state.normal(size=len(log_sigma_fp))
+        log_sigma_fp += (dtype(0.0578)*orthog_r_err).astype(dtype, copy=False)
+
+        return np.power(dtype(10), log_sigma_fp)
@@ -0,0 +1,149 @@
+"""
+Typed on-disk checkpoints for intermediate catalogs
+"""
+
+import os
+import hashlib
+import pyarrow as pa
+import pyarrow.feather as feather
+
+__all__ = ['CHECKPOINT_SCHEMA_VERSION', 'hash_inputs', 'CatalogCheckpoint']
+
+# Increase when the layout of checkpointed catalogs changes
+CHECKPOINT_SCHEMA_VERSION = 1
+
+
+def hash_inputs(*inputs):
+
+    """
+    Hash of the inputs a checkpoint is built from.
+
+    Strings naming existing files contribute their absolute path, size and
+    modification time instead of their contents so large databases are not
+    read. Everything else contributes its repr.
+
+    Parameters
+    ----------
+
+    inputs: str, numbers, tuples, ...
+    Inputs in a fixed order
+
+    Returns
+    -------
+
+    input_hash: str
+        Hex digest of the inputs
+    """
+
+    input_hash = hashlib.sha1()
+    for item in inputs:
+        if isinstance(item, str) and os.path.isfile(item):
+            file_stat = os.stat(item)
+            item = (os.path.abspath(item), file_stat.st_size, file_stat.st_mtime_ns)
+        input_hash.update(repr(item).encode('utf-8'))
+        input_hash.update(b'\0')
+
+    return input_hash.hexdigest()
+
+
+class CatalogCheckpoint():
+
+    """
+    A dataframe checkpoint stored as an uncompressed Feather file.
+
+    Column types (including bytes and JSON string columns) survive the round
+    trip and the file is memory-mapped when loaded. The schema version and a
+    hash of the inputs are kept in the file metadata so checkpoints written by
+    other code or from other inputs are treated as stale.
+
+    Parameters
+    ----------
+
+    checkpoint_dir: str
+    Directory holding the checkpoint files
+
+    name: str
+    Checkpoint name. The file is `checkpoint_dir/name.feather`.
+
+    input_hash: str
+    Hash of the inputs, usually from `hash_inputs`
+    """
+
+    def __init__(self, checkpoint_dir, name, input_hash):
+
+        self.filename = os.path.join(checkpoint_dir, '%s.feather' % name)
+        self.input_hash = input_hash
+
+    def metadata(self):
+
+        """
+        The schema version and input hash stored in the checkpoint file, or
+        None if there is no readable checkpoint.
+        """
+
+        if not os.path.exists(self.filename):
+            return None
+
+        try:
+            with pa.memory_map(self.filename) as source:
+                file_metadata = pa.ipc.open_file(source).schema.metadata or {}
+        except pa.ArrowInvalid:
+            return None
+
+        if b'checkpoint_schema_version' not in file_metadata:
+            return None
+
+        return {'schema_version': int(file_metadata[b'checkpoint_schema_version']),
+                'input_hash': file_metadata.get(b'input_hash', b'').decode('utf-8')}
+
+    def is_valid(self):
+
+        """
+        True if the checkpoint exists and matches the schema version and inputs.
+        """
+
+        checkpoint_metadata = self.metadata()
+        if checkpoint_metadata is None:
+            return False
+
+        return ((checkpoint_metadata['schema_version'] == CHECKPOINT_SCHEMA_VERSION) &
+                (checkpoint_metadata['input_hash'] == self.input_hash))
+
+    def load(self):
+
+        """
+        Load the checkpointed dataframe.
+
+        Returns
+        -------
+
+        catalog_df: pandas dataframe
+        """
+
+        if not self.is_valid():
+            raise ValueError('Checkpoint %s is missing or stale' % self.filename)
+
+        return feather.read_table(self.filename, memory_map=True).to_pandas()
+
+    def save(self, catalog_df):
+
+        """
+        Write `catalog_df` to the checkpoint file. The dataframe index is not kept.
+
+        Parameters
+        ----------
+
+        catalog_df: pandas dataframe
+        Catalog to checkpoint
+        """
+
+        catalog_table = pa.Table.from_pandas(catalog_df, preserve_index=False)
+        file_metadata = dict(catalog_table.schema.metadata or {})
+        file_metadata[b'checkpoint_schema_version'] = str(CHECKPOINT_SCHEMA_VERSION).encode()
+        file_metadata[b'input_hash'] = self.input_hash.encode('utf-8')
+        catalog_table = catalog_table.replace_schema_metadata(file_metadata)
+
+        # Write then rename so an interrupted run never leaves a partial checkpoint
+        tmp_filename = self.filename + '.tmp'
+        feather.write_feather(catalog_table, tmp_filename, compression='uncompressed')
+        os.replace(tmp_filename, self.filename)
@@ -4,18 +4,23 @@ import pandas as pd
 import numpy as np
 import sncosmo
 from astropy.cosmology import FlatLambdaCDM
-from sqlalchemy import create_engine
-from .base_sprinkler import BaseSprinkler
+from .base_sprinkler import BaseSprinkler, HOST_CHOICE_STREAM
+from .match_index import LensCandidateIndex, HostRedshiftIndex, ClaimedMask, bipartite_assignment
+from .id_random import SystemRandomStream
+from .lens_catalog_readers import image_slot_columns
+from .photometry import sed_file_name, get_sed_cache, get_bandpass_registry, PhotometryEngine
+from .truth_io import get_truth_writer
 from lsst.sims.photUtils import Sed, BandpassDict, getImsimFluxNorm, Bandpass
 from lsst.utils import getPackageDir
-from copy import deepcopy
 
 __all__ = ['DC2Sprinkler']
 
 
 class DC2Sprinkler(BaseSprinkler):
 
-    def match_to_lenscat_agn(self, vel_disp, redshift, om10_array, density=1.0):
+    def match_to_lenscat_agn(self, vel_disp, redshift, om10_array, density=1.0,
+                             rng_mode='legacy', assignment='greedy', assignment_seed=0,
+                             max_candidates=64):
 
         """
         Match DC2 galaxies to lens galaxies in OM10 based upon velocity dispersion and redshift.
@@ -30,8 +35,27 @@ class DC2Sprinkler(BaseSprinkler):
         redshift: numpy.ndarray
         Redshifts of potential lens galaxies from cosmoDC2
 
-        om10_array: FITS recarray
-        OM10 Lens Catalog
+        om10_array: dict or OM10Catalog
+        OM10 Lens Catalog columns keyed as in `OM10Reader.config`
+
+        rng_mode: str, default='legacy'
+        'legacy' draws from `np.random.RandomState(LENSID)` for each system as the
+        sprinkler always has. 'philox' uses a counter-based generator keyed on
+        LENSID so all match probabilities are drawn in one array operation.
+
+        assignment: str, default='greedy'
+        'greedy' goes through the systems in catalog order and gives each a random
+        unclaimed candidate. 'global' matches all systems at once with a bipartite
+        matching over the system and candidate pairs within tolerance so systems
+        in crowded parts of parameter space are not starved by earlier ones. See
+        `assign_global` for when the matching is maximum.
+
+        assignment_seed: int, default=0
+        Seed of the candidate pruning and of the tie-break between equally
+        large matchings in 'global' mode
+
+        max_candidates: int or None, default=64
+        Candidates kept per system in 'global' mode. None keeps them all.
 
         Returns
         -------
@@ -46,59 +70,68 @@ class DC2Sprinkler(BaseSprinkler):
             OM10 LENSID values for systems matched is corresponding order as other outputs
         """
 
+        self._check_assignment(assignment)
+
         lens_gal_idx = []
         om10_idx = []
 
-        i = 0
-        successful_matches = 0
+        # Bin the candidate lenses once so each OM10 system only
+        # looks at galaxies close to it in (log sigma, log z)
+        candidate_index = LensCandidateIndex(vel_disp, redshift, tolerance=0.03)
+        claimed = ClaimedMask(len(candidate_index))
 
-        for row in om10_array:
+        lens_z_arr = om10_array['z_lens']
+        lens_sigma_arr = om10_array['vel_disp_lens']
 
-            rand_state = np.random.RandomState(row['LENSID'])
+        system_rng = SystemRandomStream(om10_array['system_id'], rng_mode=rng_mode)
+        match_prob = system_rng.uniform()
 
-            if i % 500 == 0:
-                print("Matched %i out of %i possible OM10 systems so far. Total Catalog Length: %i" %
-                    (successful_matches, i, len(om10_array)))
-            i += 1
+        # adjust matching probability for low z lenses
+        # to get closer match to overall om10 in redshift and vel. disp.
+        match_prob[lens_z_arr < 0.3] *= 0.2
+        match_prob[lens_sigma_arr >= 225.] *= 0.5
 
-            lens_z = row['ZLENS']
-            log_lens_z = np.log10(lens_z)
+        try_idx = np.where(~(match_prob > density))[0]
 
-            lens_sigma = row['VELDISP']
-            log_lens_sigma = np.log10(lens_sigma)
+        if assignment == 'global':
+            om10_idx, lens_gal_idx = self.assign_global(candidate_index, lens_sigma_arr,
+                                                        lens_z_arr, try_idx, seed=assignment_seed,
+                                                        max_candidates=max_candidates)
+            return om10_idx, lens_gal_idx, om10_array['system_id'][om10_idx]
 
-            match_prob = rand_state.uniform()
+        successful_matches = 0
 
-            # adjust matching probability for low z lenses
-            # to get closer match to overall om10 in redshift and vel. disp.
-            if lens_z < 0.3:
-                match_prob *= 0.2
-            if lens_sigma >= 225.:
-                match_prob *= 0.5
+        for num_tried, i in enumerate(try_idx):
 
-            if match_prob > density:
-                continue
+            if num_tried % 500 == 0:
+                print("Matched %i out of %i possible OM10 systems so far. Total Catalog Length: %i" %
+                    (successful_matches, i, len(lens_z_arr)))
+
+            log_lens_z = np.log10(lens_z_arr[i])
+            log_lens_sigma = np.log10(lens_sigma_arr[i])
 
-            match_idx = (np.where((np.abs(log_lens_sigma - np.log10(vel_disp)) < 0.03) &
-                                (np.abs(log_lens_z - np.log10(redshift)) < 0.03)))[0]
+            match_idx = candidate_index.query(log_lens_sigma, log_lens_z)
             # Avoid duplicates
-            match_idx_keep = [w for w in match_idx if w not in lens_gal_idx]
+            match_idx_keep = claimed.unclaimed(match_idx)
             if len(match_idx_keep) == 0:
                 continue
             # Randomly choose one of the matches
-            matched_lens_idx = rand_state.choice(match_idx_keep)
+            matched_lens_idx = system_rng.choice(i, match_idx_keep)
 
+            claimed.claim(matched_lens_idx)
             lens_gal_idx.append(matched_lens_idx)
-            om10_idx.append(i-1)
+            om10_idx.append(i)
             successful_matches += 1
 
-        om10_lens_ids = om10_array['LENSID'][om10_idx]
+        om10_lens_ids = om10_array['system_id'][om10_idx]
 
         return om10_idx, lens_gal_idx, om10_lens_ids
 
     def match_to_lenscat_sne(self, vel_disp, redshift, glsne_cat_zl,
                              glsne_cat_sigma, glsne_cat_sysno,
-                             glsne_weights, density=1.0):
+                             glsne_weights, density=1.0, rng_mode='legacy',
+                             assignment='greedy', assignment_seed=0, weight_norm=None,
+                             max_candidates=64):
 
         """
         Match DC2 galaxies to lens galaxies in OM10 based upon velocity dispersion and redshift.
@@ -116,6 +149,31 @@ class DC2Sprinkler(BaseSprinkler):
         glsne_cat: pandas dataframe
         Catalog of Strongly Lensed SNe systems from Goldstein et al. 2019
 
+        rng_mode: str, default='legacy'
+        'legacy' draws from `np.random.RandomState(sysno)` for each system as the
+        sprinkler always has. 'philox' uses a counter-based generator keyed on
+        sysno so all match probabilities are drawn in one array operation.
+
+        assignment: str, default='greedy'
+        'greedy' goes through the systems in catalog order and gives each a random
+        unclaimed candidate. 'global' matches all systems at once with a bipartite
+        matching over the system and candidate pairs within tolerance so systems
+        in crowded parts of parameter space are not starved by earlier ones. See
+        `assign_global` for when the matching is maximum.
+
+        assignment_seed: int, default=0
+        Seed of the candidate pruning and of the tie-break between equally
+        large matchings in 'global' mode
+
+        max_candidates: int or None, default=64
+        Candidates kept per system in 'global' mode. None keeps them all.
+
+        weight_norm: float, default=None
+        Value the system weights are divided by. Defaults to the largest of
+        `glsne_weights`. Pass the maximum over the whole catalog when matching
+        only part of it so the match probability of a system does not depend
+        on which other systems are passed in.
+
         Returns
         -------
 
@@ -132,26 +190,18 @@ class DC2Sprinkler(BaseSprinkler):
         lens_gal_idx = []
         glsne_idx = []
 
-        normed_weights = glsne_weights/np.max(glsne_weights)
-
-        i = 0
-        successful_matches = 0
+        glsne_cat_zl = np.asarray(glsne_cat_zl)
+        glsne_cat_sigma = np.asarray(glsne_cat_sigma)
 
-        for lens_z, lens_sigma, lens_sysno, sys_weight in zip(glsne_cat_zl, glsne_cat_sigma, glsne_cat_sysno, normed_weights):
+        self._check_assignment(assignment)
 
-            rand_state = np.random.RandomState(lens_sysno)
+        candidate_index = LensCandidateIndex(vel_disp, redshift, tolerance=0.03)
+        claimed = ClaimedMask(len(candidate_index))
 
-            if i % 5000 == 0:
-                print("Matched %i out of %i possible GLSNe systems so far. Total Catalog Length: %i" %
-                    (successful_matches, i, len(glsne_cat_zl)))
-            i += 1
-
-            log_lens_z = np.log10(lens_z)
-
-            log_lens_sigma = np.log10(lens_sigma)
-
-            match_prob = rand_state.uniform()
-            match_density = density * sys_weight * 10
+        system_rng = SystemRandomStream(glsne_cat_sysno, rng_mode=rng_mode)
+        match_prob = system_rng.uniform()
+        match_density = self.sne_match_density(glsne_weights, density=density,
+                                                weight_norm=weight_norm)
     #         if lens_sigma > 190.:
     #             match_prob = match_density - 0.01
     #         if lens_z < 0.4:
@@ -159,49 +209,268 @@ class DC2Sprinkler(BaseSprinkler):
     #         if lens_sigma < 130.:
     #             match_prob *= 2.
 
-            if (match_prob > match_density):
-                continue
+        try_idx = np.where(~(match_prob > match_density))[0]
+
+        if assignment == 'global':
+            glsne_idx, lens_gal_idx = self.assign_global(candidate_index, glsne_cat_sigma,
+                                                         glsne_cat_zl, try_idx, seed=assignment_seed,
+                                                         max_candidates=max_candidates)
+            return glsne_idx, lens_gal_idx, glsne_cat_sysno[glsne_idx]
+
+        successful_matches = 0
 
-            match_idx = (np.where((np.abs(log_lens_sigma - np.log10(vel_disp)) < 0.03) &
-                                (np.abs(log_lens_z - np.log10(redshift)) < 0.03)))[0]
+        for num_tried, i in enumerate(try_idx):
+
+            if num_tried % 5000 == 0:
+                print("Matched %i out of %i possible GLSNe systems so far. Total Catalog Length: %i" %
+                    (successful_matches, i, len(glsne_cat_zl)))
+
+            log_lens_z = np.log10(glsne_cat_zl[i])
+
+            log_lens_sigma = np.log10(glsne_cat_sigma[i])
+
+            match_idx = candidate_index.query(log_lens_sigma, log_lens_z)
             # Avoid duplicates
-            match_idx_keep = [w for w in match_idx if w not in lens_gal_idx]
+            match_idx_keep = claimed.unclaimed(match_idx)
             if len(match_idx_keep) == 0:
                 continue
             # Randomly choose one of the matches
-            matched_lens_idx = rand_state.choice(match_idx_keep)
+            matched_lens_idx = system_rng.choice(i, match_idx_keep)
 
+            claimed.claim(matched_lens_idx)
             lens_gal_idx.append(matched_lens_idx)
-            glsne_idx.append(i-1)
+            glsne_idx.append(i)
             successful_matches += 1
 
         glsne_lens_ids = glsne_cat_sysno[glsne_idx]
 
         return glsne_idx, lens_gal_idx, glsne_lens_ids
 
-    def add_sncosmo_params(self, glsne_merged_df):
+    def sne_match_density(self, glsne_weights, density=1.0, weight_norm=None):
+
+        """
+        Threshold below which the uniform draw of a GLSNe system must fall for
+        the system to be tried in `match_to_lenscat_sne`.
+
+        Parameters
+        ----------
+
+        glsne_weights: numpy.ndarray
+        Weights of the GLSNe systems
+
+        density: float, default=1.0
+        Density scale for matching GLSNe systems
+
+        weight_norm: float, default=None
+        Value the weights are divided by. Defaults to the largest of `glsne_weights`.
+
+        Returns
+        -------
+
+        match_density: numpy.ndarray
+            Match threshold of each system
+        """
+
+        glsne_weights = np.asarray(glsne_weights)
+        if weight_norm is None:
+            weight_norm = np.max(glsne_weights, initial=0.)
+
+        return density * (glsne_weights/weight_norm) * 10
+
+    def _check_assignment(self, assignment):
+
+        if assignment not in ('greedy', 'global'):
+            raise ValueError("assignment must be 'greedy' or 'global', not %s" % assignment)
+
+    def assign_global(self, candidate_index, lens_sigma, lens_z, try_idx, seed=0,
+                      max_candidates=64, chunk_size=5000):
+
+        """
+        Match lens catalog systems to candidate galaxies with a bipartite
+        matching over the pairs within tolerance.
+
+        With `max_candidates=None` every pair is kept and the matching has the
+        largest possible number of systems. Otherwise systems with more than
+        `max_candidates` candidates keep a random subset of about that many so
+        the graph stays small in crowded parts of parameter space. The result
+        is then a maximum matching of the pruned graph only, which is an
+        approximation: a system can miss out when all of its kept candidates
+        are needed elsewhere even though a dropped one was free.
+
+        Parameters
+        ----------
+
+        candidate_index: LensCandidateIndex
+        Index over the candidate lens galaxies
+
+        lens_sigma: numpy.ndarray
+        Velocity dispersions (km/s) of all lens catalog systems
+
+        lens_z: numpy.ndarray
+        Lens redshifts of all lens catalog systems
+
+        try_idx: numpy.ndarray
+        Systems to try to match
+
+        seed: int, default=0
+        Seed of the candidate subsets and of the tie-break between equally
+        large matchings
+
+        max_candidates: int or None, default=64
+        Expected number of candidates kept for each system. None keeps every
+        candidate for an exact maximum matching.
+
+        chunk_size: int, default=5000
+        Number of systems whose candidate pairs are found at a time
+
+        Returns
+        -------
+
+        sys_idx: List of ints
+            Indices of the matched systems in ascending order
+
+        lens_gal_idx: List of ints
+            Indices of the galaxies matched to each system
+        """
+
+        try_idx = np.asarray(try_idx, dtype=np.int64)
+        log_sigma = np.log10(np.asarray(lens_sigma)[try_idx])
+        log_z = np.log10(np.asarray(lens_z)[try_idx])
+
+        rand_state = np.random.RandomState(seed)
+        pair_sys = []
+        pair_gal = []
+        for start in range(0, len(try_idx), chunk_size):
+            query_idx, match_idx = candidate_index.query_pairs(log_sigma[start:start+chunk_size],
+                                                               log_z[start:start+chunk_size])
+            if max_candidates is not None:
+                n_pairs = np.bincount(query_idx, minlength=min(chunk_size, len(try_idx) - start))
+                keep_prob = np.minimum(1., max_candidates / np.maximum(n_pairs, 1))[query_idx]
+                keep = rand_state.uniform(size=len(query_idx)) < keep_prob
+                query_idx = query_idx[keep]
+                match_idx = match_idx[keep]
+            pair_sys.append(query_idx + start)
+            pair_gal.append(match_idx)
+
+        if len(pair_sys) > 0:
+            pair_sys = np.concatenate(pair_sys)
+            pair_gal = np.concatenate(pair_gal)
+
+        matched_sys, matched_gal = bipartite_assignment(pair_sys, pair_gal, len(try_idx),
+                                                        len(candidate_index),
+                                                        seed=rand_state.randint(2**31))
+        print("Matched %i out of %i possible systems with a global assignment" %
+              (len(matched_sys), len(try_idx)))
+
+        return list(try_idx[matched_sys]), list(matched_gal)
+
+    def add_sncosmo_params(self, glsne_merged_df, batched=True, source='salt2-extended'):
+
+        """
+        Add the SALT2 parameters of each lensed SN to the catalog.
+
+        x0 is set so the rest-frame peak Bessell B magnitude is `MB` at the
+        redshift `zs` in the cosmoDC2 cosmology. As before, the normalization
+        is found with the source at its default x1=0 and c=0 and the catalog
+        then gets x1=1 and c=0.
+
+        Parameters
+        ----------
+
+        glsne_merged_df: pandas dataframe
+            Lensed SNe systems with `zs` and `MB` columns
+
+        batched: bool, default=True
+            Compute x0 for all systems at once from a single rest-frame peak
+            magnitude and one vectorized distance modulus call. If False every
+            system goes through `sncosmo.Model.set_source_peakabsmag`. Both
+            agree to floating point precision.
 
-        source = sncosmo.get_source('salt2-extended')
-        model = sncosmo.Model(source=source)
+        source: str or sncosmo.Source, default='salt2-extended'
+            The sncosmo source model
+
+        Returns
+        -------
+
+        glsne_merged_df: pandas dataframe
+            The input dataframe with `x0`, `x1` and `c` columns added
+        """
 
         # Use cosmoDC2 settings
         cosmo = FlatLambdaCDM(H0=71, Om0=0.265, Tcmb0=0, Neff=3.04, m_nu=None, Ob0=0.045)
 
-        x0 = []
-        for sn_row_zs, sn_row_mb in zip(glsne_merged_df['zs'].values, glsne_merged_df['MB'].values):
-            z = sn_row_zs
-            MB = sn_row_mb
-            model.set(z=z)
-            model.set_source_peakabsmag(MB, 'bessellb', 'ab', cosmo=cosmo)
-            x0.append(model.get('x0'))
+        if batched is True:
+            glsne_merged_df['x0'] = self.calc_peakabsmag_x0(glsne_merged_df['zs'].values,
+                                                            glsne_merged_df['MB'].values,
+                                                            cosmo, source=source)
+        else:
+            model = sncosmo.Model(source=source)
+            x0 = []
+            for sn_row_zs, sn_row_mb in zip(glsne_merged_df['zs'].values, glsne_merged_df['MB'].values):
+                z = sn_row_zs
+                MB = sn_row_mb
+                model.set(z=z)
+                model.set_source_peakabsmag(MB, 'bessellb', 'ab', cosmo=cosmo)
+                x0.append(model.get(model.source.param_names[0]))
+            glsne_merged_df['x0'] = x0
 
-        glsne_merged_df['x0'] = x0
         glsne_merged_df['x1'] = 1.
         glsne_merged_df['c'] = 0.
 
         return glsne_merged_df
 
-    def match_hosts_om10(self, redshift, agn_i_mag, om10_systems):
+    def calc_peakabsmag_x0(self, redshift, abs_mag, cosmo, source='salt2-extended',
+                           band='bessellb', magsys='ab'):
+
+        """
+        Source amplitude giving each absolute peak magnitude at each redshift.
+
+        The rest-frame peak magnitude of the source scales as -2.5 log10 of its
+        amplitude, so it is calculated once at unit amplitude and the amplitude
+        for every system follows in closed form.
+
+        Parameters
+        ----------
+
+        redshift: numpy ndarray
+            Source redshifts. Must be positive.
+
+        abs_mag: numpy ndarray
+            Absolute peak magnitudes in `band`
+
+        cosmo: astropy cosmology
+            Cosmology for the distance moduli
+
+        source: str or sncosmo.Source, default='salt2-extended'
+            The sncosmo source model. Its parameters other than the amplitude
+            are used as they are.
+
+        band: str, default='bessellb'
+            Rest-frame bandpass of `abs_mag`
+
+        magsys: str, default='ab'
+            Magnitude system of `abs_mag`
+
+        Returns
+        -------
+
+        x0: numpy ndarray
+            Amplitude (x0 for SALT2) of each source
+        """
+
+        redshift = np.asarray(redshift, dtype=np.float64)
+        if np.any(redshift <= 0.):
+            raise ValueError('absolute magnitude undefined when z<=0.')
+
+        unit_source = sncosmo.get_source(source, copy=True)
+        unit_source.set(**{unit_source.param_names[0]: 1.})
+        unit_peakmag = unit_source.peakmag(band, magsys)
+
+        peak_mag = np.asarray(abs_mag, dtype=np.float64) + cosmo.distmod(redshift).value
+
+        return 10.**(0.4 * (unit_peakmag - peak_mag))
+
+    def match_hosts_om10(self, redshift, agn_i_mag, om10_systems, rng_mode='legacy'):
 
         """
         Match host galaxies to OM10 systems based upon redshift and i-band AGN magnitude.
@@ -215,8 +484,13 @@ class DC2Sprinkler(BaseSprinkler):
         agn_i_mag: numpy ndarray
             Array of DC2 potential AGN i-band magnitudes in same order as redshift
 
-        om10_systems: om10 fits data table
-            The subselection of OM10 that matched to a lens galaxy already
+        om10_systems: dict or OM10Catalog
+            The subselection of OM10 that matched to a lens galaxy already with
+            columns keyed as in `OM10Reader.config`
+
+        rng_mode: str, default='legacy'
+            Random number generator used to pick between candidate hosts.
+            See `match_to_lenscat_agn`.
 
         Returns
         -------
@@ -229,34 +503,39 @@ class DC2Sprinkler(BaseSprinkler):
             the same order as `om10_idx`
 
         om10_system_ids: list
-            `LENSID` values of the om10 systems that matched to a DC2 host galaxy
+            `system_id` values of the om10 systems that matched to a DC2 host galaxy
         """
 
         i = 0
         om10_idx = []
         host_gal_idx = []
-
-        for om10_row in om10_systems:
-            rand_state = np.random.RandomState(om10_row['LENSID'])
-            log_z_om10 = np.log10(om10_row['ZSRC'])
-            imag_om10 = om10_row['MAGI_IN']
-
-            matches = np.where((np.abs(np.log10(redshift) - log_z_om10) < 0.05) &
-                            (np.abs(agn_i_mag - imag_om10) < 0.05))[0]
-            keep_matches = [w for w in matches if w not in host_gal_idx]
+        # Sort the hosts by redshift once so each system only looks at its redshift window
+        host_index = HostRedshiftIndex(redshift, agn_i_mag, z_tolerance=0.05, match_tolerance=0.05)
+        claimed = ClaimedMask(len(host_index))
+        # The lens matchers used stream 0 for the draws that passed the density
+        # cut, so the host pick must not reuse them
+        system_rng = SystemRandomStream(om10_systems['system_id'], rng_mode=rng_mode,
+                                        stream=HOST_CHOICE_STREAM)
+
+        for z_om10, imag_om10 in zip(om10_systems['z_src'], om10_systems['mag_i_src']):
+            log_z_om10 = np.log10(z_om10)
+
+            matches = host_index.query(log_z_om10, imag_om10)
+            keep_matches = claimed.unclaimed(matches)
             if len(keep_matches) > 0:
-                gal_match = rand_state.choice(keep_matches)
+                gal_match = system_rng.choice(i, keep_matches)
+                claimed.claim(gal_match)
                 om10_idx.append(i)
                 host_gal_idx.append(gal_match)
 
             i += 1
 
-        om10_system_ids = om10_systems['LENSID'][om10_idx]
+        om10_system_ids = om10_systems['system_id'][om10_idx]
 
         return om10_idx, host_gal_idx, om10_system_ids
 
     def match_hosts_glsne(self, redshift, host_size, glsne_redshifts,
-                          glsne_host_size, glsne_sysno):
+                          glsne_host_size, glsne_sysno, rng_mode='legacy'):
 
         """
         Match host galaxies to GLSNE systems based upon redshift
@@ -273,6 +552,10 @@ class DC2Sprinkler(BaseSprinkler):
         glsne_sysno: numpy ndarray
             The system numbers of the subselection of GLSNe that matched to a lens galaxy already
 
+        rng_mode: str, default='legacy'
+            Random number generator used to pick between candidate hosts.
+            See `match_to_lenscat_sne`.
+
         Returns
         -------
 
@@ -290,50 +573,63 @@ class DC2Sprinkler(BaseSprinkler):
         i = 0
         glsne_idx = []
         host_gal_idx = []
-
-        for glsne_z, glsne_size, row_sysno in zip(glsne_redshifts, glsne_host_size, glsne_sysno):
-            rand_state = np.random.RandomState(row_sysno)
+        host_index = HostRedshiftIndex(redshift, np.log10(np.asarray(host_size)),
+                                       z_tolerance=0.05, match_tolerance=0.05)
+        claimed = ClaimedMask(len(host_index))
+        # The lens matchers used stream 0 for the draws that passed the density
+        # cut, so the host pick must not reuse them
+        system_rng = SystemRandomStream(glsne_sysno, rng_mode=rng_mode,
+                                        stream=HOST_CHOICE_STREAM)
+
+        for glsne_z, glsne_size in zip(glsne_redshifts, glsne_host_size):
             log_z_glsne = np.log10(glsne_z)
             log_size_glsne = np.log10(glsne_size)
 
             if i % 50 == 0:
                 print(i)
 
-            matches = np.where((np.abs(np.log10(redshift) - log_z_glsne) < 0.05) &
-                            (np.abs(np.log10(host_size) - log_size_glsne) < 0.05))[0]
-            keep_matches = [w for w in matches if w not in host_gal_idx]
+            matches = host_index.query(log_z_glsne, log_size_glsne)
+            keep_matches = claimed.unclaimed(matches)
             if len(keep_matches) > 0:
-                gal_match = rand_state.choice(keep_matches)
+                gal_match = system_rng.choice(i, keep_matches)
+                claimed.claim(gal_match)
                 glsne_idx.append(i)
                 host_gal_idx.append(gal_match)
 
             i += 1
 
-            glsne_system_ids = glsne_sysno[glsne_idx]
+        glsne_system_ids = glsne_sysno[glsne_idx]
 
         return glsne_idx, host_gal_idx, glsne_system_ids
 
-    def add_flux(self, sed_name, redshift, magnorm_dict, av, rv, bp_dict=None):
+    def add_flux(self, sed_name, redshift, magnorm_dict, av, rv, bp_dict=None,
+                 sed_cache=None, flux_lookup=None):
+
+        if flux_lookup is not None:
+            # Interpolate from precomputed flux grids instead of integrating the SED
+            magnorms = [magnorm_dict[bp_name] for bp_name in flux_lookup.bandpass_names]
+            flux_no_mw, flux_mw = flux_lookup.calc_fluxes(sed_name, [redshift], [magnorms], [av], [rv])
+            return (dict(zip(flux_lookup.bandpass_names, flux_no_mw[0])),
+                    dict(zip(flux_lookup.bandpass_names, flux_mw[0])))
 
         if bp_dict is None:
-            bp_dict = BandpassDict.loadTotalBandpassesFromFiles()
+            bp_dict = get_bandpass_registry().lsst_bandpasses
+        if sed_cache is None:
+            sed_cache = get_sed_cache()
 
         result_dict_no_mw = {}
         result_dict_mw = {}
 
-        sed_obj = Sed()
-        sed_obj.readSED_flambda(os.path.join(os.environ['SIMS_SED_LIBRARY_DIR'], sed_name))
-        a_x, b_x = sed_obj.setupCCM_ab()
+        sed_obj, a_x, b_x = sed_cache.get_sed(sed_name)
+        sed_z = sed_cache.get_redshifted_sed(sed_name, redshift)
+        # Dust does not depend on the band so only apply it once
+        sed_dust = Sed(wavelen=sed_z.wavelen, flambda=sed_z.flambda)
+        sed_dust.addDust(a_x, b_x, A_v=av, R_v=rv)
         for bandpass_name in bp_dict.keys():
-            sed_copy = deepcopy(sed_obj)
-            flux_norm = getImsimFluxNorm(sed_copy, magnorm_dict[bandpass_name])
-            sed_copy.multiplyFluxNorm(flux_norm)
-            sed_copy.redshiftSED(redshift, dimming=True)
-            band_flux = sed_copy.calcFlux(bp_dict[bandpass_name])
-            result_dict_no_mw[bandpass_name] = band_flux
-            sed_copy.addDust(a_x, b_x, A_v=av, R_v=rv)
-            band_flux_mw = sed_copy.calcFlux(bp_dict[bandpass_name])
-            result_dict_mw[bandpass_name] = band_flux_mw
+            # Band fluxes scale linearly with the flux normalization
+            flux_norm = getImsimFluxNorm(sed_obj, magnorm_dict[bandpass_name])
+            result_dict_no_mw[bandpass_name] = flux_norm * sed_z.calcFlux(bp_dict[bandpass_name])
+            result_dict_mw[bandpass_name] = flux_norm * sed_dust.calcFlux(bp_dict[bandpass_name])
 
         return result_dict_no_mw, result_dict_mw
 
@@ -360,80 +656,59 @@ class DC2Sprinkler(BaseSprinkler):
             Return the pandas dataframe format of the truth catalog.
         """
 
-        new_entries = []
-
-        for i in range(len(matched_sys_cat)):
-
-            gal_id = matched_lenses.iloc[i]['galaxy_id']
-            new_sys_id_num = i
-            new_sys_id = '%s_%i' % (id_type_prefix, new_sys_id_num)
-            # The newly inserted lens galaxy keeps the old gal_id
-            unique_id = gal_id
-
-            ra_lens = matched_lenses.iloc[i]['ra']
-            dec_lens = matched_lenses.iloc[i]['dec']
-
-            redshift = matched_sys_cat.iloc[i]['z_lens']
-            shear_1_dc2 = matched_lenses.iloc[i]['gamma_1']
-            shear_2_dc2 = matched_lenses.iloc[i]['gamma_2']
-            kappa_dc2 = matched_lenses.iloc[i]['kappa']
-            gamma_lenscat = matched_sys_cat.iloc[i]['gamma']
-            phi_gamma_lenscat = matched_sys_cat.iloc[i]['phi_gamma']
-            shear_1_lenscat = gamma_lenscat * np.cos(2 * phi_gamma_lenscat)
-            shear_2_lenscat = gamma_lenscat * np.sin(2 * phi_gamma_lenscat)
-            sindex_lens = 4
-
-    #         major_axis_lens = matched_sys_cat.iloc[i]['reff_lens'] / \
-    #                             np.sqrt(1 - matched_sys_cat.iloc[i]['ellip_lens'])
-    #         minor_axis_lens = matched_sys_cat.iloc[i]['reff_lens'] * \
-    #                             np.sqrt(1 - matched_sys_cat.iloc[i]['ellip_lens'])
-    #         position_angle = matched_sys_cat.iloc[i]['phie_lens']*(-1.0)*np.pi/180.0
-            major_axis_lens = matched_lenses.iloc[i]['size']
-            minor_axis_lens = matched_lenses.iloc[i]['size_minor']
-            position_angle = matched_lenses.iloc[i]['position_angle']
-
-            # Change dc2 ellip [(1-q)/(1+q)] to om10 ellipticity which is (1-q)
-            q = minor_axis_lens/major_axis_lens
-            ellip_dc2 = 1.0 - q
-            ellip_lens = matched_sys_cat.iloc[i]['ellip_lens']
-            # Convert DC2 position angle to `phie` which starts from y-axis
-            phie_dc2 = 0.5*position_angle - 90
-            phie_lens = matched_sys_cat.iloc[i]['phie_lens']
-
-            av_mw = matched_lenses.iloc[i]['av_mw']
-            rv_mw = matched_lenses.iloc[i]['rv_mw']
-
-            vel_disp_lens = matched_lenses.iloc[i]['fp_vel_disp']
-
-            cat_sys_id = matched_sys_cat.iloc[i]['system_id']
-
-            new_row = [unique_id, ra_lens, dec_lens,
-                    redshift, shear_1_dc2, shear_2_dc2, kappa_dc2,
-                    gamma_lenscat, phi_gamma_lenscat,
-                    shear_1_lenscat, shear_2_lenscat, sindex_lens,
-                    major_axis_lens, minor_axis_lens,
-                    position_angle, ellip_dc2, ellip_lens, phie_dc2, phie_lens,
-                    av_mw, rv_mw, vel_disp_lens,
-                    cat_sys_id, new_sys_id]
-
-            new_entries.append(new_row)
-
-        lens_df = pd.DataFrame(new_entries,
-                            columns=['unique_id', 'ra_lens', 'dec_lens',
-                                        'redshift', 'shear_1_cosmodc2', 'shear_2_cosmodc2',
-                                        'kappa_cosmodc2', 'gamma_lenscat', 'phig_lenscat',
-                                        'shear_1_lenscat', 'shear_2_lenscat',
-                                        'sindex_lens', 'major_axis_lens',
-                                        'minor_axis_lens', 'position_angle', 'ellip_cosmodc2',
-                                        'ellip_lens', 'phie_cosmodc2', 'phie_lens', 'av_mw', 'rv_mw',
-                                        'vel_disp_lenscat',
-                                        'lens_cat_sys_id', 'dc2_sys_id'])
+        n_sys = len(matched_sys_cat)
+        # Work on whole columns. Use positional arrays since the matched
+        # lenses and systems do not share an index.
+        lens_cols = {col: matched_lenses[col].values[:n_sys] for col in
+                     ['galaxy_id', 'ra', 'dec', 'gamma_1', 'gamma_2', 'kappa',
+                      'size', 'size_minor', 'position_angle', 'av_mw', 'rv_mw',
+                      'fp_vel_disp']}
+
+        gamma_lenscat = np.asarray(matched_sys_cat['gamma'].values, dtype=np.float64)
+        phi_gamma_lenscat = np.asarray(matched_sys_cat['phi_gamma'].values, dtype=np.float64)
+        shear_1_lenscat = gamma_lenscat * np.cos(2 * phi_gamma_lenscat)
+        shear_2_lenscat = gamma_lenscat * np.sin(2 * phi_gamma_lenscat)
+
+        # Change dc2 ellip [(1-q)/(1+q)] to om10 ellipticity which is (1-q)
+        q = lens_cols['size_minor']/lens_cols['size']
+        ellip_dc2 = 1.0 - q
+        # Convert DC2 position angle to `phie` which starts from y-axis
+        phie_dc2 = 0.5*lens_cols['position_angle'] - 90
+
+        # The newly inserted lens galaxy keeps the old gal_id
+        new_sys_id = ['%s_%i' % (id_type_prefix, new_sys_id_num) for new_sys_id_num in range(n_sys)]
+
+        lens_df = pd.DataFrame({'unique_id': lens_cols['galaxy_id'],
+                                'ra_lens': lens_cols['ra'],
+                                'dec_lens': lens_cols['dec'],
+                                'redshift': matched_sys_cat['z_lens'].values,
+                                'shear_1_cosmodc2': lens_cols['gamma_1'],
+                                'shear_2_cosmodc2': lens_cols['gamma_2'],
+                                'kappa_cosmodc2': lens_cols['kappa'],
+                                'gamma_lenscat': gamma_lenscat,
+                                'phig_lenscat': phi_gamma_lenscat,
+                                'shear_1_lenscat': shear_1_lenscat,
+                                'shear_2_lenscat': shear_2_lenscat,
+                                'sindex_lens': np.full(n_sys, 4, dtype=np.int64),
+                                'major_axis_lens': lens_cols['size'],
+                                'minor_axis_lens': lens_cols['size_minor'],
+                                'position_angle': lens_cols['position_angle'],
+                                'ellip_cosmodc2': ellip_dc2,
+                                'ellip_lens': matched_sys_cat['ellip_lens'].values,
+                                'phie_cosmodc2': phie_dc2,
+                                'phie_lens': matched_sys_cat['phie_lens'].values,
+                                'av_mw': lens_cols['av_mw'],
+                                'rv_mw': lens_cols['rv_mw'],
+                                'vel_disp_lenscat': lens_cols['fp_vel_disp'],
+                                'lens_cat_sys_id': matched_sys_cat['system_id'].values,
+                                'dc2_sys_id': new_sys_id})
 
         return lens_df
 
     def output_lens_galaxy_truth(self, matched_agn_lens, matched_agn_sys,
                                  matched_sne_lens, matched_sne_sys, out_file,
-                                 return_df=False, overwrite_existing=False):
+                                 return_df=False, overwrite_existing=False,
+                                 output_format='sqlite'):
 
         """
         Output sqlite truth catalogs for foreground lens galaxies for
@@ -462,6 +737,10 @@ class DC2Sprinkler(BaseSprinkler):
         overwrite_existing: bool, default=False
             Overwrite existing catalog
 
+        output_format: str, default='sqlite'
+            'sqlite' writes `out_file` as a sqlite file. 'parquet' writes a directory
+            `out_file` of Parquet datasets partitioned by healpix of the lens position.
+
         Returns
         -------
         agn_lens_df: pandas dataframe
@@ -476,12 +755,9 @@ class DC2Sprinkler(BaseSprinkler):
         sne_lens_df = self.create_lens_truth_dataframe(matched_sne_lens,
                                                        matched_sne_sys, 'GLSNE')
 
-        if overwrite_existing is True and os.path.exists(out_file):
-            os.remove(out_file)
-
-        engine = create_engine('sqlite:///%s' % out_file, echo=False)
-        agn_lens_df.to_sql('agn_lens', con=engine)
-        sne_lens_df.to_sql('sne_lens', con=engine)
+        truth_writer = get_truth_writer(out_file, output_format=output_format,
+                                        overwrite_existing=overwrite_existing)
+        truth_writer.write({'agn_lens': agn_lens_df, 'sne_lens': sne_lens_df})
 
         if return_df is True:
             return agn_lens_df, sne_lens_df
@@ -500,8 +776,82 @@ class DC2Sprinkler(BaseSprinkler):
 
         return label_array, label_dict
 
+    def explode_image_column(self, image_values, n_img):
+
+        """
+        Flatten a column of per-system image arrays into one value per image,
+        keeping only the first `n_img` entries of each system.
+
+        `image_values` can be a dense (n_sys, n_max) array, a sequence of
+        equal length arrays or a sequence of arrays of different lengths.
+        """
+
+        if len(image_values) == 0:
+            return np.array([], dtype=np.float64)
+
+        n_img = np.asarray(n_img, dtype=np.int64)
+        if not (isinstance(image_values, np.ndarray) and image_values.ndim == 2):
+            if len(set(len(sys_values) for sys_values in image_values)) > 1:
+                return np.concatenate([np.asarray(sys_values, dtype=np.float64)[:sys_n_img]
+                                       for sys_values, sys_n_img in zip(image_values, n_img)])
+            image_values = np.stack(image_values)
+
+        img_mask = np.arange(image_values.shape[1]) < n_img[:, None]
+
+        return np.asarray(image_values[img_mask], dtype=np.float64)
+
+    def image_values(self, matched_sys_cat, key):
+
+        """
+        Values of an image quantity for every system.
+
+        Returns the (n_sys, n_max) array when `matched_sys_cat` holds the
+        quantity as dense columns `<key>_0`, `<key>_1`, ... (see
+        `GoldsteinSNeCatReader.merge_dense_catalog`) and the `key` column of
+        per-system arrays otherwise. Either can go to `explode_image_column`.
+        """
+
+        if key in matched_sys_cat.columns:
+            return matched_sys_cat[key].values
+
+        n_max = 0
+        while '%s_%i' % (key, n_max) in matched_sys_cat.columns:
+            n_max += 1
+        if n_max == 0:
+            raise KeyError(key)
+
+        return matched_sys_cat[image_slot_columns(key, n_max)].to_numpy(dtype=np.float64)
+
+    def image_index(self, n_img):
+
+        """
+        Index arrays to explode systems into one row per image.
+
+        Parameters
+        ----------
+
+        n_img: numpy.ndarray
+            Number of images of each system
+
+        Returns
+        -------
+
+        sys_idx: numpy.ndarray
+            System row of each image
+
+        image_number: numpy.ndarray
+            Image number of each image within its system
+        """
+
+        n_img = np.asarray(n_img, dtype=np.int64)
+        sys_idx = np.repeat(np.arange(len(n_img)), n_img)
+        img_offset = np.cumsum(n_img) - n_img
+        image_number = np.arange(len(sys_idx)) - np.repeat(img_offset, n_img)
+
+        return sys_idx, image_number
+
     def create_host_truth_dataframe(self, matched_lenses, matched_hosts,
-                                    matched_sys_cat, id_type_prefix):
+                                    matched_sys_cat, id_type_prefix, phot_engine=None):
 
         """
         Create the final properly formatted lens galaxy truth catalog.
@@ -521,6 +871,9 @@ class DC2Sprinkler(BaseSprinkler):
             Ids to match systems will be (id_type_prefix)_(lens sys id number)
             Example: `GLAGN_0`
 
+        phot_engine: PhotometryEngine or FluxLookup, default=None
+            Calculates the host fluxes. Defaults to exact fluxes through the LSST bandpasses.
+
         Returns
         -------
         host_df: pandas dataframe
@@ -528,152 +881,111 @@ class DC2Sprinkler(BaseSprinkler):
         """
 
 
-        new_entries = []
-
-        bp_dict = BandpassDict.loadTotalBandpassesFromFiles()
-
-        for i in range(len(matched_sys_cat)):
-            for j in range(matched_sys_cat.iloc[i]['n_img']):
-
-                gal_id = matched_hosts.iloc[i]['galaxy_id']+j
-                new_sys_id_num = i
-                new_sys_id = '%s_%i' % (id_type_prefix, new_sys_id_num)
-                image_number = j
-                unique_id = '%s_host_%i_%i' % (id_type_prefix, new_sys_id_num, image_number)
-
-                ra_lens = matched_lenses.iloc[i]['ra']
-                dec_lens = matched_lenses.iloc[i]['dec']
-                id_lens = matched_lenses.iloc[i]['galaxy_id']
-
-                x_src = matched_sys_cat.iloc[i]['x_src']
-                y_src = matched_sys_cat.iloc[i]['y_src']
-                x_img = matched_sys_cat.iloc[i]['x_img'][j]
-                y_img = matched_sys_cat.iloc[i]['y_img'][j]
-
-                delta_ra_unlensed = x_src / 3600.0
-                delta_dec_unlensed = y_src / 3600.0
-                ra_host_unlensed = ra_lens + delta_ra_unlensed/np.cos(np.radians(dec_lens))
-                dec_host_unlensed = dec_lens + delta_dec_unlensed
-
-                delta_ra_lensed = x_img / 3600.0
-                delta_dec_lensed = y_img / 3600.0
-                ra_host_lensed = ra_lens + delta_ra_lensed/np.cos(np.radians(dec_lens))
-                dec_host_lensed = dec_lens + delta_dec_lensed
-
-                redshift = matched_sys_cat.iloc[i]['z_src']
-                shear_1 = 0. #matched_hosts.iloc[i]['gamma_1']
-                shear_2 = 0. #matched_hosts.iloc[i]['gamma_2']
-                kappa = 0. #matched_hosts.iloc[i]['kappa']
-                sindex_bulge = 4
-                sindex_disk = 1
-
-                mag_adjust = 2.5*np.log10(np.abs(matched_sys_cat.iloc[i]['magnification_img'][j]))
-                magnorm_disk_array, magnorm_disk_dict = self.merge_bandpass_columns(matched_hosts.iloc[i], 'disk_magnorm')
-                # Postage stamp code expects unlensed mag
-                magnorm_disk = magnorm_disk_array #- mag_adjust
-                magnorm_disk_u = magnorm_disk[0]
-                magnorm_disk_g = magnorm_disk[1]
-                magnorm_disk_r = magnorm_disk[2]
-                magnorm_disk_i = magnorm_disk[3]
-                magnorm_disk_z = magnorm_disk[4]
-                magnorm_disk_y = magnorm_disk[5]
-
-                disk_flux_no_mw, disk_flux_mw = self.add_flux(matched_hosts.iloc[i]['sed_disk'][2:-1],
-                                                        redshift,
-                                                        magnorm_disk_dict, matched_lenses.iloc[i]['av_mw'],
-                                                        matched_lenses.iloc[i]['rv_mw'], bp_dict=bp_dict)
-
-                magnorm_bulge_array, magnorm_bulge_dict = self.merge_bandpass_columns(matched_hosts.iloc[i], 'bulge_magnorm')
-                magnorm_bulge = magnorm_bulge_array #- mag_adjust
-                magnorm_bulge_u = magnorm_bulge[0]
-                magnorm_bulge_g = magnorm_bulge[1]
-                magnorm_bulge_r = magnorm_bulge[2]
-                magnorm_bulge_i = magnorm_bulge[3]
-                magnorm_bulge_z = magnorm_bulge[4]
-                magnorm_bulge_y = magnorm_bulge[5]
-
-                bulge_flux_no_mw, bulge_flux_mw = self.add_flux(matched_hosts.iloc[i]['sed_bulge'][2:-1],
-                                                        redshift,
-                                                        magnorm_bulge_dict, matched_lenses.iloc[i]['av_mw'],
-                                                        matched_lenses.iloc[i]['rv_mw'], bp_dict=bp_dict)
-
-                flux_u = bulge_flux_mw['u'] + disk_flux_mw['u']
-                flux_g = bulge_flux_mw['g'] + disk_flux_mw['g']
-                flux_r = bulge_flux_mw['r'] + disk_flux_mw['r']
-                flux_i = bulge_flux_mw['i'] + disk_flux_mw['i']
-                flux_z = bulge_flux_mw['z'] + disk_flux_mw['z']
-                flux_y = bulge_flux_mw['y'] + disk_flux_mw['y']
-
-                flux_u_noMW = bulge_flux_no_mw['u'] + disk_flux_no_mw['u']
-                flux_g_noMW = bulge_flux_no_mw['g'] + disk_flux_no_mw['g']
-                flux_r_noMW = bulge_flux_no_mw['r'] + disk_flux_no_mw['r']
-                flux_i_noMW = bulge_flux_no_mw['i'] + disk_flux_no_mw['i']
-                flux_z_noMW = bulge_flux_no_mw['z'] + disk_flux_no_mw['z']
-                flux_y_noMW = bulge_flux_no_mw['y'] + disk_flux_no_mw['y']
-
-                major_axis_disk = matched_hosts.iloc[i]['semi_major_axis_disk']
-                major_axis_bulge = matched_hosts.iloc[i]['semi_major_axis_bulge']
-                minor_axis_disk = matched_hosts.iloc[i]['semi_minor_axis_disk']
-                minor_axis_bulge = matched_hosts.iloc[i]['semi_minor_axis_bulge']
-                major_axis = matched_hosts.iloc[i]['semi_major_axis']
-                minor_axis = matched_hosts.iloc[i]['semi_minor_axis']
-                position_angle = matched_hosts.iloc[i]['position_angle']
-
-                av_internal_disk = matched_hosts.iloc[i]['av_internal_disk']
-                av_internal_bulge = matched_hosts.iloc[i]['av_internal_bulge']
-                rv_internal_disk = matched_hosts.iloc[i]['rv_internal_disk']
-                rv_internal_bulge = matched_hosts.iloc[i]['rv_internal_bulge']
-                av_mw = matched_lenses.iloc[i]['av_mw']
-                rv_mw = matched_lenses.iloc[i]['rv_mw']
-
-                sed_disk_host = matched_hosts.iloc[i]['sed_disk']
-                sed_bulge_host = matched_hosts.iloc[i]['sed_bulge']
-
-                cat_sys_id = matched_sys_cat.iloc[i]['system_id']
-
-                new_row = [unique_id, x_src, y_src, x_img, y_img,
-                        ra_lens, dec_lens, ra_host_unlensed, dec_host_unlensed,
-                        ra_host_lensed, dec_host_lensed,
-                        magnorm_disk_u, magnorm_disk_g, magnorm_disk_r,
-                        magnorm_disk_i, magnorm_disk_z, magnorm_disk_y,
-                        magnorm_bulge_u, magnorm_bulge_g, magnorm_bulge_r,
-                        magnorm_bulge_i, magnorm_bulge_z, magnorm_bulge_y,
-                        flux_u, flux_g, flux_r, flux_i, flux_z, flux_y,
-                        flux_u_noMW, flux_g_noMW, flux_r_noMW, flux_i_noMW, flux_z_noMW, flux_y_noMW,
-                        redshift, shear_1, shear_2, kappa, sindex_bulge, sindex_disk,
-                        major_axis_disk, major_axis_bulge, minor_axis_disk, minor_axis_bulge,
-                        major_axis, minor_axis,
-                        position_angle, av_internal_disk, av_internal_bulge, rv_internal_disk,
-                        rv_internal_bulge, av_mw, rv_mw, sed_disk_host, sed_bulge_host,
-                        gal_id, id_lens, cat_sys_id, new_sys_id, image_number]
-
-                new_entries.append(new_row)
-
-        host_df = pd.DataFrame(new_entries,
-                            columns=['unique_id', 'x_src', 'y_src', 'x_img', 'y_img',
-                                        'ra_lens', 'dec_lens', 'ra_host_unlensed', 'dec_host_unlensed',
-                                        'ra_host_lensed', 'dec_host_lensed',
-                                        'magnorm_disk_u', 'magnorm_disk_g', 'magnorm_disk_r',
-                                        'magnorm_disk_i', 'magnorm_disk_z', 'magnorm_disk_y',
-                                        'magnorm_bulge_u', 'magnorm_bulge_g', 'magnorm_bulge_r',
-                                        'magnorm_bulge_i', 'magnorm_bulge_z', 'magnorm_bulge_y',
-                                        'flux_u', 'flux_g', 'flux_r', 'flux_i', 'flux_z', 'flux_y',
-                                        'flux_u_noMW', 'flux_g_noMW', 'flux_r_noMW', 'flux_i_noMW', 'flux_z_noMW', 'flux_y_noMW',
-                                        'redshift', 'shear_1', 'shear_2',
-                                        'kappa', 'sindex_bulge', 'sindex_disk',
-                                        'major_axis_disk', 'major_axis_bulge', 'minor_axis_disk',
-                                        'minor_axis_bulge', 'semi_major_axis', 'semi_minor_axis', 'position_angle',
-                                        'av_internal_disk', 'av_internal_bulge',
-                                        'rv_internal_disk', 'rv_internal_bulge',
-                                        'av_mw', 'rv_mw', 'sed_disk_host',
-                                        'sed_bulge_host', 'original_gal_id', 'lens_gal_id',
-                                        'lens_cat_sys_id', 'dc2_sys_id', 'image_number'])
+        if phot_engine is None:
+            phot_engine = PhotometryEngine()
+        bandpass_names = ['u', 'g', 'r', 'i', 'z', 'y']
+
+        n_sys = len(matched_sys_cat)
+        n_img = np.asarray(matched_sys_cat['n_img'].values, dtype=np.int64)
+
+        # Explode the systems into one row per image
+        sys_idx, image_number = self.image_index(n_img)
+
+        x_img = self.explode_image_column(self.image_values(matched_sys_cat, 'x_img'), n_img)
+        y_img = self.explode_image_column(self.image_values(matched_sys_cat, 'y_img'), n_img)
+
+        lens_gal_id = matched_lenses['galaxy_id'].values[:n_sys]
+        ra_lens = matched_lenses['ra'].values[:n_sys]
+        dec_lens = matched_lenses['dec'].values[:n_sys]
+        av_mw = matched_lenses['av_mw'].values[:n_sys]
+        rv_mw = matched_lenses['rv_mw'].values[:n_sys]
+        x_src = matched_sys_cat['x_src'].values
+        y_src = matched_sys_cat['y_src'].values
+        redshift = matched_sys_cat['z_src'].values
+
+        delta_ra_unlensed = x_src / 3600.0
+        delta_dec_unlensed = y_src / 3600.0
+        ra_host_unlensed = ra_lens + delta_ra_unlensed/np.cos(np.radians(dec_lens))
+        dec_host_unlensed = dec_lens + delta_dec_unlensed
+
+        delta_ra_lensed = x_img / 3600.0
+        delta_dec_lensed = y_img / 3600.0
+        ra_host_lensed = ra_lens[sys_idx] + delta_ra_lensed/np.cos(np.radians(dec_lens[sys_idx]))
+        dec_host_lensed = dec_lens[sys_idx] + delta_dec_lensed
+
+        magnorm_disk, magnorm_disk_dict = self.merge_bandpass_columns(matched_hosts, 'disk_magnorm')
+        magnorm_bulge, magnorm_bulge_dict = self.merge_bandpass_columns(matched_hosts, 'bulge_magnorm')
+        # Postage stamp code expects unlensed mag
+        magnorm_disk = magnorm_disk[:n_sys]
+        magnorm_bulge = magnorm_bulge[:n_sys]
+
+        # The host SED and fluxes are the same for every image of a system so
+        # only calculate them once per system.
+        sed_disk_host = matched_hosts['sed_disk'].values[:n_sys]
+        sed_bulge_host = matched_hosts['sed_bulge'].values[:n_sys]
+        disk_flux_no_mw, disk_flux_mw = phot_engine.calc_fluxes([sed_file_name(sed_name) for sed_name in sed_disk_host],
+                                                                redshift, magnorm_disk, av_mw, rv_mw)
+        bulge_flux_no_mw, bulge_flux_mw = phot_engine.calc_fluxes([sed_file_name(sed_name) for sed_name in sed_bulge_host],
+                                                                  redshift, magnorm_bulge, av_mw, rv_mw)
+        flux_mw = disk_flux_mw + bulge_flux_mw
+        flux_no_mw = disk_flux_no_mw + bulge_flux_no_mw
+
+        new_sys_id = np.array(['%s_%i' % (id_type_prefix, new_sys_id_num)
+                               for new_sys_id_num in range(n_sys)], dtype=object)
+        unique_id = ['%s_host_%i_%i' % (id_type_prefix, new_sys_id_num, img_num)
+                     for new_sys_id_num, img_num in zip(sys_idx, image_number)]
+
+        host_cols = {'unique_id': unique_id,
+                     'x_src': x_src[sys_idx], 'y_src': y_src[sys_idx],
+                     'x_img': x_img, 'y_img': y_img,
+                     'ra_lens': ra_lens[sys_idx], 'dec_lens': dec_lens[sys_idx],
+                     'ra_host_unlensed': ra_host_unlensed[sys_idx],
+                     'dec_host_unlensed': dec_host_unlensed[sys_idx],
+                     'ra_host_lensed': ra_host_lensed, 'dec_host_lensed': dec_host_lensed}
+        for band_num, bp_name in enumerate(bandpass_names):
+            host_cols['magnorm_disk_%s' % bp_name] = magnorm_disk[sys_idx, band_num]
+        for band_num, bp_name in enumerate(bandpass_names):
+            host_cols['magnorm_bulge_%s' % bp_name] = magnorm_bulge[sys_idx, band_num]
+        for band_num, bp_name in enumerate(bandpass_names):
+            host_cols['flux_%s' % bp_name] = flux_mw[sys_idx, band_num]
+        for band_num, bp_name in enumerate(bandpass_names):
+            host_cols['flux_%s_noMW' % bp_name] = flux_no_mw[sys_idx, band_num]
+        host_cols['redshift'] = redshift[sys_idx]
+        host_cols['shear_1'] = np.zeros(len(sys_idx))
+        host_cols['shear_2'] = np.zeros(len(sys_idx))
+        host_cols['kappa'] = np.zeros(len(sys_idx))
+        host_cols['sindex_bulge'] = np.full(len(sys_idx), 4, dtype=np.int64)
+        host_cols['sindex_disk'] = np.full(len(sys_idx), 1, dtype=np.int64)
+        for host_col, out_col in [('semi_major_axis_disk', 'major_axis_disk'),
+                                  ('semi_major_axis_bulge', 'major_axis_bulge'),
+                                  ('semi_minor_axis_disk', 'minor_axis_disk'),
+                                  ('semi_minor_axis_bulge', 'minor_axis_bulge'),
+                                  ('semi_major_axis', 'semi_major_axis'),
+                                  ('semi_minor_axis', 'semi_minor_axis'),
+                                  ('position_angle', 'position_angle'),
+                                  ('av_internal_disk', 'av_internal_disk'),
+                                  ('av_internal_bulge', 'av_internal_bulge'),
+                                  ('rv_internal_disk', 'rv_internal_disk'),
+                                  ('rv_internal_bulge', 'rv_internal_bulge')]:
+            host_cols[out_col] = matched_hosts[host_col].values[:n_sys][sys_idx]
+        host_cols['av_mw'] = av_mw[sys_idx]
+        host_cols['rv_mw'] = rv_mw[sys_idx]
+        host_cols['sed_disk_host'] = sed_disk_host[sys_idx]
+        host_cols['sed_bulge_host'] = sed_bulge_host[sys_idx]
+        host_cols['original_gal_id'] = matched_hosts['galaxy_id'].values[:n_sys][sys_idx] + image_number
+        host_cols['lens_gal_id'] = lens_gal_id[sys_idx]
+        host_cols['lens_cat_sys_id'] = matched_sys_cat['system_id'].values[sys_idx]
+        host_cols['dc2_sys_id'] = new_sys_id[sys_idx]
+        host_cols['image_number'] = image_number
+
+        host_df = pd.DataFrame(host_cols)
 
         return host_df
 
     def output_host_galaxy_truth(self, matched_agn_lens, matched_agn_hosts, matched_agn_sys,
                                  matched_sne_lens, matched_sne_hosts, matched_sne_sys, out_file,
-                                 return_df=False, overwrite_existing=False):
+                                 return_df=False, overwrite_existing=False, phot_engine=None,
+                                 output_format='sqlite'):
 
         """
         Output sqlite truth catalogs for foreground lens galaxies for
@@ -708,6 +1020,13 @@ class DC2Sprinkler(BaseSprinkler):
         overwrite_existing: bool, default=False
             Overwrite existing catalog
 
+        phot_engine: PhotometryEngine or FluxLookup, default=None
+            Calculates the host fluxes. Defaults to exact fluxes through the LSST bandpasses.
+
+        output_format: str, default='sqlite'
+            'sqlite' writes `out_file` as a sqlite file. 'parquet' writes a directory
+            `out_file` of Parquet datasets partitioned by healpix of the lens position.
+
         Returns
         -------
         agn_host_df: pandas dataframe
@@ -717,17 +1036,19 @@ class DC2Sprinkler(BaseSprinkler):
             Pandas dataframe format of the truth catalog for the host galaxies in lensed SNe systems.
         """
 
+        if phot_engine is None:
+            phot_engine = PhotometryEngine()
+
         agn_host_df = self.create_host_truth_dataframe(matched_agn_lens, matched_agn_hosts,
-                                                       matched_agn_sys, 'GLAGN')
+                                                       matched_agn_sys, 'GLAGN',
+                                                       phot_engine=phot_engine)
         sne_host_df = self.create_host_truth_dataframe(matched_sne_lens, matched_sne_hosts,
-                                                       matched_sne_sys, 'GLSNE')
-
-        if overwrite_existing is True and os.path.exists(out_file):
-            os.remove(out_file)
+                                                       matched_sne_sys, 'GLSNE',
+                                                       phot_engine=phot_engine)
 
-        engine = create_engine('sqlite:///%s' % out_file, echo=False)
-        agn_host_df.to_sql('agn_hosts', con=engine)
-        sne_host_df.to_sql('sne_hosts', con=engine)
+        truth_writer = get_truth_writer(out_file, output_format=output_format,
+                                        overwrite_existing=overwrite_existing)
+        truth_writer.write({'agn_hosts': agn_host_df, 'sne_hosts': sne_host_df})
 
         if return_df is True:
             return agn_host_df, sne_host_df
@@ -735,7 +1056,8 @@ class DC2Sprinkler(BaseSprinkler):
     def output_lensed_agn_truth(self, matched_hosts, matched_lenses,
                                 matched_sys_cat, out_file,
                                 return_df=True,
-                                overwrite_existing=False):
+                                overwrite_existing=False,
+                                phot_engine=None, output_format='sqlite'):
 
         """
         Create the final properly formatted lens galaxy truth catalog.
@@ -756,107 +1078,90 @@ class DC2Sprinkler(BaseSprinkler):
 
         overwrite_existing: bool, default=False
 
+        phot_engine: PhotometryEngine or FluxLookup, default=None
+            Calculates the AGN fluxes. Defaults to exact fluxes through the LSST bandpasses.
+
+        output_format: str, default='sqlite'
+            'sqlite' writes `out_file` as a sqlite file. 'parquet' writes a directory
+            `out_file` of Parquet datasets partitioned by healpix of the lens position.
+
         Returns
         -------
         lens_df: pandas dataframe
             Return the pandas dataframe format of the truth catalog.
         """
 
-        new_entries = []
-
-        bp_dict = BandpassDict.loadTotalBandpassesFromFiles()
-
-        for i in range(len(matched_sys_cat)):
-            for j in range(matched_sys_cat.iloc[i]['n_img']):
-
-                gal_id = matched_hosts.iloc[i]['galaxy_id']+j
-                new_sys_id_num = i
-                new_sys_id = 'GLAGN_%i' % new_sys_id_num
-                image_number = j
-                gal_unique_id = 'GLAGN_agn_%i_%i' % (new_sys_id_num, image_number)
-
-                ra_lens = matched_lenses.iloc[i]['ra']
-                dec_lens = matched_lenses.iloc[i]['dec']
-                id_lens = matched_lenses.iloc[i]['galaxy_id']
-                x_src = matched_sys_cat.iloc[i]['x_src']
-                y_src = matched_sys_cat.iloc[i]['y_src']
-                x_img = matched_sys_cat.iloc[i]['x_img'][j]
-                y_img = matched_sys_cat.iloc[i]['y_img'][j]
-                delta_ra = matched_sys_cat.iloc[i]['x_img'][j] / 3600.0
-                delta_dec = matched_sys_cat.iloc[i]['y_img'][j] / 3600.0
-                ra = ra_lens + delta_ra/np.cos(np.radians(dec_lens))
-                dec = dec_lens + delta_dec
-
-                redshift = matched_sys_cat.iloc[i]['z_src']
-                t_delay = matched_sys_cat.iloc[i]['t_delay_img'][j]
-
-                magnorm = matched_hosts.iloc[i]['magNorm_agn']
-                mag = matched_sys_cat.iloc[i]['magnification_img'][j]
-
-                magnorm_dict = {x: magnorm for x in ['u', 'g', 'r', 'i', 'z', 'y']}
-
-                agn_flux_no_mw, agn_flux_mw = self.add_flux('agnSED/agn.spec.gz',
-                                                    redshift,
-                                                    magnorm_dict, matched_lenses.iloc[i]['av_mw'],
-                                                    matched_lenses.iloc[i]['rv_mw'], bp_dict=bp_dict)
-
-                agn_var_param = json.loads(matched_hosts.iloc[i]['varParamStr_agn'])['p']
-                seed = agn_var_param['seed']
-                agn_tau_u = agn_var_param['agn_tau_u']
-                agn_tau_g = agn_var_param['agn_tau_g']
-                agn_tau_r = agn_var_param['agn_tau_r']
-                agn_tau_i = agn_var_param['agn_tau_i']
-                agn_tau_z = agn_var_param['agn_tau_z']
-                agn_tau_y = agn_var_param['agn_tau_y']
-                agn_sf_u = agn_var_param['agn_sf_u']
-                agn_sf_g = agn_var_param['agn_sf_g']
-                agn_sf_r = agn_var_param['agn_sf_r']
-                agn_sf_i = agn_var_param['agn_sf_i']
-                agn_sf_z = agn_var_param['agn_sf_z']
-                agn_sf_y = agn_var_param['agn_sf_y']
-
-                av_mw = matched_lenses.iloc[i]['av_mw']
-                rv_mw = matched_lenses.iloc[i]['rv_mw']
-
-                cat_sys_id = matched_sys_cat.iloc[i]['system_id']
-
-                new_row = [gal_unique_id, ra, dec, x_src, y_src, x_img, y_img,
-                        redshift, t_delay, magnorm,
-                        agn_flux_mw['u'], agn_flux_mw['g'], agn_flux_mw['r'],
-                        agn_flux_mw['i'], agn_flux_mw['z'], agn_flux_mw['y'],
-                        agn_flux_no_mw['u'], agn_flux_no_mw['g'], agn_flux_no_mw['r'],
-                        agn_flux_no_mw['i'], agn_flux_no_mw['z'], agn_flux_no_mw['y'],
-                        mag, seed, agn_tau_u, agn_tau_u, agn_tau_u,
-                        agn_tau_u, agn_tau_u, agn_tau_u,
-                        agn_sf_u, agn_sf_g, agn_sf_r,
-                        agn_sf_i, agn_sf_z, agn_sf_y,
-                        av_mw, rv_mw, id_lens, new_sys_id,
-                        cat_sys_id, image_number]
-
-                new_entries.append(new_row)
-
-        agn_df = pd.DataFrame(new_entries,
-                            columns=['unique_id', 'ra', 'dec', 'x_agn', 'y_agn',
-                                    'x_img', 'y_img',
-                                    'redshift', 't_delay', 'magnorm',
-                                    'flux_u_agn', 'flux_g_agn', 'flux_r_agn',
-                                    'flux_i_agn', 'flux_z_agn', 'flux_y_agn',
-                                    'flux_u_agn_noMW', 'flux_g_agn_noMW',
-                                    'flux_r_agn_noMW', 'flux_i_agn_noMW',
-                                    'flux_z_agn_noMW', 'flux_y_agn_noMW',
-                                    'magnification', 'seed', 'agn_tau_u',
-                                    'agn_tau_g', 'agn_tau_r',
-                                    'agn_tau_i', 'agn_tau_z', 'agn_tau_y',
-                                    'agn_sf_u', 'agn_sf_g', 'agn_sf_r',
-                                    'agn_sf_i', 'agn_sf_z', 'agn_sf_y',
-                                    'av_mw', 'rv_mw', 'lens_id', 'dc2_sys_id',
-                                    'lens_cat_sys_id', 'image_number'])
-
-        if overwrite_existing is True and os.path.exists(out_file):
-            os.remove(out_file)
-
-        engine = create_engine('sqlite:///%s' % out_file, echo=False)
-        agn_df.to_sql('lensed_agn', con=engine)
+        if phot_engine is None:
+            phot_engine = PhotometryEngine()
+        bandpass_names = ['u', 'g', 'r', 'i', 'z', 'y']
+
+        # Every image of a system has the same unlensed AGN fluxes
+        n_sys = len(matched_sys_cat)
+        sys_flux_no_mw, sys_flux_mw = phot_engine.calc_fluxes('agnSED/agn.spec.gz',
+                                                              matched_sys_cat['z_src'].values,
+                                                              matched_hosts['magNorm_agn'].values[:n_sys],
+                                                              matched_lenses['av_mw'].values[:n_sys],
+                                                              matched_lenses['rv_mw'].values[:n_sys])
+
+        # Explode the systems into one row per image
+        n_img = np.asarray(matched_sys_cat['n_img'].values, dtype=np.int64)
+        sys_idx, image_number = self.image_index(n_img)
+
+        x_img = self.explode_image_column(self.image_values(matched_sys_cat, 'x_img'), n_img)
+        y_img = self.explode_image_column(self.image_values(matched_sys_cat, 'y_img'), n_img)
+        t_delay = self.explode_image_column(self.image_values(matched_sys_cat, 't_delay_img'),
+                                            n_img)
+        magnification = self.explode_image_column(self.image_values(matched_sys_cat,
+                                                                    'magnification_img'),
+                                                  n_img)
+
+        ra_lens = matched_lenses['ra'].values[:n_sys][sys_idx]
+        dec_lens = matched_lenses['dec'].values[:n_sys][sys_idx]
+        ra = ra_lens + (x_img / 3600.0)/np.cos(np.radians(dec_lens))
+        dec = dec_lens + y_img / 3600.0
+
+        agn_var_params = [json.loads(var_param_str)['p'] for var_param_str
+                          in matched_hosts['varParamStr_agn'].values[:n_sys]]
+
+        unique_id = ['GLAGN_agn_%i_%i' % (new_sys_id_num, img_num)
+                     for new_sys_id_num, img_num in zip(sys_idx, image_number)]
+        new_sys_id = np.array(['GLAGN_%i' % new_sys_id_num
+                               for new_sys_id_num in range(n_sys)], dtype=object)
+
+        agn_cols = {'unique_id': unique_id, 'ra': ra, 'dec': dec,
+                    'x_agn': matched_sys_cat['x_src'].values[sys_idx],
+                    'y_agn': matched_sys_cat['y_src'].values[sys_idx],
+                    'x_img': x_img, 'y_img': y_img,
+                    'redshift': matched_sys_cat['z_src'].values[sys_idx],
+                    't_delay': t_delay,
+                    'magnorm': matched_hosts['magNorm_agn'].values[:n_sys][sys_idx]}
+        for band_num, bp_name in enumerate(bandpass_names):
+            agn_cols['flux_%s_agn' % bp_name] = sys_flux_mw[sys_idx, band_num]
+        for band_num, bp_name in enumerate(bandpass_names):
+            agn_cols['flux_%s_agn_noMW' % bp_name] = sys_flux_no_mw[sys_idx, band_num]
+        agn_cols['magnification'] = magnification
+        agn_cols['seed'] = np.array([var_param['seed'] for var_param in agn_var_params])[sys_idx]
+        # The tau columns have always all held the u-band tau
+        agn_tau_u = np.array([var_param['agn_tau_u'] for var_param in agn_var_params])[sys_idx]
+        for bp_name in bandpass_names:
+            agn_cols['agn_tau_%s' % bp_name] = agn_tau_u
+        for bp_name in bandpass_names:
+            agn_cols['agn_sf_%s' % bp_name] = np.array([var_param['agn_sf_%s' % bp_name] for
+                                                        var_param in agn_var_params])[sys_idx]
+        agn_cols['av_mw'] = matched_lenses['av_mw'].values[:n_sys][sys_idx]
+        agn_cols['rv_mw'] = matched_lenses['rv_mw'].values[:n_sys][sys_idx]
+        agn_cols['lens_id'] = matched_lenses['galaxy_id'].values[:n_sys][sys_idx]
+        agn_cols['dc2_sys_id'] = new_sys_id[sys_idx]
+        agn_cols['lens_cat_sys_id'] = matched_sys_cat['system_id'].values[sys_idx]
+        agn_cols['image_number'] = image_number
+
+        agn_df = pd.DataFrame(agn_cols)
+
+        lens_positions = {'lensed_agn': (np.repeat(matched_lenses['ra'].values[:n_sys], n_img),
+                                         np.repeat(matched_lenses['dec'].values[:n_sys], n_img))}
+        truth_writer = get_truth_writer(out_file, output_format=output_format,
+                                        overwrite_existing=overwrite_existing)
+        truth_writer.write({'lensed_agn': agn_df}, lens_positions=lens_positions)
 
         if return_df is True:
             return agn_df
@@ -864,7 +1169,7 @@ class DC2Sprinkler(BaseSprinkler):
     def output_lensed_sne_truth(self, matched_hosts, matched_lenses,
                                 matched_sys_cat, out_file,
                                 return_df=True, id_offset=0,
-                                overwrite_existing=False):
+                                overwrite_existing=False, output_format='sqlite'):
 
         """
         Create the final properly formatted lens galaxy truth catalog.
@@ -888,72 +1193,64 @@ class DC2Sprinkler(BaseSprinkler):
 
         overwrite_existing: bool, default=False
 
+        output_format: str, default='sqlite'
+            'sqlite' writes `out_file` as a sqlite file. 'parquet' writes a directory
+            `out_file` of Parquet datasets partitioned by healpix of the lens position.
+
         Returns
         -------
         lens_df: pandas dataframe
             Return the pandas dataframe format of the truth catalog.
         """
 
-        new_entries = []
-
-        for i in range(len(matched_sys_cat)):
-            for j in range(matched_sys_cat.iloc[i]['n_img']):
-
-                gal_id = matched_hosts.iloc[i]['galaxy_id']+j
-                new_sys_id_num = i
-                image_number = j
-                new_sys_id = 'GLSNE_%i' % new_sys_id_num
-                gal_unique_id = 'GLSNE_sne_%i_%i' % (new_sys_id_num, image_number)
-
-                ra_lens = matched_lenses.iloc[i]['ra']
-                dec_lens = matched_lenses.iloc[i]['dec']
-                id_lens = matched_lenses.iloc[i]['galaxy_id']
-                sn_x = matched_sys_cat.iloc[i]['snx']
-                sn_y = matched_sys_cat.iloc[i]['sny']
-                img_x = matched_sys_cat.iloc[i]['x_img'][j]
-                img_y = matched_sys_cat.iloc[i]['y_img'][j]
-                delta_ra = matched_sys_cat.iloc[i]['x_img'][j] / 3600.0
-                delta_dec = matched_sys_cat.iloc[i]['y_img'][j] / 3600.0
-                ra = ra_lens + delta_ra/np.cos(np.radians(dec_lens))
-                dec = dec_lens + delta_dec
-
-                t0 = matched_sys_cat.iloc[i]['t0']
-                t_delay = matched_sys_cat.iloc[i]['t_delay_img'][j]
-                mb = matched_sys_cat.iloc[i]['MB']
-                mag = matched_sys_cat.iloc[i]['magnification_img'][j]
-                x0 = matched_sys_cat.iloc[i]['x0']
-                x1 = matched_sys_cat.iloc[i]['x1']
-                c = matched_sys_cat.iloc[i]['c']
-                host_type = matched_sys_cat.iloc[i]['host_type']
-
-                redshift = matched_sys_cat.iloc[i]['z_src']
-
-                av_mw = matched_lenses.iloc[i]['av_mw']
-                rv_mw = matched_lenses.iloc[i]['rv_mw']
-
-                cat_sys_id = matched_sys_cat.iloc[i]['system_id']
-
-                new_row = [gal_unique_id, gal_unique_id, ra, dec, sn_x, sn_y,
-                        img_x, img_y, t0,
-                        t_delay, mb, mag, x0, x1, c, host_type,
-                        redshift, av_mw, rv_mw,
-                        id_lens, new_sys_id, cat_sys_id, image_number]
-
-                new_entries.append(new_row)
-
-        sne_df = pd.DataFrame(new_entries,
-                            columns=['unique_id', 'gal_unq_id', 'ra', 'dec', 'x_sne', 'y_sne',
-                                    'x_img', 'y_img', 't0', 't_delay', 'MB', 'magnification',
-                                    'x0', 'x1', 'c', 'host_type', 'redshift',
-                                    'av_mw', 'rv_mw', 'lens_id',
-                                    'dc2_sys_id', 'lens_cat_sys_id',
-                                    'image_number'])
-
-        if overwrite_existing is True and os.path.exists(out_file):
-            os.remove(out_file)
-
-        engine = create_engine('sqlite:///%s' % out_file, echo=False)
-        sne_df.to_sql('lensed_sne', con=engine)
+        n_sys = len(matched_sys_cat)
+        n_img = np.asarray(matched_sys_cat['n_img'].values, dtype=np.int64)
+        sys_idx, image_number = self.image_index(n_img)
+
+        x_img = self.explode_image_column(self.image_values(matched_sys_cat, 'x_img'), n_img)
+        y_img = self.explode_image_column(self.image_values(matched_sys_cat, 'y_img'), n_img)
+        t_delay = self.explode_image_column(self.image_values(matched_sys_cat, 't_delay_img'),
+                                            n_img)
+        magnification = self.explode_image_column(self.image_values(matched_sys_cat,
+                                                                    'magnification_img'),
+                                                  n_img)
+
+        ra_lens = matched_lenses['ra'].values[:n_sys][sys_idx]
+        dec_lens = matched_lenses['dec'].values[:n_sys][sys_idx]
+        ra = ra_lens + (x_img / 3600.0)/np.cos(np.radians(dec_lens))
+        dec = dec_lens + y_img / 3600.0
+
+        unique_id = ['GLSNE_sne_%i_%i' % (new_sys_id_num, img_num)
+                     for new_sys_id_num, img_num in zip(sys_idx, image_number)]
+        new_sys_id = np.array(['GLSNE_%i' % new_sys_id_num
+                               for new_sys_id_num in range(n_sys)], dtype=object)
+
+        sne_cols = {'unique_id': unique_id, 'gal_unq_id': unique_id,
+                    'ra': ra, 'dec': dec,
+                    'x_sne': matched_sys_cat['snx'].values[sys_idx],
+                    'y_sne': matched_sys_cat['sny'].values[sys_idx],
+                    'x_img': x_img, 'y_img': y_img,
+                    't0': matched_sys_cat['t0'].values[sys_idx],
+                    't_delay': t_delay,
+                    'MB': matched_sys_cat['MB'].values[sys_idx],
+                    'magnification': magnification}
+        for sys_col in ['x0', 'x1', 'c', 'host_type']:
+            sne_cols[sys_col] = matched_sys_cat[sys_col].values[sys_idx]
+        sne_cols['redshift'] = matched_sys_cat['z_src'].values[sys_idx]
+        sne_cols['av_mw'] = matched_lenses['av_mw'].values[:n_sys][sys_idx]
+        sne_cols['rv_mw'] = matched_lenses['rv_mw'].values[:n_sys][sys_idx]
+        sne_cols['lens_id'] = matched_lenses['galaxy_id'].values[:n_sys][sys_idx]
+        sne_cols['dc2_sys_id'] = new_sys_id[sys_idx]
+        sne_cols['lens_cat_sys_id'] = matched_sys_cat['system_id'].values[sys_idx]
+        sne_cols['image_number'] = image_number
+
+        sne_df = pd.DataFrame(sne_cols)
+
+        lens_positions = {'lensed_sne': (np.repeat(matched_lenses['ra'].values[:n_sys], n_img),
+                                         np.repeat(matched_lenses['dec'].values[:n_sys], n_img))}
+        truth_writer = get_truth_writer(out_file, output_format=output_format,
+                                        overwrite_existing=overwrite_existing)
+        truth_writer.write({'lensed_sne': sne_df}, lens_positions=lens_positions)
 
         if return_df is True:
             return sne_df
\ No newline at end of file
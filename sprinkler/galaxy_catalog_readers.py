@@ -5,20 +5,194 @@ Readers for galaxy catalogs to match to lens systems
 import numpy as np
 import pandas as pd
 import GCRCatalogs
+import healpy
 import sqlite3
+import warnings
+
+__all__ = ['DC2Reader', 'LocalGalaxyCatalog', 'CandidateFilter']
+
+
+class CandidateFilter():
+
+    """
+    Select rows of a galaxy dataframe with a boolean mask.
+
+    Predicates are only recorded when added. They are evaluated on whole
+    columns when the mask is needed and the dataframe is copied once, in
+    `apply`, however many predicates there are.
+
+    Parameters
+    ----------
+
+    galaxy_df: pandas dataframe
+    Galaxies to select from
+    """
+
+    def __init__(self, galaxy_df):
+
+        self.galaxy_df = galaxy_df
+        self.predicates = []
+
+    def require(self, predicate):
+
+        """
+        Keep only the rows where `predicate(galaxy_df)` is True.
+
+        Parameters
+        ----------
+
+        predicate: callable
+        Takes the dataframe and returns a boolean array with one value per row
+
+        Returns
+        -------
+
+        self: CandidateFilter
+        """
+
+        self.predicates.append(predicate)
+
+        return self
+
+    def exclude_ids(self, ids, id_column='galaxy_id'):
+
+        """
+        Drop the rows whose `id_column` value is in `ids`.
+        """
+
+        exclude_ids = np.asarray(ids)
+
+        return self.require(lambda galaxy_df: np.isin(galaxy_df[id_column].values,
+                                                      exclude_ids, invert=True))
+
+    def mask(self):
+
+        """
+        Boolean mask of the selected rows.
+        """
+
+        keep = np.ones(len(self.galaxy_df), dtype=bool)
+        for predicate in self.predicates:
+            keep &= np.asarray(predicate(self.galaxy_df), dtype=bool)
+
+        return keep
+
+    def apply(self):
+
+        """
+        The selected rows as a new dataframe with a fresh index.
+        """
+
+        selected_df = self.galaxy_df.take(np.flatnonzero(self.mask()))
+        selected_df.index = pd.RangeIndex(len(selected_df))
+
+        return selected_df
+
+
+class LocalGalaxyCatalog():
+
+    """
+    In-memory stand-in for a cosmoDC2 GCRCatalogs catalog so the readers can be
+    run offline.
+
+    Galaxies are split into native chunks by healpix of their position like
+    cosmoDC2. `get_quantities` takes the same arguments as the GCR method:
+    filters are strings such as 'ra < 53.755' or tuples of a callable and the
+    quantity names it takes, and native filters select on `healpix_pixel`.
+
+    Parameters
+    ----------
+
+    galaxy_df: pandas dataframe or str
+    Galaxy quantities, or the filename of a pickled dataframe of them
+
+    nside: int, default=32
+    Healpix nside of the native chunks
+    """
+
+    def __init__(self, galaxy_df, nside=32):
+
+        if isinstance(galaxy_df, str):
+            galaxy_df = pd.read_pickle(galaxy_df)
+
+        self.galaxy_df = galaxy_df.reset_index(drop=True)
+        self.healpix_pixel = healpy.ang2pix(nside, self.galaxy_df['ra'].values,
+                                            self.galaxy_df['dec'].values,
+                                            nest=False, lonlat=True)
+
+    def list_all_quantities(self):
+
+        return list(self.galaxy_df.columns)
+
+    def _filter_mask(self, chunk_df, filters):
+
+        mask = np.ones(len(chunk_df), dtype=bool)
+        for chunk_filter in filters:
+            if isinstance(chunk_filter, str):
+                mask &= np.asarray(chunk_df.eval(chunk_filter), dtype=bool)
+            else:
+                filter_func = chunk_filter[0]
+                mask &= np.asarray(filter_func(*[chunk_df[quantity].values
+                                                 for quantity in chunk_filter[1:]]),
+                                   dtype=bool)
+
+        return mask
+
+    def _iter_quantities(self, quantities, filters, native_filters):
+
+        for hpix in np.unique(self.healpix_pixel):
+            hpix_df = pd.DataFrame({'healpix_pixel': [hpix]})
+            if not self._filter_mask(hpix_df, native_filters)[0]:
+                continue
+            chunk_df = self.galaxy_df[self.healpix_pixel == hpix]
+            chunk_df = chunk_df[self._filter_mask(chunk_df, filters)]
+            yield {quantity: chunk_df[quantity].values for quantity in quantities}
+
+    def get_quantities(self, quantities, filters=None, native_filters=None,
+                       return_iterator=False):
+
+        """
+        Quantities of the galaxies that pass `filters` as a dict of arrays, or
+        an iterator over one such dict per healpix chunk.
+        """
+
+        if filters is None:
+            filters = []
+        if native_filters is None:
+            native_filters = []
+
+        chunk_iter = self._iter_quantities(quantities, filters, native_filters)
+        if return_iterator:
+            return chunk_iter
+
+        chunks = list(chunk_iter)
+        if len(chunks) == 0:
+            return {quantity: self.galaxy_df[quantity].values[:0] for quantity in quantities}
+
+        return {quantity: np.concatenate([chunk[quantity] for chunk in chunks])
+                for quantity in quantities}
 
-__all__ = ['DC2Reader']
 
 class DC2Reader():
 
     """
     Reader for cosmoDC2 galaxies supplemented with AGN
     and SED information.
+
+    Parameters
+    ----------
+
+    catalog_version: str
+    GCRCatalogs name of the cosmoDC2 catalog
+
+    catalog: GCR catalog or LocalGalaxyCatalog, default=None
+    Already loaded catalog to read instead of `catalog_version`
     """
 
-    def __init__(self, catalog_version):
+    def __init__(self, catalog_version, catalog=None):
 
         self.catalog_version = catalog_version
+        self.catalog = catalog
 
         # The columns we need to query
         self.quantity_list = [
@@ -48,31 +222,303 @@ class DC2Reader():
             'mag_true_i_lsst'
         ]
 
-    def load_galaxy_catalog(self, catalog_filters):
+    def get_catalog(self):
+
+        if self.catalog is None:
+            self.catalog = GCRCatalogs.load_catalog(self.catalog_version)
+
+        return self.catalog
+
+    def iter_galaxy_catalog(self, catalog_filters, native_filters=None,
+                            ellipticals_only=False, min_redshift=None, exclude_ids=None):
+
+        """
+        Iterate over the galaxy catalog one native (healpix) chunk at a time.
 
-        catalog = GCRCatalogs.load_catalog(self.catalog_version)
+        The cuts are applied to every chunk as it is read so only the
+        surviving galaxies of each chunk are held in memory.
+
+        Parameters
+        ----------
+
+        catalog_filters: list
+        GCR filters
+
+        native_filters: list, default=None
+        GCR native filters, e.g. on `healpix_pixel`
+
+        ellipticals_only: bool, default=False
+        Keep only the galaxies passing the bulge fraction cut of `trim_catalog`
+
+        min_redshift: float, default=None
+        Keep only galaxies with `redshift_true` above this
+
+        exclude_ids: array-like, default=None
+        Drop galaxies with these `galaxy_id` values
+
+        Returns
+        -------
+
+        chunk_iter: iterator of pandas dataframes
+            The galaxies of each chunk that pass the cuts
+        """
+
+        catalog = self.get_catalog()
+        for dc2_chunk in catalog.get_quantities(self.quantity_list, catalog_filters,
+                                                native_filters=native_filters,
+                                                return_iterator=True):
+            chunk_df = self.candidate_filter(pd.DataFrame(dc2_chunk),
+                                             ellipticals_only=ellipticals_only,
+                                             min_redshift=min_redshift,
+                                             exclude_ids=exclude_ids).apply()
+            if len(chunk_df) > 0:
+                yield chunk_df
+
+    def load_galaxy_catalog(self, catalog_filters, chunked=False, native_filters=None,
+                            ellipticals_only=False, min_redshift=None, exclude_ids=None):
+
+        """
+        Load the galaxy catalog as a dataframe.
+
+        With `chunked` the catalog is read and cut one healpix chunk at a time
+        with `iter_galaxy_catalog` so only the galaxies passing the cuts are
+        kept in memory.
+        """
+
+        if chunked:
+            dc2_chunks = list(self.iter_galaxy_catalog(catalog_filters,
+                                                       native_filters=native_filters,
+                                                       ellipticals_only=ellipticals_only,
+                                                       min_redshift=min_redshift,
+                                                       exclude_ids=exclude_ids))
+            if len(dc2_chunks) == 0:
+                return pd.DataFrame([], columns=self.quantity_list)
+            return pd.concat(dc2_chunks, ignore_index=True)
+
+        catalog = self.get_catalog()
         dc2_galaxies = catalog.get_quantities(self.quantity_list,
-                                              catalog_filters)
+                                              catalog_filters,
+                                              native_filters=native_filters)
         dc2_galaxies_df = pd.DataFrame(dc2_galaxies)
+        if ellipticals_only or (min_redshift is not None) or (exclude_ids is not None):
+            dc2_galaxies_df = self.candidate_filter(dc2_galaxies_df,
+                                                    ellipticals_only=ellipticals_only,
+                                                    min_redshift=min_redshift,
+                                                    exclude_ids=exclude_ids).apply()
 
         return dc2_galaxies_df
 
-    def trim_catalog(self, full_lens_df):
+    def elliptical_mask(self, galaxy_df):
 
         # Keep only "elliptical" galaxies. Use bulge/total mass ratio as proxy.
-        trim_idx_ellip = np.where(full_lens_df['stellar_mass_bulge']/
-                                  full_lens_df['stellar_mass'] > 0.99)[0]
-        trim_lens_catalog = full_lens_df.iloc[trim_idx_ellip].reset_index(drop=True)
+        return (galaxy_df['stellar_mass_bulge'].values/
+                galaxy_df['stellar_mass'].values) > 0.99
+
+    def candidate_filter(self, galaxy_df, ellipticals_only=False, min_redshift=None,
+                         exclude_ids=None):
+
+        """
+        A `CandidateFilter` with the elliptical, redshift and galaxy id cuts requested.
+        """
+
+        galaxy_filter = CandidateFilter(galaxy_df)
+        if min_redshift is not None:
+            galaxy_filter.require(lambda df: df['redshift_true'].values > min_redshift)
+        if ellipticals_only:
+            galaxy_filter.require(self.elliptical_mask)
+        if exclude_ids is not None:
+            galaxy_filter.exclude_ids(exclude_ids)
+
+        return galaxy_filter
+
+    def trim_catalog(self, full_lens_df):
+
+        trim_lens_catalog = self.candidate_filter(full_lens_df, ellipticals_only=True).apply()
 
         return trim_lens_catalog
 
-    def load_agn_catalog(self, agn_db_file, agn_trim_query):
+    def agn_where_clause(self, ra_range=None, dec_range=None, redshift_range=None):
+
+        """
+        Build a parameterized SQL `WHERE` clause from bounds on the AGN table.
+
+        Parameters
+        ----------
+
+        ra_range, dec_range, redshift_range: tuple, default=None
+        (min, max) exclusive bounds on `ra`, `dec` and `redshift`. Either end
+        can be None to leave it open.
+
+        Returns
+        -------
+
+        where_clause: str
+            Clause starting with ' WHERE ' or an empty string without bounds
+
+        where_params: list
+            Values for the `?` placeholders in `where_clause`
+        """
+
+        conditions = []
+        where_params = []
+        for col_name, col_range in [('ra', ra_range), ('dec', dec_range),
+                                    ('redshift', redshift_range)]:
+            if col_range is None:
+                continue
+            col_min, col_max = col_range
+            if col_min is not None:
+                conditions.append('"%s" > ?' % col_name)
+                where_params.append(float(col_min))
+            if col_max is not None:
+                conditions.append('"%s" < ?' % col_name)
+                where_params.append(float(col_max))
+
+        if len(conditions) == 0:
+            return '', where_params
+
+        return ' WHERE ' + ' AND '.join(conditions), where_params
+
+    def agn_position_index(self, conn):
 
+        """
+        Name of an index on `agn_params` that leads with `ra`, or None if the
+        table has no such index.
+        """
+
+        for index_row in conn.execute('PRAGMA index_list(agn_params)').fetchall():
+            index_name = index_row[1]
+            index_cols = [col_row[2] for col_row in
+                          conn.execute('PRAGMA index_info("%s")' % index_name)]
+            if len(index_cols) > 0 and index_cols[0] == 'ra':
+                return index_name
+
+        return None
+
+    def agn_query_plan(self, agn_db_file, ra_range=None, dec_range=None, redshift_range=None):
+
+        """
+        The sqlite `EXPLAIN QUERY PLAN` of the query `load_agn_catalog` runs.
+
+        Parameters
+        ----------
+
+        agn_db_file: str
+        Filename of the AGN sqlite database
+
+        ra_range, dec_range, redshift_range: tuple, default=None
+        (min, max) exclusive bounds as passed to `load_agn_catalog`
+
+        Returns
+        -------
+
+        plan: list of str
+            Detail of each step of the plan, e.g.
+            'SEARCH agn_params USING INDEX ix_agn_params_ra_dec (ra>? AND ra<?)'
+        """
+
+        where_clause, where_params = self.agn_where_clause(ra_range=ra_range,
+                                                           dec_range=dec_range,
+                                                           redshift_range=redshift_range)
         conn = sqlite3.connect(agn_db_file)
-        cur = conn.cursor()
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        try:
+            plan = conn.execute('EXPLAIN QUERY PLAN SELECT * FROM agn_params%s ORDER BY rowid' %
+                                where_clause, where_params).fetchall()
+        finally:
+            conn.close()
+
+        return [plan_row[-1] for plan_row in plan]
+
+    def load_agn_catalog(self, agn_db_file, agn_trim_query=None, ra_range=None,
+                         dec_range=None, redshift_range=None, columns=None,
+                         chunk_size=100000, create_index=False):
+
+        """
+        Load AGN from the `agn_params` table of the cosmoDC2 AGN database.
+
+        The ra, dec and redshift bounds are applied in sqlite so only the AGN
+        inside them are read into pandas, and rows are streamed in chunks.
+        With an index on `agn_params (ra, dec)` sqlite searches the index for
+        position bounds instead of scanning the whole table. Create it once with
+
+            CREATE INDEX ix_agn_params_ra_dec ON agn_params (ra, dec)
+
+        or pass `create_index=True`. Without it the bounds are applied by a full
+        table scan and a warning is given. `agn_query_plan` shows whether a
+        query uses the index. Rows are returned in table order either way.
+
+        Parameters
+        ----------
+
+        agn_db_file: str
+        Filename of the AGN sqlite database
+
+        agn_trim_query: str, default=None
+        Extra `DataFrame.query` selection applied to each chunk
+
+        ra_range, dec_range, redshift_range: tuple, default=None
+        (min, max) exclusive bounds. Either end can be None to leave it open.
+
+        columns: list of str, default=None
+        Columns to load. All columns are loaded if None.
+
+        chunk_size: int, default=100000
+        Number of rows read from sqlite at a time
+
+        create_index: bool, default=False
+        Create the (ra, dec) index if it is missing. Needs write access to
+        `agn_db_file`. If False the table is scanned when the index is missing.
+
+        Returns
+        -------
+
+        trim_agn_df: pandas dataframe
+            The selected AGN
+        """
+
+        where_clause, where_params = self.agn_where_clause(ra_range=ra_range,
+                                                           dec_range=dec_range,
+                                                           redshift_range=redshift_range)
+
+        conn = sqlite3.connect(agn_db_file)
+        try:
+            if (ra_range is not None or dec_range is not None) and \
+                    self.agn_position_index(conn) is None:
+                if create_index is True:
+                    print('Creating the (ra, dec) index on agn_params in %s' % agn_db_file)
+                    conn.execute('CREATE INDEX ix_agn_params_ra_dec ON agn_params (ra, dec)')
+                    conn.commit()
+                else:
+                    warnings.warn('agn_params in %s has no index on (ra, dec) so the ' % agn_db_file +
+                                  'position bounds scan the whole table. Create it with ' +
+                                  'CREATE INDEX ix_agn_params_ra_dec ON agn_params (ra, dec) ' +
+                                  'or pass create_index=True.')
+
+            table_columns = [row[1] for row in
+                             conn.execute('PRAGMA table_info(agn_params)')]
+            if columns is None:
+                col_str = '*'
+                columns = table_columns
+            else:
+                missing = [col_name for col_name in columns if col_name not in table_columns]
+                if len(missing) > 0:
+                    raise ValueError('Columns %s are not in agn_params' % str(missing))
+                col_str = ', '.join('"%s"' % col_name for col_name in columns)
+
+            # Searching the index returns rows in (ra, dec) order so sort
+            # back to table order to match a full scan
+            agn_chunks = []
+            for agn_chunk in pd.read_sql_query('SELECT %s FROM agn_params%s ORDER BY rowid' %
+                                               (col_str, where_clause),
+                                               conn, params=where_params, chunksize=chunk_size):
+                if agn_trim_query is not None:
+                    agn_chunk = agn_chunk.query(agn_trim_query)
+                agn_chunks.append(agn_chunk)
+        finally:
+            conn.close()
+
+        if len(agn_chunks) == 0:
+            return pd.DataFrame([], columns=columns)
 
-        agn_df = pd.read_sql_query("SELECT * FROM agn_params", conn)
-        trim_agn_df = agn_df.query(agn_trim_query).reset_index(drop=True)
+        trim_agn_df = pd.concat(agn_chunks, ignore_index=True)
 
         return trim_agn_df
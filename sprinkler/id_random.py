@@ -0,0 +1,238 @@
+"""
+Counter-based random numbers keyed on catalog IDs
+"""
+
+import numpy as np
+
+__all__ = ['philox4x32', 'id_uniform', 'id_normal', 'SystemRandomStream']
+
+# Philox4x32 multipliers and Weyl key increments from Salmon et al. 2011
+_PHILOX_M0 = np.uint64(0xD2511F53)
+_PHILOX_M1 = np.uint64(0xCD9E8D57)
+_PHILOX_W0 = np.uint32(0x9E3779B9)
+_PHILOX_W1 = np.uint32(0xBB67AE85)
+_LOW_32 = np.uint64(0xFFFFFFFF)
+_SHIFT_32 = np.uint64(32)
+
+
+def philox4x32(counter, key, rounds=10):
+
+    """
+    Philox4x32 counter-based bijection (Salmon et al. 2011) evaluated
+    elementwise over arrays of counters and keys.
+
+    Parameters
+    ----------
+
+    counter: tuple of four array-like
+    The four 32-bit words of the counter
+
+    key: tuple of two array-like
+    The two 32-bit words of the key
+
+    rounds: int, default=10
+    Number of Philox rounds
+
+    Returns
+    -------
+
+    words: tuple of four numpy.ndarray
+        The four uint32 output words, broadcast to a common shape
+    """
+
+    c_0, c_1, c_2, c_3 = [np.atleast_1d(np.asarray(c, dtype=np.uint32)) for c in counter]
+    k_0, k_1 = [np.atleast_1d(np.asarray(k, dtype=np.uint32)) for k in key]
+
+    for round_num in range(rounds):
+        if round_num > 0:
+            k_0 = k_0 + _PHILOX_W0
+            k_1 = k_1 + _PHILOX_W1
+        prod_0 = _PHILOX_M0 * c_0.astype(np.uint64)
+        prod_1 = _PHILOX_M1 * c_2.astype(np.uint64)
+        hi_0 = (prod_0 >> _SHIFT_32).astype(np.uint32)
+        lo_0 = (prod_0 & _LOW_32).astype(np.uint32)
+        hi_1 = (prod_1 >> _SHIFT_32).astype(np.uint32)
+        lo_1 = (prod_1 & _LOW_32).astype(np.uint32)
+        c_0, c_1, c_2, c_3 = hi_1 ^ c_1 ^ k_0, lo_1, hi_0 ^ c_3 ^ k_1, lo_0
+
+    return c_0, c_1, c_2, c_3
+
+
+def _id_words(ids, draw, stream):
+
+    ids = np.atleast_1d(np.asarray(ids)).astype(np.int64).view(np.uint64)
+    key = ((ids & _LOW_32).astype(np.uint32), (ids >> _SHIFT_32).astype(np.uint32))
+    counter = (np.full(len(ids), draw, dtype=np.uint32),
+               np.full(len(ids), stream, dtype=np.uint32),
+               np.zeros(len(ids), dtype=np.uint32),
+               np.zeros(len(ids), dtype=np.uint32))
+
+    return philox4x32(counter, key)
+
+
+def _words_to_uniform(word_a, word_b):
+
+    # Same 53-bit construction numpy uses to build doubles from 32-bit words
+    return ((word_a >> np.uint32(5)).astype(np.float64) * 67108864. +
+            (word_b >> np.uint32(6)).astype(np.float64)) / 9007199254740992.
+
+
+def id_uniform(ids, draw=0, stream=0):
+
+    """
+    Uniform random numbers in [0, 1) with one value per ID.
+
+    The value for an ID depends only on the ID, `draw` and `stream` so it is the
+    same no matter how a catalog is ordered, subset or split between processes.
+
+    Parameters
+    ----------
+
+    ids: array-like of ints
+    Catalog IDs used as the Philox key
+
+    draw: int, default=0
+    Index of the draw for each ID
+
+    stream: int, default=0
+    Independent stream number so different uses of the same IDs do not correlate
+
+    Returns
+    -------
+
+    uniform: numpy.ndarray
+        Uniform deviates in the same order as `ids`
+    """
+
+    word_0, word_1, _, _ = _id_words(ids, draw, stream)
+
+    return _words_to_uniform(word_0, word_1)
+
+
+def id_normal(ids, draw=0, stream=0):
+
+    """
+    Standard normal random numbers with one value per ID, generated with the
+    Box-Muller transform from a single Philox block.
+
+    Parameters
+    ----------
+
+    ids: array-like of ints
+    Catalog IDs used as the Philox key
+
+    draw: int, default=0
+    Index of the draw for each ID
+
+    stream: int, default=0
+    Independent stream number so different uses of the same IDs do not correlate
+
+    Returns
+    -------
+
+    normal: numpy.ndarray
+        Normal deviates in the same order as `ids`
+    """
+
+    word_0, word_1, word_2, word_3 = _id_words(ids, draw, stream)
+    u_1 = _words_to_uniform(word_0, word_1)
+    u_2 = _words_to_uniform(word_2, word_3)
+
+    return np.sqrt(-2. * np.log1p(-u_1)) * np.cos(2. * np.pi * u_2)
+
+
+class SystemRandomStream():
+
+    """
+    Per-system random draws for the lens and host matchers.
+
+    In `philox` mode the draws come from a counter-based generator keyed on the
+    system ID so the match probabilities for a whole catalog are made in one
+    array operation. In `legacy` mode every draw comes from a
+    `np.random.RandomState(system_id)` exactly as the matchers originally did.
+
+    Parameters
+    ----------
+
+    system_ids: array-like of ints
+    Lens catalog system IDs in catalog order
+
+    rng_mode: str, default='legacy'
+    Either 'legacy' or 'philox'
+
+    stream: int, default=0
+    Philox stream number. Ignored in legacy mode.
+    """
+
+    def __init__(self, system_ids, rng_mode='legacy', stream=0):
+
+        if rng_mode not in ('legacy', 'philox'):
+            raise ValueError("rng_mode must be 'legacy' or 'philox', not %s" % rng_mode)
+
+        self.system_ids = np.asarray(system_ids)
+        self.rng_mode = rng_mode
+        self.stream = stream
+        # Number of uniform draws already made for every system
+        self._n_draws = 0
+
+    def __len__(self):
+
+        return len(self.system_ids)
+
+    def _legacy_state(self, i):
+
+        rand_state = np.random.RandomState(self.system_ids[i])
+        if self._n_draws > 0:
+            rand_state.uniform(size=self._n_draws)
+
+        return rand_state
+
+    def uniform(self):
+
+        """
+        Draw the next uniform deviate for every system.
+
+        Returns
+        -------
+
+        uniform: numpy.ndarray
+            One value in [0, 1) for each system in catalog order
+        """
+
+        if self.rng_mode == 'philox':
+            uniform = id_uniform(self.system_ids, draw=self._n_draws, stream=self.stream)
+        else:
+            uniform = np.array([self._legacy_state(i).uniform() for i in range(len(self))],
+                               dtype=np.float64)
+        self._n_draws += 1
+
+        return uniform
+
+    def choice(self, i, candidates):
+
+        """
+        Pick one of `candidates` at random for system `i` using the draw that
+        follows the uniform deviates already taken with `uniform`.
+
+        Parameters
+        ----------
+
+        i: int
+        Row of the system in `system_ids`
+
+        candidates: numpy.ndarray
+        Candidate galaxy indices to pick from
+
+        Returns
+        -------
+
+        chosen: int
+            The chosen entry of `candidates`
+        """
+
+        if self.rng_mode == 'philox':
+            u_choice = id_uniform(self.system_ids[i], draw=self._n_draws,
+                                  stream=self.stream)[0]
+            return candidates[min(int(u_choice * len(candidates)), len(candidates) - 1)]
+
+        return self._legacy_state(i).choice(candidates)
@@ -4,9 +4,105 @@ Readers for strongly lensed systems
 
 import numpy as np
 import pandas as pd
+from collections.abc import Mapping
 from astropy.io import fits
 
-__all__ = ['OM10Reader', 'GoldsteinSNeCatReader']
+__all__ = ['OM10Reader', 'OM10Catalog', 'GoldsteinSNeCatReader', 'image_slot_columns']
+
+
+def native_byteorder(cat_vals):
+
+    """
+    Return `cat_vals` in native byte order. Arrays that are already native
+    (or have no byte order) are returned as they are without a copy.
+    """
+
+    if cat_vals.dtype.isnative:
+        return cat_vals
+
+    return cat_vals.astype(cat_vals.dtype.newbyteorder('='))
+
+
+def image_slot_columns(key, n_max):
+
+    """
+    Names of the dense dataframe columns `<key>_0` ... `<key>_<n_max - 1>`
+    that hold an image quantity with one column per image slot.
+    """
+
+    return ['%s_%i' % (key, img_num) for img_num in range(n_max)]
+
+
+class OM10Catalog(Mapping):
+
+    """
+    Lazy view of a memory-mapped OM10 catalog keyed like `OM10Reader.config`.
+
+    Opening the catalog reads only the FITS header. A column is read from the
+    memory-mapped table the first time it is accessed and, since FITS data
+    are big-endian, converted to native byte order once and cached. The image
+    columns (`x_img`, `y_img`, `t_delay_img`, `magnification_img`) are dense
+    2-D arrays with one row per system where only the first `n_img` entries
+    of each row are images.
+
+    Parameters
+    ----------
+
+    hdu_list: astropy.io.fits.HDUList
+    Open FITS file with the OM10 table in the first extension
+
+    config: dict
+    Catalog keys mapped to FITS column names
+    """
+
+    def __init__(self, hdu_list, config):
+
+        self.hdu_list = hdu_list
+        self.config = config
+        self._columns = {}
+
+    @property
+    def data(self):
+
+        """
+        The memory-mapped FITS table.
+        """
+
+        return self.hdu_list[1].data
+
+    def __getitem__(self, key):
+
+        if key not in self._columns:
+            self._columns[key] = native_byteorder(self.data[self.config[key]])
+
+        return self._columns[key]
+
+    def __iter__(self):
+
+        return iter(self.config)
+
+    def __len__(self):
+
+        return len(self.config)
+
+    @property
+    def n_systems(self):
+
+        """
+        Number of lens systems in the catalog.
+        """
+
+        return self.hdu_list[1].header['NAXIS2']
+
+    def close(self):
+
+        """
+        Drop the cached columns and close the FITS file.
+        """
+
+        self._columns = {}
+        self.hdu_list.close()
+
 
 class OM10Reader():
 
@@ -45,14 +141,34 @@ class OM10Reader():
             'phi_gamma':'PHIG'
         }
 
-    def load_catalog(self):
+    def load_catalog(self, memmap=False):
+
+        """
+        Load the OM10 catalog.
+
+        Parameters
+        ----------
+
+        memmap: bool, default=False
+        Return an `OM10Catalog` backed by the memory-mapped FITS table instead
+        of reading every column. Image columns then stay dense 2-D arrays.
+
+        Returns
+        -------
+
+        lensed_agn_cat: dict or OM10Catalog
+            Catalog columns keyed as in `self.config`. With `memmap=False` the
+            image columns are lists with one array per system.
+        """
+
+        if memmap is True:
+            return OM10Catalog(fits.open(self.filename, memmap=True), self.config)
 
         om10_cat = fits.open(self.filename)[1]
         lensed_agn_cat = {}
 
         for key, val in self.config.items():
-            cat_vals = om10_cat.data[val]
-            cat_vals = cat_vals.byteswap().newbyteorder()
+            cat_vals = native_byteorder(om10_cat.data[val])
             if len(np.shape(cat_vals)) == 1:
                 lensed_agn_cat[key] = cat_vals
             else:
@@ -62,6 +178,18 @@ class OM10Reader():
 
 class GoldsteinSNeCatReader():
 
+    """
+    Reader for the Goldstein et al. lensed SNe catalog stored as HDF5 tables
+    of systems and of images.
+    """
+
+    image_columns = {'x_img': 'x', 'y_img': 'y',
+                     't_delay_img': 'td', 'magnification_img': 'mu'}
+
+    magnorm_columns = ['lensgal_magnorm_u', 'lensgal_magnorm_g',
+                       'lensgal_magnorm_r', 'lensgal_magnorm_i',
+                       'lensgal_magnorm_z', 'lensgal_magnorm_y']
+
     def __init__(self, filename):
 
         self.filename = filename
@@ -113,18 +241,164 @@ class GoldsteinSNeCatReader():
 
     def merge_magnorms(self, df_merged):
 
-        lensgal_magnorm = df_merged[['lensgal_magnorm_u',
-                                     'lensgal_magnorm_g',
-                                     'lensgal_magnorm_r',
-                                     'lensgal_magnorm_i',
-                                     'lensgal_magnorm_z',
-                                     'lensgal_magnorm_y']].values
-        
+        lensgal_magnorm = df_merged[self.magnorm_columns].values
+
         df_merged['magnorm_lens'] = list(lensgal_magnorm)
 
         return df_merged
 
-    def load_catalog(self):
+    def image_arrays(self, df_img):
+
+        """
+        Pivot the image table into dense arrays with one row per system.
+
+        Parameters
+        ----------
+
+        df_img: pandas dataframe
+        Image table with one row per image
+
+        Returns
+        -------
+
+        sysno: numpy.ndarray
+            System number of each row
+
+        img_mask: numpy.ndarray
+            (n_sys, n_max) boolean array that is True for the real images
+
+        img_arrays: dict
+            (n_sys, n_max) float arrays keyed like `image_columns`. Entries
+            past the last image of a system are NaN.
+        """
+
+        img_pivot = df_img.pivot(index='sysno', columns='imno')
+        img_mask = ~np.isnan(img_pivot['td'].to_numpy(dtype=np.float64))
+        img_arrays = {key: np.ascontiguousarray(img_pivot[val].to_numpy(dtype=np.float64))
+                      for key, val in self.image_columns.items()}
+
+        return img_pivot.index.values, img_mask, img_arrays
+
+    def align_images(self, df_sys, df_img):
+
+        """
+        Dense image arrays in the row order of the system table.
+
+        Systems without images are dropped, giving the same rows and order
+        as the inner merge in `merge_catalog`.
+
+        Parameters
+        ----------
+
+        df_sys: pandas dataframe
+        System table with one row per system
+
+        df_img: pandas dataframe
+        Image table with one row per image
+
+        Returns
+        -------
+
+        df_sys: pandas dataframe
+            The systems that have images
+
+        img_mask: numpy.ndarray
+            (n_sys, n_max) boolean array that is True for the real images
+
+        img_arrays: dict
+            (n_sys, n_max) float arrays keyed like `image_columns`
+        """
+
+        sysno, img_mask, img_arrays = self.image_arrays(df_img)
+        img_row = pd.Index(sysno).get_indexer(df_sys['sysno'].values)
+        keep = np.where(img_row >= 0)[0]
+        img_row = img_row[keep]
+
+        return (df_sys.iloc[keep], img_mask[img_row],
+                {key: img_vals[img_row] for key, img_vals in img_arrays.items()})
+
+    def merge_dense_catalog(self, df_sys, df_img):
+
+        """
+        Merge the system and image tables like `merge_catalog` but keep the
+        image quantities dense.
+
+        Each image column of `image_columns` becomes one float column per
+        image slot named by `image_slot_columns`, e.g. `x_img_0`, `x_img_1`,
+        ..., that is NaN past the last image of a system. No per-system
+        arrays are created.
+
+        Returns
+        -------
+
+        df_merged: pandas dataframe
+        """
+
+        df_merged, img_mask, img_arrays = self.align_images(df_sys, df_img)
+
+        dense_cols = {'n_img': np.sum(img_mask, axis=1)}
+        for key, img_vals in img_arrays.items():
+            for col_name, col_vals in zip(image_slot_columns(key, img_vals.shape[1]), img_vals.T):
+                dense_cols[col_name] = col_vals
+
+        return pd.concat([df_merged.reset_index(drop=True), pd.DataFrame(dense_cols)], axis=1)
+
+    def load_dense_catalog(self):
+
+        """
+        Load the catalog with the per-image quantities as dense arrays.
+
+        The keys are the same as `load_catalog` with two differences. The image
+        columns are (n_sys, n_max) float arrays with `img_mask` marking the
+        real images, and `magnorm_lens` is an (n_sys, 6) float array of the
+        lens magnorms in ugrizy. Every other key is a numpy array.
+
+        Returns
+        -------
+
+        lensed_sne_cat: dict
+        """
+
+        sne_systems = pd.read_hdf(self.filename, key='system')
+        sne_images = pd.read_hdf(self.filename, key='image')
+
+        sne_systems, img_mask, img_arrays = self.align_images(sne_systems, sne_images)
+
+        lensed_sne_cat = {}
+        for key, val in self.config.items():
+            if key == 'n_img':
+                lensed_sne_cat[key] = np.sum(img_mask, axis=1)
+            elif key in self.image_columns:
+                lensed_sne_cat[key] = img_arrays[key]
+            elif key == 'magnorm_lens':
+                lensed_sne_cat[key] = sne_systems[self.magnorm_columns].to_numpy(dtype=np.float64)
+            else:
+                lensed_sne_cat[key] = sne_systems[val].values
+        lensed_sne_cat['img_mask'] = img_mask
+
+        return lensed_sne_cat
+
+    def load_catalog(self, dense=False):
+
+        """
+        Load the lensed SNe catalog.
+
+        Parameters
+        ----------
+
+        dense: bool, default=False
+        Return the dense array layout of `load_dense_catalog`
+
+        Returns
+        -------
+
+        lensed_sne_cat: dict
+            Catalog columns keyed as in `self.config`. With `dense=False` the
+            image columns and lens magnorms hold one array per system.
+        """
+
+        if dense is True:
+            return self.load_dense_catalog()
 
         sne_systems = pd.read_hdf(self.filename, key='system')
         sne_images = pd.read_hdf(self.filename, key='image')
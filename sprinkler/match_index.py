@@ -0,0 +1,379 @@
+"""
+Indices over candidate galaxies used when matching to lens catalogs
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_bipartite_matching
+
+__all__ = ['LensCandidateIndex', 'HostRedshiftIndex', 'ClaimedMask', 'bipartite_assignment']
+
+
+class LensCandidateIndex():
+
+    """
+    Sorted 2-D grid of bins over (log10 velocity dispersion, log10 redshift)
+    for the cosmoDC2 galaxies that are potential lenses.
+
+    The grid is built once and each query only visits the 3x3 block of bins
+    around the queried point instead of scanning every candidate.
+
+    Parameters
+    ----------
+
+    vel_disp: numpy.ndarray
+    Velocity dispersion (km/s) values for each cosmoDC2 galaxy that is a potential lens galaxy
+
+    redshift: numpy.ndarray
+    Redshifts of potential lens galaxies from cosmoDC2
+
+    tolerance: float, default=0.03
+    Maximum separation in dex allowed in each parameter for a match
+    """
+
+    def __init__(self, vel_disp, redshift, tolerance=0.03):
+
+        self.tolerance = tolerance
+        # Keep the input dtypes so the matching criterion is evaluated with
+        # exactly the same arithmetic as a brute force scan.
+        self.log_vel_disp = np.log10(np.asarray(vel_disp))
+        self.log_redshift = np.log10(np.asarray(redshift))
+
+        # Make the bins slightly wider than the tolerance so that floating point
+        # rounding (even for float32 inputs) can never push a galaxy within
+        # tolerance of a query point more than one bin away from it.
+        self._bin_width = tolerance * 1.001
+
+        sigma_bin = self._bin_index(self.log_vel_disp)
+        z_bin = self._bin_index(self.log_redshift)
+
+        self._sigma_bin_min = np.min(sigma_bin) if len(sigma_bin) > 0 else 0
+        self._z_bin_min = np.min(z_bin) if len(z_bin) > 0 else 0
+        # Leave a spare bin on each side of the redshift axis so that
+        # neighbouring sigma rows never overlap in the flattened keys.
+        self._n_z_bins = (np.max(z_bin) - self._z_bin_min + 3) if len(z_bin) > 0 else 1
+
+        keys = self._flat_key(sigma_bin, z_bin)
+        # A stable sort keeps galaxies inside each bin in catalog order
+        self._order = np.argsort(keys, kind='stable')
+        self._sorted_keys = keys[self._order]
+
+    def __len__(self):
+
+        return len(self.log_vel_disp)
+
+    def _bin_index(self, log_vals):
+
+        return np.floor(log_vals / self._bin_width).astype(np.int64)
+
+    def _flat_key(self, sigma_bin, z_bin):
+
+        return ((sigma_bin - self._sigma_bin_min) * self._n_z_bins +
+                (z_bin - self._z_bin_min + 1))
+
+    def query(self, log_lens_sigma, log_lens_z):
+
+        """
+        Find the candidate galaxies within `tolerance` dex of a lens system in
+        both log velocity dispersion and log redshift.
+
+        Parameters
+        ----------
+
+        log_lens_sigma: float
+        log10 of the lens system velocity dispersion (km/s)
+
+        log_lens_z: float
+        log10 of the lens system redshift
+
+        Returns
+        -------
+
+        match_idx: numpy.ndarray
+            Indices of the matching galaxies in ascending order. This is the same
+            output as the equivalent `np.where` over the full candidate arrays.
+        """
+
+        if len(self) == 0:
+            return np.array([], dtype=np.int64)
+
+        sigma_bin = self._bin_index(log_lens_sigma)
+        z_bin = self._bin_index(log_lens_z)
+
+        # Clip the redshift bins to the padded range covered by the grid
+        # so keys from one sigma row cannot spill into the next one.
+        z_lo = max(z_bin - 1, self._z_bin_min - 1)
+        z_hi = min(z_bin + 1, self._z_bin_min + self._n_z_bins - 2)
+        if z_lo > z_hi:
+            return np.array([], dtype=np.int64)
+
+        candidates = []
+        for row in range(sigma_bin - 1, sigma_bin + 2):
+            key_lo = self._flat_key(row, z_lo)
+            key_hi = self._flat_key(row, z_hi)
+            start = np.searchsorted(self._sorted_keys, key_lo, side='left')
+            end = np.searchsorted(self._sorted_keys, key_hi, side='right')
+            if end > start:
+                candidates.append(self._order[start:end])
+
+        if len(candidates) == 0:
+            return np.array([], dtype=np.int64)
+
+        candidates = np.concatenate(candidates)
+        # Apply the exact matching criterion to the candidates in the nearby bins
+        keep = ((np.abs(log_lens_sigma - self.log_vel_disp[candidates]) < self.tolerance) &
+                (np.abs(log_lens_z - self.log_redshift[candidates]) < self.tolerance))
+
+        return np.sort(candidates[keep])
+
+    def query_pairs(self, log_lens_sigma, log_lens_z):
+
+        """
+        Find all (lens system, candidate galaxy) pairs within `tolerance` dex
+        for many lens systems at once.
+
+        Parameters
+        ----------
+
+        log_lens_sigma: numpy.ndarray
+        log10 of the lens system velocity dispersions (km/s)
+
+        log_lens_z: numpy.ndarray
+        log10 of the lens system redshifts
+
+        Returns
+        -------
+
+        query_idx: numpy.ndarray
+            Position of the lens system in the input arrays for each pair
+
+        match_idx: numpy.ndarray
+            Index of the matching galaxy for each pair. Pairs are grouped by
+            `query_idx` in ascending order. Within a system they are not sorted
+            but are the same galaxies `query` returns.
+        """
+
+        log_lens_sigma = np.atleast_1d(log_lens_sigma)
+        log_lens_z = np.atleast_1d(log_lens_z)
+        if (len(self) == 0) or (len(log_lens_sigma) == 0):
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+        sigma_bin = self._bin_index(log_lens_sigma)
+        z_bin = self._bin_index(log_lens_z)
+        z_lo = np.maximum(z_bin - 1, self._z_bin_min - 1)
+        z_hi = np.minimum(z_bin + 1, self._z_bin_min + self._n_z_bins - 2)
+
+        # One contiguous range of the sorted keys per system and sigma row
+        query_idx = np.repeat(np.arange(len(sigma_bin)), 3)
+        row = np.repeat(sigma_bin, 3) + np.tile(np.arange(-1, 2), len(sigma_bin))
+        start = np.searchsorted(self._sorted_keys, self._flat_key(row, z_lo[query_idx]),
+                                side='left')
+        end = np.searchsorted(self._sorted_keys, self._flat_key(row, z_hi[query_idx]),
+                              side='right')
+        n_range = np.where(z_lo[query_idx] <= z_hi[query_idx], np.maximum(end - start, 0), 0)
+
+        range_offset = np.cumsum(n_range) - n_range
+        sorted_pos = (np.repeat(start - range_offset, n_range) +
+                      np.arange(np.sum(n_range), dtype=np.int64))
+        query_idx = np.repeat(query_idx, n_range)
+        candidates = self._order[sorted_pos]
+
+        keep = ((np.abs(log_lens_sigma[query_idx] - self.log_vel_disp[candidates]) < self.tolerance) &
+                (np.abs(log_lens_z[query_idx] - self.log_redshift[candidates]) < self.tolerance))
+
+        return query_idx[keep], candidates[keep]
+
+
+class HostRedshiftIndex():
+
+    """
+    Potential host galaxies sorted by log10 redshift with a second matching
+    quantity stored in an aligned contiguous array.
+
+    A query binary searches the redshift window around a lens system and only
+    tests the second criterion inside it, so its cost scales with the number
+    of hosts in the window instead of the whole pool.
+
+    Parameters
+    ----------
+
+    redshift: numpy.ndarray
+    Redshifts of the potential host galaxies
+
+    match_values: numpy.ndarray
+    Second quantity a host must match, e.g. AGN i-band magnitude or log10 size
+
+    z_tolerance: float, default=0.05
+    Maximum separation in dex allowed in redshift
+
+    match_tolerance: float, default=0.05
+    Maximum separation allowed in `match_values`
+    """
+
+    def __init__(self, redshift, match_values, z_tolerance=0.05, match_tolerance=0.05):
+
+        self.z_tolerance = z_tolerance
+        self.match_tolerance = match_tolerance
+
+        # Keep the input dtypes so the criteria give the same result as a
+        # brute force scan over the unsorted arrays.
+        log_redshift = np.log10(np.asarray(redshift))
+        self._order = np.argsort(log_redshift, kind='stable')
+        self.log_redshift = np.ascontiguousarray(log_redshift[self._order])
+        self.match_values = np.ascontiguousarray(np.asarray(match_values)[self._order])
+
+    def __len__(self):
+
+        return len(self.log_redshift)
+
+    def query(self, log_z, match_value):
+
+        """
+        Find the hosts within tolerance of a lens system.
+
+        Parameters
+        ----------
+
+        log_z: float
+        log10 of the source redshift of the lens system
+
+        match_value: float
+        Value of the second matching quantity for the lens system
+
+        Returns
+        -------
+
+        match_idx: numpy.ndarray
+            Indices of the matching hosts in ascending order. This is the same
+            output as the equivalent `np.where` over the full host arrays.
+        """
+
+        # Pad the search window slightly so rounding can never drop a host
+        # that passes the exact criterion below
+        window = self.z_tolerance * 1.001
+        start = np.searchsorted(self.log_redshift, log_z - window, side='left')
+        end = np.searchsorted(self.log_redshift, log_z + window, side='right')
+
+        keep = ((np.abs(self.log_redshift[start:end] - log_z) < self.z_tolerance) &
+                (np.abs(self.match_values[start:end] - match_value) < self.match_tolerance))
+
+        return np.sort(self._order[start:end][keep])
+
+
+def bipartite_assignment(sys_idx, gal_idx, n_systems, n_galaxies, seed=0):
+
+    """
+    Maximum cardinality matching between lens systems and candidate galaxies.
+
+    Every system gets at most one galaxy and every galaxy at most one system,
+    and no other assignment of the same candidate pairs matches more systems.
+    The systems and galaxies are shuffled before the Hopcroft-Karp solve so
+    the choice between equally large matchings is random but fixed by `seed`.
+
+    Parameters
+    ----------
+
+    sys_idx: numpy.ndarray
+    Lens system index of each allowed pair
+
+    gal_idx: numpy.ndarray
+    Candidate galaxy index of each allowed pair
+
+    n_systems: int
+    Number of lens systems
+
+    n_galaxies: int
+    Number of candidate galaxies
+
+    seed: int, default=0
+    Seed of the shuffle that breaks ties between matchings
+
+    Returns
+    -------
+
+    matched_sys: numpy.ndarray
+        Indices of the matched systems in ascending order
+
+    matched_gal: numpy.ndarray
+        Galaxy assigned to each of `matched_sys`
+    """
+
+    sys_idx = np.asarray(sys_idx, dtype=np.int64)
+    gal_idx = np.asarray(gal_idx, dtype=np.int64)
+    if len(sys_idx) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    rand_state = np.random.RandomState(seed)
+    sys_perm = rand_state.permutation(n_systems)
+    gal_perm = rand_state.permutation(n_galaxies)
+
+    graph = csr_matrix((np.ones(len(sys_idx), dtype=np.int8),
+                        (sys_perm[sys_idx], gal_perm[gal_idx])),
+                       shape=(n_systems, n_galaxies))
+    graph.sum_duplicates()
+    row_matched = maximum_bipartite_matching(graph, perm_type='column')
+
+    matched_sys = np.where(row_matched[sys_perm] >= 0)[0]
+    gal_inverse = np.empty(n_galaxies, dtype=np.int64)
+    gal_inverse[gal_perm] = np.arange(n_galaxies)
+    matched_gal = gal_inverse[row_matched[sys_perm[matched_sys]]]
+
+    return matched_sys, matched_gal
+
+
+class ClaimedMask():
+
+    """
+    Boolean mask over a pool of candidate galaxies recording which of them
+    have already been assigned to a lens catalog system.
+
+    Parameters
+    ----------
+
+    n_candidates: int
+    Number of galaxies in the candidate pool
+    """
+
+    def __init__(self, n_candidates):
+
+        self.mask = np.zeros(n_candidates, dtype=bool)
+
+    def __len__(self):
+
+        return int(np.sum(self.mask))
+
+    def unclaimed(self, idx):
+
+        """
+        Remove the already claimed galaxies from an array of candidate indices.
+
+        Parameters
+        ----------
+
+        idx: numpy.ndarray
+        Indices into the candidate pool
+
+        Returns
+        -------
+
+        keep_idx: numpy.ndarray
+            The entries of `idx` that have not been claimed yet, in the same order
+        """
+
+        idx = np.asarray(idx, dtype=np.int64)
+
+        return idx[~self.mask[idx]]
+
+    def claim(self, idx):
+
+        """
+        Mark one or more galaxies in the candidate pool as used.
+
+        Parameters
+        ----------
+
+        idx: int or numpy.ndarray
+        Indices into the candidate pool
+        """
+
+        self.mask[idx] = True
@@ -0,0 +1,761 @@
+"""
+Cached SEDs and photometry helpers for the truth catalogs
+"""
+
+import os
+import json
+import hashlib
+import inspect
+from collections import OrderedDict
+from copy import deepcopy
+import numpy as np
+from lsst.sims.photUtils import Sed, Bandpass, BandpassDict, getImsimFluxNorm
+
+__all__ = ['sed_file_name', 'SedCache', 'get_sed_cache', 'BandpassRegistry',
+           'get_bandpass_registry', 'PhotometryEngine', 'FluxGrid', 'FluxLookup']
+
+
+def sed_file_name(sed_name):
+
+    """
+    SED filename relative to `SIMS_SED_LIBRARY_DIR` as a str.
+
+    The cosmoDC2 SED lookup tables store names as bytes and CSV round trips turn
+    those into their repr, e.g. "b'galaxySED/Burst.gz'". Both forms and plain
+    strings are accepted.
+
+    Parameters
+    ----------
+
+    sed_name: str or bytes
+    SED name in any of the forms above
+
+    Returns
+    -------
+
+    sed_name: str
+    """
+
+    if isinstance(sed_name, bytes):
+        return sed_name.decode('utf-8')
+    if sed_name.startswith("b'") and sed_name.endswith("'"):
+        return sed_name[2:-1]
+
+    return sed_name
+
+
+class SedCache():
+
+    """
+    Bounded least recently used caches for SEDs read from `SIMS_SED_LIBRARY_DIR`.
+
+    The first cache holds each parsed `Sed` together with its CCM a(x), b(x)
+    keyed on the SED name. The second holds the same SEDs redshifted (with
+    dimming) keyed on (SED name, redshift). Cached objects are shared, so
+    callers must copy them before changing them.
+
+    Parameters
+    ----------
+
+    max_seds: int, default=256
+    Maximum number of parsed SEDs to keep
+
+    max_redshifted: int, default=512
+    Maximum number of redshifted SEDs to keep
+
+    sed_dir: str, default=None
+    Directory the SED names are relative to. Defaults to `SIMS_SED_LIBRARY_DIR`.
+    """
+
+    def __init__(self, max_seds=256, max_redshifted=512, sed_dir=None):
+
+        self.max_seds = max_seds
+        self.max_redshifted = max_redshifted
+        self.sed_dir = sed_dir
+
+        self._seds = OrderedDict()
+        self._redshifted = OrderedDict()
+        self.hits = {'sed': 0, 'redshifted': 0}
+        self.misses = {'sed': 0, 'redshifted': 0}
+
+    def _lookup(self, cache, key, kind):
+
+        if key in cache:
+            cache.move_to_end(key)
+            self.hits[kind] += 1
+            return cache[key]
+
+        self.misses[kind] += 1
+        return None
+
+    def _store(self, cache, key, value, max_size):
+
+        cache[key] = value
+        if len(cache) > max_size:
+            cache.popitem(last=False)
+
+    def get_sed(self, sed_name):
+
+        """
+        Parsed SED and its CCM extinction coefficients.
+
+        Parameters
+        ----------
+
+        sed_name: str
+        SED filename relative to the SED library directory
+
+        Returns
+        -------
+
+        sed_obj: lsst.sims.photUtils.Sed
+            The rest frame SED with `fnu` already calculated
+
+        a_x, b_x: numpy.ndarray
+            CCM extinction coefficients on the rest frame wavelength grid
+        """
+
+        entry = self._lookup(self._seds, sed_name, 'sed')
+        if entry is None:
+            sed_dir = self.sed_dir
+            if sed_dir is None:
+                sed_dir = os.environ['SIMS_SED_LIBRARY_DIR']
+            sed_obj = Sed()
+            sed_obj.readSED_flambda(os.path.join(sed_dir, sed_name))
+            a_x, b_x = sed_obj.setupCCM_ab()
+            sed_obj.flambdaTofnu()
+            entry = (sed_obj, a_x, b_x)
+            self._store(self._seds, sed_name, entry, self.max_seds)
+
+        return entry
+
+    def get_redshifted_sed(self, sed_name, redshift):
+
+        """
+        SED redshifted with cosmological dimming and no flux normalization.
+
+        Parameters
+        ----------
+
+        sed_name: str
+        SED filename relative to the SED library directory
+
+        redshift: float
+        Redshift of the object
+
+        Returns
+        -------
+
+        sed_obj: lsst.sims.photUtils.Sed
+            The redshifted SED
+        """
+
+        key = (sed_name, float(redshift))
+        sed_z = self._lookup(self._redshifted, key, 'redshifted')
+        if sed_z is None:
+            sed_obj, a_x, b_x = self.get_sed(sed_name)
+            sed_z = deepcopy(sed_obj)
+            sed_z.redshiftSED(redshift, dimming=True)
+            sed_z.flambdaTofnu()
+            self._store(self._redshifted, key, sed_z, self.max_redshifted)
+
+        return sed_z
+
+    def cache_info(self):
+
+        """
+        Hit and miss counts and current sizes of both caches.
+        """
+
+        return {'sed_hits': self.hits['sed'], 'sed_misses': self.misses['sed'],
+                'sed_size': len(self._seds),
+                'redshifted_hits': self.hits['redshifted'],
+                'redshifted_misses': self.misses['redshifted'],
+                'redshifted_size': len(self._redshifted)}
+
+    def clear(self):
+
+        self._seds.clear()
+        self._redshifted.clear()
+        self.hits = {'sed': 0, 'redshifted': 0}
+        self.misses = {'sed': 0, 'redshifted': 0}
+
+
+_sed_cache = None
+
+
+def get_sed_cache():
+
+    """
+    The SED cache shared by everything in this process. It is created on first use.
+    """
+
+    global _sed_cache
+    if _sed_cache is None:
+        _sed_cache = SedCache()
+
+    return _sed_cache
+
+
+class BandpassRegistry():
+
+    """
+    The LSST total bandpasses and the imsim normalization bandpass, each read
+    the first time they are needed.
+
+    The wavelength grid and phi array of the LSST bandpasses are kept as
+    contiguous read only arrays that every photometry calculation shares.
+    """
+
+    def __init__(self):
+
+        self._lsst_bandpasses = None
+        self._imsim_bandpass = None
+
+    def _load_lsst(self):
+
+        bp_dict = BandpassDict.loadTotalBandpassesFromFiles()
+        for bp_name in bp_dict.keys():
+            if bp_dict[bp_name].phi is None:
+                bp_dict[bp_name].sbTophi()
+
+        self.bandpass_names = list(bp_dict.keys())
+        self.wavelen_match = self._read_only(bp_dict.wavelenMatch)
+        self.wavelen_step = bp_dict.wavelenStep
+        self.phi_array = self._read_only(bp_dict.phiArray)
+        self._lsst_bandpasses = bp_dict
+
+    def _read_only(self, values):
+
+        values = np.ascontiguousarray(values, dtype=np.float64).copy()
+        values.flags.writeable = False
+
+        return values
+
+    @property
+    def lsst_bandpasses(self):
+
+        """
+        `BandpassDict` of the LSST total bandpasses
+        """
+
+        if self._lsst_bandpasses is None:
+            self._load_lsst()
+
+        return self._lsst_bandpasses
+
+    @property
+    def imsim_bandpass(self):
+
+        """
+        The imsim bandpass used to define magnorm
+        """
+
+        if self._imsim_bandpass is None:
+            imsim_bandpass = Bandpass()
+            imsim_bandpass.imsimBandpass()
+            imsim_bandpass.sbTophi()
+            self._imsim_bandpass = imsim_bandpass
+
+        return self._imsim_bandpass
+
+    def lsst_arrays(self):
+
+        """
+        Band names, wavelength grid, grid step and (n_bands x n_wavelength) phi
+        array of the LSST total bandpasses.
+        """
+
+        if self._lsst_bandpasses is None:
+            self._load_lsst()
+
+        return self.bandpass_names, self.wavelen_match, self.wavelen_step, self.phi_array
+
+
+_bandpass_registry = None
+
+
+def get_bandpass_registry():
+
+    """
+    The bandpass registry shared by everything in this process. It is created on first use.
+    """
+
+    global _bandpass_registry
+    if _bandpass_registry is None:
+        _bandpass_registry = BandpassRegistry()
+
+    return _bandpass_registry
+
+
+class PhotometryEngine():
+
+    """
+    Band fluxes for many objects at once.
+
+    Every SED is normalized with the imsim bandpass, redshifted with dimming and
+    reddened once per object. The spectra are resampled to the common bandpass
+    wavelength grid as rows of an (n_objects x n_wavelength) array and integrated
+    against all bandpasses with a single matrix multiply. The results are the
+    same as `DC2Sprinkler.add_flux` object by object.
+
+    Parameters
+    ----------
+
+    bp_dict: lsst.sims.photUtils.BandpassDict, default=None
+    Bandpasses to integrate over. Defaults to the LSST total bandpasses
+    from the process wide `BandpassRegistry`.
+
+    sed_cache: SedCache, default=None
+    Cache to load SEDs from. Defaults to the cache shared in this process.
+
+    chunk_size: int, default=500
+    Number of objects resampled together, which bounds the memory used
+    """
+
+    def __init__(self, bp_dict=None, sed_cache=None, chunk_size=500):
+
+        if sed_cache is None:
+            sed_cache = get_sed_cache()
+
+        self.sed_cache = sed_cache
+        self.chunk_size = chunk_size
+        if bp_dict is None:
+            (self.bandpass_names, self.wavelen_match,
+             self.wavelen_step, self.phi_array) = get_bandpass_registry().lsst_arrays()
+        else:
+            self.bandpass_names = list(bp_dict.keys())
+            self.wavelen_match = np.asarray(bp_dict.wavelenMatch, dtype=np.float64)
+            self.wavelen_step = bp_dict.wavelenStep
+            self.phi_array = np.ascontiguousarray(bp_dict.phiArray, dtype=np.float64)
+
+    def _resample(self, rest_wavelen, rest_fnu, redshift):
+
+        # Redshifting maps fnu(lambda) to (1+z) fnu(lambda/(1+z)). Interpolate
+        # onto the bandpass grid like `Sed.resampleSED`, with NaN where the
+        # grid is not covered by the SED.
+        fnu_match = np.empty((len(redshift), len(self.wavelen_match)))
+        for row, obj_redshift in enumerate(redshift):
+            obj_fnu = rest_fnu if rest_fnu.ndim == 1 else rest_fnu[row]
+            fnu_match[row] = np.interp(self.wavelen_match, rest_wavelen * (1. + obj_redshift),
+                                       obj_fnu, left=np.nan, right=np.nan)
+        fnu_match *= (1. + redshift)[:, np.newaxis]
+
+        return fnu_match
+
+    def calc_fluxes(self, sed_names, redshifts, magnorms, av=None, rv=None):
+
+        """
+        Calculate band fluxes with and without Milky Way dust.
+
+        Parameters
+        ----------
+
+        sed_names: str or array-like of str
+        SED filenames relative to the SED library directory, or one name for all objects
+
+        redshifts: array-like
+        Redshift of each object
+
+        magnorms: array-like
+        imsim magnorm of each object, either one value per object or an
+        (n_objects x n_bands) array with one value per band
+
+        av: array-like, default=None
+        Milky Way A_v of each object. Leave as None to skip the dusty fluxes.
+
+        rv: array-like, default=None
+        Milky Way R_v of each object
+
+        Returns
+        -------
+
+        flux_no_mw: numpy.ndarray
+            (n_objects x n_bands) fluxes without Milky Way dust in the order of `bandpass_names`
+
+        flux_mw: numpy.ndarray or None
+            (n_objects x n_bands) fluxes with Milky Way dust
+        """
+
+        redshifts = np.atleast_1d(np.asarray(redshifts, dtype=np.float64))
+        n_obj = len(redshifts)
+        n_bands = len(self.bandpass_names)
+        if isinstance(sed_names, (str, bytes)):
+            sed_names = [sed_names] * n_obj
+        sed_names = np.asarray(sed_names)
+        magnorms = np.asarray(magnorms, dtype=np.float64)
+        if magnorms.ndim < 2:
+            magnorms = np.broadcast_to(magnorms.reshape(-1, 1), (n_obj, n_bands))
+        if av is not None:
+            av = np.broadcast_to(np.asarray(av, dtype=np.float64), (n_obj,))
+            rv = np.broadcast_to(np.asarray(rv, dtype=np.float64), (n_obj,))
+
+        flux_no_mw = np.zeros((n_obj, n_bands))
+        flux_mw = np.zeros((n_obj, n_bands)) if av is not None else None
+        if n_obj == 0:
+            return flux_no_mw, flux_mw
+
+        unique_names, sed_idx = np.unique(sed_names, return_inverse=True)
+        for name_num, sed_name in enumerate(unique_names):
+            sed_obj, a_x, b_x = self.sed_cache.get_sed(str(sed_name))
+            rest_wavelen = np.asarray(sed_obj.wavelen, dtype=np.float64)
+            rest_fnu = np.asarray(sed_obj.fnu, dtype=np.float64)
+            # Band fluxes scale linearly with the flux normalization
+            norm_zero = getImsimFluxNorm(sed_obj, 0.)
+
+            obj_idx = np.where(sed_idx == name_num)[0]
+            for start in range(0, len(obj_idx), self.chunk_size):
+                chunk_idx = obj_idx[start:start + self.chunk_size]
+                redshift = redshifts[chunk_idx]
+                flux_norm = norm_zero * np.power(10., -0.4 * magnorms[chunk_idx])
+
+                fnu_match = self._resample(rest_wavelen, rest_fnu, redshift)
+                flux_no_mw[chunk_idx] = (np.dot(fnu_match, self.phi_array.T) *
+                                         self.wavelen_step * flux_norm)
+
+                if av is not None:
+                    # The dust curve stays on the rest frame grid like `Sed.addDust`
+                    # applied after redshifting in `add_flux`
+                    a_lambda = ((a_x[np.newaxis, :] + b_x[np.newaxis, :] / rv[chunk_idx, np.newaxis]) *
+                                av[chunk_idx, np.newaxis])
+                    dust_fnu = rest_fnu[np.newaxis, :] * np.power(10., -0.4 * a_lambda)
+                    fnu_match = self._resample(rest_wavelen, dust_fnu, redshift)
+                    flux_mw[chunk_idx] = (np.dot(fnu_match, self.phi_array.T) *
+                                          self.wavelen_step * flux_norm)
+
+        return flux_no_mw, flux_mw
+
+
+class FluxGrid():
+
+    """
+    Band fluxes of one SED at magnorm 0 on a regular grid of redshift and
+    Milky Way A_v with R_v=3.1.
+
+    Fluxes are interpolated bilinearly in log flux. Building the grid checks
+    the interpolation against exact fluxes half way between the grid points
+    along each axis and doubles the resolution of any axis where the largest
+    relative error is above `max_rel_error`. If the limit is still missed
+    after `max_refine` refinements the grid is kept with its error in
+    `rel_error` and `FluxLookup` calculates that SED exactly instead.
+
+    Parameters
+    ----------
+
+    sed_name: str
+    SED filename relative to the SED library directory
+
+    phot_engine: PhotometryEngine
+    Engine used to calculate the exact fluxes
+
+    z_min, z_max: float, default=0.0, 3.1
+    Redshift range of the grid
+
+    n_z: int, default=311
+    Number of redshift grid points before any refinement
+
+    av_max: float, default=1.0
+    Largest A_v in the grid. The grid starts at A_v=0.
+
+    n_av: int, default=11
+    Number of A_v grid points before any refinement
+
+    max_rel_error: float, default=1e-3
+    Largest relative error allowed half way between grid points
+
+    max_refine: int, default=3
+    Maximum number of times the grid resolution is doubled
+    """
+
+    rv = 3.1
+
+    def __init__(self, sed_name, phot_engine, z_min=0.0, z_max=3.1, n_z=311,
+                 av_max=1.0, n_av=11, max_rel_error=1e-3, max_refine=3):
+
+        self.sed_name = sed_name
+        self.z_min = z_min
+        self.z_max = z_max
+        self.av_max = av_max
+        self.max_rel_error = max_rel_error
+        self.bandpass_names = list(phot_engine.bandpass_names)
+        self.grid_kwargs = {'z_min': z_min, 'z_max': z_max, 'n_z': n_z,
+                            'av_max': av_max, 'n_av': n_av, 'max_refine': max_refine}
+
+        for refine_num in range(max_refine + 1):
+            self._fill(phot_engine, n_z, n_av)
+            z_error, av_error = self._check_error(phot_engine)
+            self.rel_error = max(z_error, av_error)
+            if self.rel_error <= max_rel_error:
+                break
+            # Only refine the axes that miss the error limit
+            if z_error > max_rel_error:
+                n_z = 2*n_z - 1
+            if av_error > max_rel_error:
+                n_av = 2*n_av - 1
+
+    def _fill(self, phot_engine, n_z, n_av):
+
+        self.z_grid = np.linspace(self.z_min, self.z_max, n_z)
+        self.av_grid = np.linspace(0., self.av_max, n_av)
+        z_mesh, av_mesh = np.meshgrid(self.z_grid, self.av_grid, indexing='ij')
+        flux_no_mw, flux_mw = phot_engine.calc_fluxes(self.sed_name, z_mesh.ravel(), 0.,
+                                                      av_mesh.ravel(), self.rv)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.log_flux = np.log(flux_mw).reshape(n_z, n_av, len(self.bandpass_names))
+
+    def _max_error(self, phot_engine, redshift, av):
+
+        z_mesh, av_mesh = np.meshgrid(redshift, av, indexing='ij')
+        z_mesh = z_mesh.ravel()
+        av_mesh = av_mesh.ravel()
+        exact_flux = phot_engine.calc_fluxes(self.sed_name, z_mesh, 0., av_mesh, self.rv)[1]
+        grid_flux = self.interpolate(z_mesh, av_mesh)
+
+        # Cells next to redshifts the SED does not cover are left to the exact calculation
+        usable = np.isfinite(exact_flux) & np.isfinite(grid_flux) & (exact_flux > 0.)
+        if not np.any(usable):
+            return 0.
+
+        return np.max(np.abs(grid_flux[usable]/exact_flux[usable] - 1.))
+
+    def _check_error(self, phot_engine):
+
+        # Check each axis half way between grid points along that axis
+        z_mid = 0.5*(self.z_grid[1:] + self.z_grid[:-1])
+        av_mid = 0.5*(self.av_grid[1:] + self.av_grid[:-1])
+        z_error = self._max_error(phot_engine, z_mid, self.av_grid[[0, -1]])
+        av_error = self._max_error(phot_engine, self.z_grid, av_mid)
+
+        return z_error, av_error
+
+    def in_grid(self, redshift, av):
+
+        return ((redshift >= self.z_min) & (redshift <= self.z_max) &
+                (av >= 0.) & (av <= self.av_max))
+
+    def interpolate(self, redshift, av):
+
+        """
+        Interpolated band fluxes at magnorm 0.
+
+        Parameters
+        ----------
+
+        redshift: numpy.ndarray
+        Redshifts inside the grid
+
+        av: numpy.ndarray
+        Milky Way A_v values inside the grid
+
+        Returns
+        -------
+
+        flux: numpy.ndarray
+            (n_objects x n_bands) fluxes. NaN where a neighboring grid point has no flux.
+        """
+
+        redshift = np.asarray(redshift, dtype=np.float64)
+        av = np.asarray(av, dtype=np.float64)
+
+        z_step = self.z_grid[1] - self.z_grid[0]
+        z_idx = np.clip(np.floor((redshift - self.z_min)/z_step).astype(np.int64),
+                        0, len(self.z_grid) - 2)
+        z_frac = ((redshift - self.z_grid[z_idx])/z_step)[:, np.newaxis]
+
+        av_step = self.av_grid[1] - self.av_grid[0]
+        av_idx = np.clip(np.floor(av/av_step).astype(np.int64), 0, len(self.av_grid) - 2)
+        av_frac = ((av - self.av_grid[av_idx])/av_step)[:, np.newaxis]
+
+        log_flux = ((1. - z_frac)*(1. - av_frac)*self.log_flux[z_idx, av_idx] +
+                    z_frac*(1. - av_frac)*self.log_flux[z_idx + 1, av_idx] +
+                    (1. - z_frac)*av_frac*self.log_flux[z_idx, av_idx + 1] +
+                    z_frac*av_frac*self.log_flux[z_idx + 1, av_idx + 1])
+
+        return np.exp(log_flux)
+
+    def save(self, filename, phi_hash=''):
+
+        np.savez(filename, sed_name=self.sed_name, z_grid=self.z_grid,
+                 av_grid=self.av_grid, log_flux=self.log_flux,
+                 max_rel_error=self.max_rel_error, rel_error=self.rel_error,
+                 bandpass_names=np.array(self.bandpass_names), phi_hash=phi_hash,
+                 grid_kwargs=json.dumps(self.grid_kwargs, sort_keys=True, default=float))
+
+    @classmethod
+    def load(cls, filename):
+
+        """
+        Read a grid written with `save`. Returns the grid and the hash of the
+        bandpasses it was built with.
+        """
+
+        with np.load(filename) as grid_file:
+            flux_grid = cls.__new__(cls)
+            flux_grid.sed_name = str(grid_file['sed_name'])
+            flux_grid.z_grid = grid_file['z_grid']
+            flux_grid.av_grid = grid_file['av_grid']
+            flux_grid.log_flux = grid_file['log_flux']
+            flux_grid.max_rel_error = float(grid_file['max_rel_error'])
+            flux_grid.rel_error = float(grid_file['rel_error'])
+            flux_grid.bandpass_names = [str(bp_name) for bp_name in grid_file['bandpass_names']]
+            phi_hash = str(grid_file['phi_hash'])
+            # Grids saved before the settings were recorded are never reused
+            flux_grid.grid_kwargs = None
+            if 'grid_kwargs' in grid_file.files:
+                flux_grid.grid_kwargs = json.loads(str(grid_file['grid_kwargs']))
+        flux_grid.z_min = flux_grid.z_grid[0]
+        flux_grid.z_max = flux_grid.z_grid[-1]
+        flux_grid.av_max = flux_grid.av_grid[-1]
+
+        return flux_grid, phi_hash
+
+
+class FluxLookup():
+
+    """
+    Band fluxes interpolated from a `FluxGrid` for each SED, with the same
+    `calc_fluxes` interface as `PhotometryEngine`.
+
+    Grids are built the first time an SED is needed and saved in `grid_dir`
+    so later runs only read them. A saved grid is rebuilt when it was made
+    with other bandpasses, a looser error limit or other `grid_kwargs`.
+    Objects outside the grid, with R_v other than 3.1, or where the grid has
+    no flux are calculated exactly with the photometry engine instead, as are
+    all objects with an SED whose grid misses `max_rel_error`.
+
+    Parameters
+    ----------
+
+    grid_dir: str, default=None
+    Directory to save and read the grids. Grids are only kept in memory if None.
+
+    phot_engine: PhotometryEngine, default=None
+    Engine for building grids and exact fluxes. Defaults to the LSST bandpasses.
+
+    max_rel_error: float, default=1e-3
+    Largest relative error allowed against the exact fluxes
+
+    grid_kwargs:
+    Other `FluxGrid` arguments such as the grid ranges
+    """
+
+    def __init__(self, grid_dir=None, phot_engine=None, max_rel_error=1e-3, **grid_kwargs):
+
+        if phot_engine is None:
+            phot_engine = PhotometryEngine()
+
+        self.grid_dir = grid_dir
+        self.phot_engine = phot_engine
+        self.max_rel_error = max_rel_error
+        self.grid_kwargs = grid_kwargs
+        self.bandpass_names = phot_engine.bandpass_names
+        self._phi_hash = hashlib.sha1(np.ascontiguousarray(phot_engine.phi_array).tobytes()).hexdigest()
+        # Every setting a grid is built with, including the FluxGrid defaults
+        grid_settings = {name: param.default for name, param in
+                         inspect.signature(FluxGrid.__init__).parameters.items()
+                         if param.default is not inspect.Parameter.empty}
+        grid_settings.pop('max_rel_error')
+        grid_settings.update(grid_kwargs)
+        self._grid_settings = json.loads(json.dumps(grid_settings, sort_keys=True, default=float))
+        self._grids = {}
+
+        if grid_dir is not None:
+            os.makedirs(grid_dir, exist_ok=True)
+
+    def _grid_filename(self, sed_name):
+
+        return os.path.join(self.grid_dir, '%s.npz' % sed_name.replace(os.sep, '__'))
+
+    def get_grid(self, sed_name):
+
+        """
+        The flux grid for an SED, read from `grid_dir` or built if needed.
+        """
+
+        if sed_name in self._grids:
+            return self._grids[sed_name]
+
+        flux_grid = None
+        if self.grid_dir is not None and os.path.exists(self._grid_filename(sed_name)):
+            flux_grid, phi_hash = FluxGrid.load(self._grid_filename(sed_name))
+            # Rebuild grids made for other bandpasses, a looser error limit or other settings
+            if ((phi_hash != self._phi_hash) or
+                (flux_grid.max_rel_error > self.max_rel_error) or
+                (flux_grid.bandpass_names != self.bandpass_names) or
+                (flux_grid.grid_kwargs != self._grid_settings)):
+                flux_grid = None
+
+        if flux_grid is None:
+            flux_grid = FluxGrid(sed_name, self.phot_engine, max_rel_error=self.max_rel_error,
+                                 **self.grid_kwargs)
+            if self.grid_dir is not None:
+                flux_grid.save(self._grid_filename(sed_name), phi_hash=self._phi_hash)
+            if flux_grid.rel_error > self.max_rel_error:
+                print('Flux grid for %s has relative error %e above %e. Using exact fluxes.' %
+                      (sed_name, flux_grid.rel_error, self.max_rel_error))
+
+        self._grids[sed_name] = flux_grid
+
+        return flux_grid
+
+    def calc_fluxes(self, sed_names, redshifts, magnorms, av=None, rv=None):
+
+        """
+        Calculate band fluxes with and without Milky Way dust.
+        Arguments and returns are the same as `PhotometryEngine.calc_fluxes`.
+        """
+
+        redshifts = np.atleast_1d(np.asarray(redshifts, dtype=np.float64))
+        n_obj = len(redshifts)
+        n_bands = len(self.bandpass_names)
+        if isinstance(sed_names, (str, bytes)):
+            sed_names = [sed_names] * n_obj
+        sed_names = np.asarray(sed_names)
+        magnorms = np.asarray(magnorms, dtype=np.float64)
+        if magnorms.ndim < 2:
+            magnorms = np.broadcast_to(magnorms.reshape(-1, 1), (n_obj, n_bands))
+        if av is not None:
+            av = np.broadcast_to(np.asarray(av, dtype=np.float64), (n_obj,))
+            rv = np.broadcast_to(np.asarray(rv, dtype=np.float64), (n_obj,))
+
+        flux_no_mw = np.zeros((n_obj, n_bands))
+        flux_mw = np.zeros((n_obj, n_bands)) if av is not None else None
+        if n_obj == 0:
+            return flux_no_mw, flux_mw
+
+        unique_names, sed_idx = np.unique(sed_names, return_inverse=True)
+        for name_num, sed_name in enumerate(unique_names):
+            flux_grid = self.get_grid(str(sed_name))
+            obj_idx = np.where(sed_idx == name_num)[0]
+            redshift = redshifts[obj_idx]
+            norm = np.power(10., -0.4 * magnorms[obj_idx])
+            use_grid = flux_grid.in_grid(redshift, np.zeros(len(obj_idx)))
+            # A grid that never reached the error limit is not used at all
+            use_grid &= (flux_grid.rel_error <= self.max_rel_error)
+            if av is not None:
+                use_grid &= flux_grid.in_grid(redshift, av[obj_idx]) & (rv[obj_idx] == FluxGrid.rv)
+
+            grid_no_mw = np.full((len(obj_idx), n_bands), np.nan)
+            grid_mw = np.full((len(obj_idx), n_bands), np.nan)
+            grid_no_mw[use_grid] = flux_grid.interpolate(redshift[use_grid],
+                                                         np.zeros(np.sum(use_grid)))
+            if av is not None:
+                grid_mw[use_grid] = flux_grid.interpolate(redshift[use_grid], av[obj_idx][use_grid])
+                use_grid &= np.all(np.isfinite(grid_mw), axis=1)
+            use_grid &= np.all(np.isfinite(grid_no_mw), axis=1)
+
+            flux_no_mw[obj_idx[use_grid]] = grid_no_mw[use_grid] * norm[use_grid]
+            if av is not None:
+                flux_mw[obj_idx[use_grid]] = grid_mw[use_grid] * norm[use_grid]
+
+            exact_idx = obj_idx[~use_grid]
+            if len(exact_idx) > 0:
+                exact_no_mw, exact_mw = self.phot_engine.calc_fluxes(str(sed_name), redshifts[exact_idx],
+                                                                     magnorms[exact_idx],
+                                                                     None if av is None else av[exact_idx],
+                                                                     None if av is None else rv[exact_idx])
+                flux_no_mw[exact_idx] = exact_no_mw
+                if av is not None:
+                    flux_mw[exact_idx] = exact_mw
+
+        return flux_no_mw, flux_mw
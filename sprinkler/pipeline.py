@@ -0,0 +1,310 @@
+"""
+Named pipeline stages with content-addressed caching of their outputs
+"""
+
+import os
+import json
+import pickle
+import hashlib
+import inspect
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+__all__ = ['content_hash', 'StagePipeline']
+
+
+def _update_hash(input_hash, obj):
+
+    if isinstance(obj, pd.DataFrame):
+        input_hash.update(b'DataFrame')
+        _update_hash(input_hash, obj.index)
+        for col_name in obj.columns:
+            _update_hash(input_hash, str(col_name))
+            _update_hash(input_hash, obj[col_name])
+    elif isinstance(obj, (pd.Series, pd.Index)):
+        input_hash.update(str(obj.dtype).encode('utf-8'))
+        _update_hash(input_hash, np.asarray(obj))
+    elif isinstance(obj, np.ndarray):
+        input_hash.update(('%s%s' % (obj.dtype.descr, obj.shape)).encode('utf-8'))
+        if obj.dtype.hasobject:
+            input_hash.update(pickle.dumps(obj.tolist(), protocol=4))
+        else:
+            input_hash.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        input_hash.update(b'dict')
+        for key in sorted(obj.keys(), key=str):
+            _update_hash(input_hash, str(key))
+            _update_hash(input_hash, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        input_hash.update(('%s%i' % (type(obj).__name__, len(obj))).encode('utf-8'))
+        for item in obj:
+            _update_hash(input_hash, item)
+    else:
+        input_hash.update(repr(obj).encode('utf-8'))
+    input_hash.update(b'\0')
+
+
+def content_hash(obj):
+
+    """
+    Hash of the contents of a stage output or parameter.
+
+    Dataframes, numpy arrays (including FITS records), dicts, lists and tuples
+    are hashed by value. Anything else contributes its repr.
+
+    Parameters
+    ----------
+
+    obj: object
+    Object to hash
+
+    Returns
+    -------
+
+    obj_hash: str
+        Hex digest of the contents
+    """
+
+    obj_hash = hashlib.sha1()
+    _update_hash(obj_hash, obj)
+
+    return obj_hash.hexdigest()
+
+
+class StagePipeline():
+
+    """
+    A chain of named stages where each stage caches its output on disk.
+
+    A stage is keyed on its name, the source of its function and of the module
+    level functions it calls, its parameters and the content hashes of the
+    outputs of the stages it takes as inputs.
+    When the key of a stage has a cached output it is not run again, so a
+    re-run only recomputes the stages downstream of what changed. A stage
+    whose output comes out identical to the cached one does not invalidate the
+    stages after it.
+
+    Parameters
+    ----------
+
+    cache_dir: str, default=None
+    Directory for the cached stage outputs. Nothing is cached if None.
+
+    code_version: str, default=''
+    Extra string added to every stage key, e.g. a hash of library code the
+    stage functions call
+    """
+
+    def __init__(self, cache_dir=None, code_version=''):
+
+        self.cache_dir = cache_dir
+        self.code_version = code_version
+        self.stages = OrderedDict()
+        self._outputs = {}
+        self._output_hashes = {}
+        self.run_stages = []
+
+    def add_stage(self, name, func, inputs=(), params=None, cache=True, is_current=None):
+
+        """
+        Add a stage to the pipeline.
+
+        Parameters
+        ----------
+
+        name: str
+        Stage name
+
+        func: callable
+        Called as `func(*input_outputs, **params)`
+
+        inputs: list of str, default=()
+        Names of earlier stages whose outputs are passed to `func` in order
+
+        params: dict, default=None
+        Keyword parameters of `func`. Part of the stage key.
+
+        cache: bool, default=True
+        Save the output to `cache_dir`. Stages that do their own checkpointing
+        can turn this off and are then run every time.
+
+        is_current: callable, default=None
+        Called with a cached output. If it returns False the stage is run
+        again, e.g. when the files a stage writes have been removed.
+        """
+
+        if name in self.stages:
+            raise ValueError('Stage %s already exists' % name)
+        for input_name in inputs:
+            if input_name not in self.stages:
+                raise ValueError('Stage %s needs %s to be added first' % (name, input_name))
+
+        self.stages[name] = {'func': func, 'inputs': list(inputs),
+                             'params': dict(params or {}), 'cache': cache,
+                             'is_current': is_current}
+
+    def _func_source(self, func):
+
+        try:
+            return inspect.getsource(func)
+        except (OSError, TypeError):
+            return getattr(func, '__qualname__', repr(func))
+
+    def _helper_functions(self, func, helpers):
+
+        # Module level functions a stage function calls, followed through the
+        # functions they call in turn
+        code_objs = [func.__code__]
+        while len(code_objs) > 0:
+            code_obj = code_objs.pop()
+            code_objs.extend(const for const in code_obj.co_consts if inspect.iscode(const))
+            for global_name in code_obj.co_names:
+                helper = func.__globals__.get(global_name)
+                if inspect.isfunction(helper) and (helper not in helpers):
+                    helpers.append(helper)
+                    self._helper_functions(helper, helpers)
+
+        return helpers
+
+    def _stage_source(self, func):
+
+        # Editing a helper a stage calls has to invalidate the stage too
+        func = inspect.unwrap(func)
+        if not inspect.isfunction(func):
+            return self._func_source(func)
+
+        return [self._func_source(func)] + [self._func_source(helper) for helper
+                                            in self._helper_functions(func, [func])[1:]]
+
+    def stage_key(self, name):
+
+        """
+        Cache key of a stage. Its input stages must already have been resolved.
+        """
+
+        stage = self.stages[name]
+
+        return content_hash([name, self.code_version, self._stage_source(stage['func']),
+                             stage['params'],
+                             [self._output_hashes[input_name] for input_name in stage['inputs']]])
+
+    def _cache_files(self, name, key):
+
+        stage_dir = os.path.join(self.cache_dir, name)
+
+        return (os.path.join(stage_dir, '%s.pkl' % key),
+                os.path.join(stage_dir, '%s.json' % key))
+
+    def _cached_output(self, name, key):
+
+        # Filename and content hash of the cached output of a stage, or None
+        stage = self.stages[name]
+        if (self.cache_dir is None) or (stage['cache'] is False):
+            return None
+
+        output_file, info_file = self._cache_files(name, key)
+        if not (os.path.exists(output_file) & os.path.exists(info_file)):
+            return None
+
+        with open(info_file, 'r') as f:
+            stage_info = json.load(f)
+
+        if stage['is_current'] is not None:
+            if not stage['is_current'](self._read_output(output_file)):
+                return None
+
+        return output_file, stage_info['output_hash']
+
+    def _read_output(self, output_file):
+
+        with open(output_file, 'rb') as f:
+            return pickle.load(f)
+
+    def get_output(self, name):
+
+        """
+        Output of a stage that has been resolved by `run`.
+        """
+
+        output = self._outputs[name]
+        if isinstance(output, _CachedOutput):
+            output = self._read_output(output.filename)
+            self._outputs[name] = output
+
+        return output
+
+    def _run_stage(self, name, key):
+
+        stage = self.stages[name]
+        print('Running stage %s' % name)
+        output = stage['func'](*[self.get_output(input_name) for input_name in stage['inputs']],
+                               **stage['params'])
+        self._outputs[name] = output
+        self._output_hashes[name] = content_hash(output)
+        self.run_stages.append(name)
+
+        if (self.cache_dir is not None) and (stage['cache'] is True):
+            output_file, info_file = self._cache_files(name, key)
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            # Write then rename so an interrupted run never leaves a partial cache entry
+            with open(output_file + '.tmp', 'wb') as f:
+                pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(output_file + '.tmp', output_file)
+            with open(info_file, 'w') as f:
+                json.dump({'stage': name, 'output_hash': self._output_hashes[name]}, f)
+
+    def run(self, targets=None):
+
+        """
+        Bring the requested stages up to date.
+
+        Parameters
+        ----------
+
+        targets: list of str, default=None
+        Stages to resolve. All stages if None.
+
+        Returns
+        -------
+
+        outputs: dict
+            Output of each target stage keyed by stage name
+        """
+
+        if targets is None:
+            targets = list(self.stages.keys())
+
+        needed = set()
+        to_visit = list(targets)
+        while len(to_visit) > 0:
+            name = to_visit.pop()
+            if name not in needed:
+                needed.add(name)
+                to_visit.extend(self.stages[name]['inputs'])
+
+        self._outputs = {}
+        self._output_hashes = {}
+        self.run_stages = []
+        for name in self.stages:
+            if name not in needed:
+                continue
+            key = self.stage_key(name)
+            cached = self._cached_output(name, key)
+            if cached is not None:
+                output_file, self._output_hashes[name] = cached
+                self._outputs[name] = _CachedOutput(output_file)
+                print('Using cached output of stage %s' % name)
+            else:
+                self._run_stage(name, key)
+
+        return {name: self.get_output(name) for name in targets}
+
+
+class _CachedOutput():
+
+    # Placeholder for a cached output that has not been read from disk yet
+
+    def __init__(self, filename):
+
+        self.filename = filename
@@ -0,0 +1,483 @@
+"""
+Writers for the sprinkled truth catalogs
+"""
+
+import os
+import sqlite3
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import healpy
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+__all__ = ['TruthCatalogWriter', 'TruthParquetWriter', 'get_truth_writer',
+           'TruthCatalogReader', 'lens_healpix', 'truth_catalog_path']
+
+OUTPUT_FORMATS = ('sqlite', 'parquet')
+
+
+def lens_healpix(ra, dec, nside=32):
+
+    """
+    Ring ordered healpix ids used to partition the Parquet truth catalogs.
+
+    Parameters
+    ----------
+
+    ra: array-like
+    Right ascension in degrees
+
+    dec: array-like
+    Declination in degrees
+
+    nside: int, default=32
+    Healpix nside of the partitions
+
+    Returns
+    -------
+
+    healpix: numpy.ndarray
+        Healpix id of each position
+    """
+
+    return healpy.ang2pix(nside, np.asarray(ra), np.asarray(dec), nest=False, lonlat=True)
+
+
+def truth_catalog_path(truth_dir, catalog_name, output_format=None):
+
+    """
+    Location of a truth catalog. sqlite catalogs are the file
+    `<catalog_name>.db` and Parquet catalogs the directory `<catalog_name>`.
+
+    Parameters
+    ----------
+
+    truth_dir: str
+    Directory holding the truth catalogs
+
+    catalog_name: str
+    Name of the catalog without extension, e.g. 'lens_truth'
+
+    output_format: str, default=None
+    Either 'sqlite' or 'parquet'. If None use the format found in
+    `truth_dir`, preferring sqlite when both exist.
+
+    Returns
+    -------
+
+    path: str
+        sqlite filename or Parquet directory to pass to `TruthCatalogReader`
+    """
+
+    sqlite_path = os.path.join(truth_dir, '%s.db' % catalog_name)
+    parquet_path = os.path.join(truth_dir, catalog_name)
+
+    if output_format is None:
+        if os.path.exists(sqlite_path) or not os.path.isdir(parquet_path):
+            output_format = 'sqlite'
+        else:
+            output_format = 'parquet'
+
+    if output_format == 'sqlite':
+        return sqlite_path
+    elif output_format == 'parquet':
+        return parquet_path
+
+    raise ValueError('output_format must be one of %s, not %s' % (str(OUTPUT_FORMATS),
+                                                                  output_format))
+
+
+def get_truth_writer(out_file, output_format='sqlite', overwrite_existing=False):
+
+    """
+    Writer for a truth catalog in the requested format.
+
+    Parameters
+    ----------
+
+    out_file: str
+    sqlite filename or root directory of the Parquet datasets
+
+    output_format: str, default='sqlite'
+    Either 'sqlite' or 'parquet'
+
+    overwrite_existing: bool, default=False
+    Replace an existing catalog
+
+    Returns
+    -------
+
+    truth_writer: TruthCatalogWriter or TruthParquetWriter
+    """
+
+    if output_format == 'sqlite':
+        return TruthCatalogWriter(out_file, overwrite_existing=overwrite_existing)
+    elif output_format == 'parquet':
+        return TruthParquetWriter(out_file, overwrite_existing=overwrite_existing)
+
+    raise ValueError('output_format must be one of %s, not %s' % (str(OUTPUT_FORMATS),
+                                                                  output_format))
+
+
+class TruthCatalogWriter():
+
+    """
+    Write truth catalog dataframes to a sqlite file with batched inserts.
+
+    All tables are loaded inside a single transaction with the journal in WAL
+    mode and synchronous writes off. The lookup indexes are built once the rows
+    are in and the journal is returned to the sqlite default so the output is
+    a single self-contained file. Tables have the same layout `DataFrame.to_sql`
+    gives them so existing readers work unchanged.
+
+    Parameters
+    ----------
+
+    out_file: str
+    Filename of the sqlite file
+
+    overwrite_existing: bool, default=False
+    Remove `out_file` before writing if it already exists
+
+    batch_size: int, default=50000
+    Number of rows sent to sqlite in each `executemany` call
+    """
+
+    index_columns = ['dc2_sys_id', 'lens_cat_sys_id', 'unique_id']
+
+    def __init__(self, out_file, overwrite_existing=False, batch_size=50000):
+
+        self.out_file = out_file
+        self.overwrite_existing = overwrite_existing
+        self.batch_size = batch_size
+
+    def column_type(self, column):
+
+        """
+        sqlite column type matching what `DataFrame.to_sql` declares.
+
+        Parameters
+        ----------
+
+        column: pandas Series
+        Column to be written
+
+        Returns
+        -------
+
+        col_type: str
+            The declared sqlite type
+        """
+
+        if pd.api.types.is_bool_dtype(column):
+            return 'BOOLEAN'
+        elif pd.api.types.is_integer_dtype(column):
+            return 'INTEGER' if column.dtype.itemsize <= 4 else 'BIGINT'
+        elif pd.api.types.is_float_dtype(column):
+            return 'FLOAT'
+
+        inferred = pd.api.types.infer_dtype(column, skipna=True)
+        if inferred == 'integer':
+            return 'BIGINT'
+        elif inferred in ('floating', 'mixed-integer-float', 'decimal'):
+            return 'FLOAT'
+        elif inferred == 'boolean':
+            return 'BOOLEAN'
+
+        return 'TEXT'
+
+    def column_values(self, column):
+
+        """
+        Convert a column into a list of python objects sqlite can bind.
+        """
+
+        values = column.tolist()
+        if column.dtype == object:
+            values = [val.item() if isinstance(val, np.generic) else val
+                      for val in values]
+
+        return values
+
+    def write_table(self, conn, df, table_name, index=True):
+
+        """
+        Create one table and insert its rows in batches. Returns the names of
+        the columns to index once all tables are loaded.
+        """
+
+        columns = {}
+        if index is True:
+            index_label = df.index.name if df.index.name is not None else 'index'
+            columns[index_label] = df.index.to_series()
+        for col_name in df.columns:
+            columns[str(col_name)] = df[col_name]
+
+        col_defs = ', '.join('"%s" %s' % (col_name, self.column_type(col))
+                             for col_name, col in columns.items())
+        conn.execute('CREATE TABLE "%s" (%s)' % (table_name, col_defs))
+
+        insert = 'INSERT INTO "%s" VALUES (%s)' % (table_name,
+                                                   ', '.join(['?']*len(columns)))
+        for start in range(0, len(df), self.batch_size):
+            stop = start + self.batch_size
+            rows = zip(*[self.column_values(col.iloc[start:stop])
+                         for col in columns.values()])
+            conn.executemany(insert, rows)
+
+        index_names = [col_name for col_name in columns
+                       if col_name in self.index_columns]
+        if index is True:
+            index_names.insert(0, index_label)
+
+        return index_names
+
+    def write(self, tables, index=True, lens_positions=None):
+
+        """
+        Write the truth catalog tables and build the lookup indexes.
+
+        Parameters
+        ----------
+
+        tables: dict
+        Dataframes to write keyed by table name
+
+        index: bool, default=True
+        Write the dataframe index as the first column like `DataFrame.to_sql`
+
+        lens_positions: dict, default=None
+        Unused. Accepted so both truth catalog writers share an interface.
+        """
+
+        if self.overwrite_existing is True and os.path.exists(self.out_file):
+            os.remove(self.out_file)
+
+        conn = sqlite3.connect(self.out_file, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+
+            conn.execute('BEGIN')
+            try:
+                table_indexes = {}
+                for table_name, df in tables.items():
+                    table_indexes[table_name] = self.write_table(conn, df, table_name,
+                                                                 index=index)
+                for table_name, index_names in table_indexes.items():
+                    for col_name in index_names:
+                        conn.execute('CREATE INDEX "ix_%s_%s" ON "%s" ("%s")' %
+                                     (table_name, col_name, table_name, col_name))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+            conn.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            conn.close()
+
+
+class TruthParquetWriter():
+
+    """
+    Write truth catalog dataframes as Parquet datasets partitioned by the
+    healpix of the lens position.
+
+    Every table becomes the directory `out_dir/table_name` with one
+    `healpix=<id>` partition directory per sky pixel so readers only open the
+    files covering the region they need. Columns match the sqlite tables.
+
+    Parameters
+    ----------
+
+    out_dir: str
+    Root directory of the truth catalog
+
+    overwrite_existing: bool, default=False
+    Replace tables that already exist under `out_dir`
+
+    nside: int, default=32
+    Healpix nside of the partitions
+    """
+
+    partition_column = 'healpix'
+
+    def __init__(self, out_dir, overwrite_existing=False, nside=32):
+
+        self.out_dir = out_dir
+        self.overwrite_existing = overwrite_existing
+        self.nside = nside
+
+    def table_healpix(self, df, table_name, lens_positions):
+
+        if lens_positions is not None and table_name in lens_positions:
+            ra, dec = lens_positions[table_name]
+        elif 'ra_lens' in df.columns and 'dec_lens' in df.columns:
+            ra, dec = df['ra_lens'].values, df['dec_lens'].values
+        else:
+            raise ValueError('Table %s has no lens position to partition on. ' % table_name +
+                             'Pass it with lens_positions.')
+
+        return lens_healpix(ra, dec, nside=self.nside)
+
+    def write(self, tables, index=True, lens_positions=None):
+
+        """
+        Write the truth catalog tables.
+
+        Parameters
+        ----------
+
+        tables: dict
+        Dataframes to write keyed by table name
+
+        index: bool, default=True
+        Write the dataframe index as an `index` column like the sqlite tables
+
+        lens_positions: dict, default=None
+        (ra, dec) arrays in degrees of the lens for every row keyed by table name.
+        Tables without an entry are partitioned on their `ra_lens` and `dec_lens`
+        columns.
+        """
+
+        for table_name, df in tables.items():
+            table_dir = os.path.join(self.out_dir, table_name)
+            if os.path.exists(table_dir):
+                if self.overwrite_existing is not True:
+                    raise ValueError('Table %s already exists in %s' % (table_name,
+                                                                        self.out_dir))
+                shutil.rmtree(table_dir)
+
+            out_df = df.reset_index() if index is True else df.reset_index(drop=True)
+            out_df.columns = [str(col_name) for col_name in out_df.columns]
+            out_df[self.partition_column] = self.table_healpix(df, table_name, lens_positions)
+
+            arrow_table = pa.Table.from_pandas(out_df, preserve_index=False)
+            metadata = dict(arrow_table.schema.metadata or {})
+            metadata[b'sprinkler'] = json.dumps({'healpix_nside': self.nside}).encode()
+            arrow_table = arrow_table.replace_schema_metadata(metadata)
+            pq.write_to_dataset(arrow_table, table_dir,
+                                partition_cols=[self.partition_column])
+
+
+class TruthCatalogReader():
+
+    """
+    Read truth catalog tables from either the sqlite or the Parquet format.
+
+    Parameters
+    ----------
+
+    path: str
+    sqlite filename or root directory of the Parquet datasets
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.output_format = 'parquet' if os.path.isdir(path) else 'sqlite'
+
+    def _dataset(self, table_name):
+
+        return ds.dataset(os.path.join(self.path, table_name), format='parquet',
+                          partitioning='hive')
+
+    def healpix_nside(self, table_name):
+
+        """
+        Healpix nside the Parquet table is partitioned with.
+        """
+
+        metadata = self._dataset(table_name).schema.metadata
+
+        return json.loads(metadata[b'sprinkler'])['healpix_nside']
+
+    def healpix_in_disc(self, table_name, ra, dec, radius):
+
+        """
+        Partitions of a Parquet table that overlap a circle on the sky.
+
+        Parameters
+        ----------
+
+        table_name: str
+        Name of the table
+
+        ra: float
+        Right ascension of the center in degrees
+
+        dec: float
+        Declination of the center in degrees
+
+        radius: float
+        Radius in degrees
+
+        Returns
+        -------
+
+        healpix: numpy.ndarray
+            Healpix ids to pass to `read`
+        """
+
+        nside = self.healpix_nside(table_name)
+
+        return healpy.query_disc(nside, healpy.ang2vec(ra, dec, lonlat=True),
+                                 np.radians(radius), inclusive=True)
+
+    def read(self, table_name, columns=None, healpix=None, index_col=None):
+
+        """
+        Load a truth catalog table.
+
+        Parameters
+        ----------
+
+        table_name: str
+        Name of the table
+
+        columns: list of str, default=None
+        Columns to load. All columns are loaded if None.
+
+        healpix: array-like, default=None
+        Only load rows in these partitions. Needs the Parquet format.
+
+        index_col: str, default=None
+        Column to use as the dataframe index, e.g. 'index' to get back the
+        index written with the table.
+
+        Returns
+        -------
+
+        truth_df: pandas dataframe
+        """
+
+        if self.output_format == 'sqlite':
+            if healpix is not None:
+                raise ValueError('Selecting by healpix needs a Parquet truth catalog')
+            col_str = '*' if columns is None else ', '.join('"%s"' % col_name
+                                                            for col_name in columns)
+            conn = sqlite3.connect(self.path)
+            try:
+                truth_df = pd.read_sql_query('SELECT %s FROM "%s"' % (col_str, table_name),
+                                             conn)
+            finally:
+                conn.close()
+        else:
+            dataset = self._dataset(table_name)
+            if columns is None:
+                columns = [col_name for col_name in dataset.schema.names
+                           if col_name != TruthParquetWriter.partition_column]
+            row_filter = None
+            if healpix is not None:
+                row_filter = ds.field(TruthParquetWriter.partition_column).isin(
+                    np.asarray(healpix, dtype=np.int64).tolist())
+            truth_df = dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+
+        if index_col is not None:
+            truth_df = truth_df.set_index(index_col)
+
+        return truth_df
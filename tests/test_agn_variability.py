@@ -0,0 +1,127 @@
+import sys
+sys.path.append('../scripts/dc2')
+import unittest
+import numpy as np
+try:
+    from dc2_utils.variability import ExtraGalacticVariabilityModels
+    from dc2_utils.variability import simulate_agn, simulate_agn_array
+except ImportError:
+    # The variability mixins need the lsst sims packages
+    ExtraGalacticVariabilityModels = None
+
+
+def agn_params(rand_state, n_agn):
+
+    params = {'seed': rand_state.randint(0, 2**31, size=n_agn)}
+    for filt_name in ['u', 'g', 'r', 'i', 'z', 'y']:
+        params['agn_tau_%s' % filt_name] = rand_state.uniform(50., 500., size=n_agn)
+        params['agn_sf_%s' % filt_name] = rand_state.uniform(0.1, 0.5, size=n_agn)
+
+    return params
+
+
+@unittest.skipIf(ExtraGalacticVariabilityModels is None, 'lsst sims packages are not available')
+class testApplyAgn(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        rand_state = np.random.RandomState(24)
+        cls.n_agn = 200
+        cls.params = agn_params(rand_state, cls.n_agn)
+        cls.redshift = rand_state.uniform(0.1, 3., size=cls.n_agn)
+        cls.expmjd = rand_state.uniform(59580., 60500., size=cls.n_agn)
+
+    def apply_agn(self, n_threads, filters=('u', 'g', 'r', 'i', 'z', 'y')):
+
+        class AgnModel(ExtraGalacticVariabilityModels):
+            _agn_threads = n_threads
+            filters_to_simulate = list(filters)
+
+        return AgnModel().applyAgn([np.arange(self.n_agn)], self.params, self.expmjd,
+                                   redshift=self.redshift)
+
+    def test_process_pool_matches_serial(self):
+
+        d_mags = self.apply_agn(1)
+        self.assertEqual(d_mags.shape, (6, self.n_agn))
+        self.assertTrue(np.all(d_mags != 0.))
+        for n_threads in [2, 3]:
+            np.testing.assert_array_equal(self.apply_agn(n_threads), d_mags)
+
+    def test_filter_subset(self):
+
+        d_mags = self.apply_agn(1, filters=('g', 'i'))
+        np.testing.assert_array_equal(d_mags[[0, 2, 4, 5]], 0.)
+        np.testing.assert_array_equal(self.apply_agn(2, filters=('g', 'i')), d_mags)
+        np.testing.assert_array_equal(d_mags[[1, 3]], self.apply_agn(1)[[1, 3]])
+
+
+@unittest.skipIf(ExtraGalacticVariabilityModels is None, 'lsst sims packages are not available')
+class testSimulateAgnArray(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        rand_state = np.random.RandomState(25)
+        cls.n_agn = 200
+        cls.walk_start_date = ExtraGalacticVariabilityModels._agn_walk_start_date
+        cls.seed = rand_state.randint(0, 2**31, size=cls.n_agn)
+        cls.tau = rand_state.uniform(5., 500., size=(6, cls.n_agn))
+        cls.sf = rand_state.uniform(0.1, 0.5, size=(6, cls.n_agn))
+        cls.time_dilation = 1. + rand_state.uniform(0.1, 3., size=cls.n_agn)
+        cls.expmjd = rand_state.uniform(cls.walk_start_date,
+                                        cls.walk_start_date + 1500., size=cls.n_agn)
+        # Epochs on and right after the walk start and on the time grid
+        cls.expmjd[:10] = cls.walk_start_date + np.arange(10)
+        cls.expmjd[10:15] = cls.walk_start_date + 100. + rand_state.uniform(0., 1e-9, size=5)
+
+    def test_euler_matches_simulate_agn(self):
+
+        d_mags = simulate_agn_array(self.expmjd, self.tau, self.time_dilation, self.sf,
+                                    self.seed, self.walk_start_date, chunk_size=64)
+        self.assertEqual(d_mags.shape, (6, self.n_agn))
+        for i_filt in range(6):
+            for i_agn in range(self.n_agn):
+                self.assertEqual(d_mags[i_filt, i_agn],
+                                 simulate_agn(self.expmjd[i_agn], self.tau[i_filt, i_agn],
+                                              self.time_dilation[i_agn], self.sf[i_filt, i_agn],
+                                              self.seed[i_agn], self.walk_start_date))
+
+    def test_subset_and_order(self):
+
+        d_mags = simulate_agn_array(self.expmjd, self.tau, self.time_dilation, self.sf,
+                                    self.seed, self.walk_start_date)
+
+        # Each seed gives the same values whatever it is simulated with
+        rand_state = np.random.RandomState(26)
+        subset = rand_state.permutation(self.n_agn)[:60]
+        np.testing.assert_array_equal(simulate_agn_array(self.expmjd[subset], self.tau[:, subset],
+                                                         self.time_dilation[subset],
+                                                         self.sf[:, subset], self.seed[subset],
+                                                         self.walk_start_date, chunk_size=7),
+                                      d_mags[:, subset])
+
+        # A single filter gives the same values as that row of all filters
+        np.testing.assert_array_equal(simulate_agn_array(self.expmjd, self.tau[3],
+                                                         self.time_dilation, self.sf[3],
+                                                         self.seed, self.walk_start_date),
+                                      d_mags[3])
+
+    def test_exact_stationary_std(self):
+
+        # Rest frame tau shorter than the step, where the euler update is unstable
+        n_agn = 5000
+        sf = 0.3
+        for tau in [50., 300.]:
+            d_mags = simulate_agn_array(np.full(n_agn, self.walk_start_date + 1000.3),
+                                        np.full(n_agn, tau), np.ones(n_agn), np.full(n_agn, sf),
+                                        np.arange(n_agn), self.walk_start_date,
+                                        method='exact', time_step=200.)
+            self.assertTrue(np.all(np.isfinite(d_mags)))
+            self.assertAlmostEqual(np.mean(d_mags), 0., delta=0.02)
+            self.assertAlmostEqual(np.std(d_mags), sf, delta=0.015)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import sys
 sys.path.append('..')
 import unittest
+import numpy as np
 from sprinkler import OM10Reader, GoldsteinSNeCatReader, DC2Reader
 from sprinkler import BaseSprinkler
 
@@ -36,5 +37,58 @@ class testBaseSprinkler(unittest.TestCase):
         self.sl_sprinkler.sprinkle_sne()
 
 
+class testVelocityDispersion(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        rand_state = np.random.RandomState(21)
+        cls.radius = rand_state.uniform(1., 10., size=1000)
+        cls.mu_e = rand_state.uniform(18., 22., size=1000)
+        cls.galaxy_id = rand_state.permutation(10**6)[:1000]
+
+    def test_legacy(self):
+
+        a = 1.4335
+        b = 0.3150
+        c = -8.8979
+        log_sigma_fp = (np.log10(self.radius) - b*self.mu_e - c)/a
+        log_sigma_fp += np.random.RandomState(seed=88).normal(scale=0.0578, size=1000)
+
+        np.testing.assert_array_equal(BaseSprinkler().calc_velocity_dispersion(self.radius,
+                                                                             self.mu_e),
+                                      np.power(10, log_sigma_fp))
+
+    def test_philox_chunk_invariant(self):
+
+        sigma_fp = BaseSprinkler().calc_velocity_dispersion(self.radius, self.mu_e,
+                                                          galaxy_id=self.galaxy_id,
+                                                          rng_mode='philox')
+        reverse = BaseSprinkler().calc_velocity_dispersion(self.radius[::-1],
+                                                         self.mu_e[::-1],
+                                                         galaxy_id=self.galaxy_id[::-1],
+                                                         rng_mode='philox')
+        chunk = BaseSprinkler().calc_velocity_dispersion(self.radius[300:400],
+                                                       self.mu_e[300:400],
+                                                       galaxy_id=self.galaxy_id[300:400],
+                                                       rng_mode='philox')
+
+        np.testing.assert_allclose(sigma_fp, reverse[::-1], rtol=1e-12)
+        np.testing.assert_allclose(sigma_fp[300:400], chunk, rtol=1e-12)
+
+        log_scatter = np.log10(sigma_fp) - (np.log10(self.radius) - 0.3150*self.mu_e + 8.8979)/1.4335
+        self.assertAlmostEqual(np.std(log_scatter), 0.0578, delta=0.005)
+
+        sigma_fp_32 = BaseSprinkler().calc_velocity_dispersion(self.radius, self.mu_e,
+                                                             galaxy_id=self.galaxy_id,
+                                                             rng_mode='philox', dtype=np.float32)
+        self.assertEqual(sigma_fp_32.dtype, np.float32)
+        np.testing.assert_allclose(sigma_fp_32, sigma_fp, rtol=1e-5)
+
+        with self.assertRaises(ValueError):
+            BaseSprinkler().calc_velocity_dispersion(self.radius, self.mu_e,
+                                                   rng_mode='philox')
+
+
 if __name__ == '__main__':
     unittest.main()
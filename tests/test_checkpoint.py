@@ -0,0 +1,67 @@
+import sys
+sys.path.append('..')
+import os
+import json
+import tempfile
+import shutil
+import unittest
+import numpy as np
+import pandas as pd
+import sprinkler.checkpoint
+from sprinkler import CatalogCheckpoint, hash_inputs, sed_file_name
+
+class testCatalogCheckpoint(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.scratch_dir = tempfile.mkdtemp(dir=os.path.abspath('.'))
+        cls.host_df = pd.DataFrame({'galaxy_id': np.arange(5, dtype=np.int64) + 10**10,
+                                    'ra': np.linspace(72.5, 75., 5),
+                                    'disk_sed': [b'galaxySED/Exp.%i.gz' % i for i in range(5)],
+                                    'varParamStr_agn': [json.dumps({'p': {'seed': i}})
+                                                        for i in range(5)]})
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.scratch_dir)
+
+    def test_round_trip(self):
+
+        host_ckpt = CatalogCheckpoint(self.scratch_dir, 'host_ckpt', hash_inputs('v1'))
+        self.assertFalse(host_ckpt.is_valid())
+        host_ckpt.save(self.host_df)
+        self.assertTrue(host_ckpt.is_valid())
+
+        host_df = host_ckpt.load()
+        pd.testing.assert_frame_equal(host_df, self.host_df, check_dtype=False)
+        self.assertEqual(host_df['galaxy_id'].dtype, np.int64)
+        self.assertIsInstance(host_df['disk_sed'].iloc[0], bytes)
+        self.assertEqual(json.loads(host_df['varParamStr_agn'].iloc[3])['p']['seed'], 3)
+
+    def test_stale(self):
+
+        CatalogCheckpoint(self.scratch_dir, 'stale_ckpt', hash_inputs('v1')).save(self.host_df)
+
+        stale_ckpt = CatalogCheckpoint(self.scratch_dir, 'stale_ckpt', hash_inputs('v2'))
+        self.assertFalse(stale_ckpt.is_valid())
+        with self.assertRaises(ValueError):
+            stale_ckpt.load()
+
+        schema_version = sprinkler.checkpoint.CHECKPOINT_SCHEMA_VERSION
+        try:
+            sprinkler.checkpoint.CHECKPOINT_SCHEMA_VERSION = schema_version + 1
+            self.assertFalse(CatalogCheckpoint(self.scratch_dir, 'stale_ckpt',
+                                               hash_inputs('v1')).is_valid())
+        finally:
+            sprinkler.checkpoint.CHECKPOINT_SCHEMA_VERSION = schema_version
+
+    def test_sed_file_name(self):
+
+        for sed_name in [b'galaxySED/Burst.gz', "b'galaxySED/Burst.gz'", 'galaxySED/Burst.gz']:
+            self.assertEqual(sed_file_name(sed_name), 'galaxySED/Burst.gz')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,17 @@
 import sys
 sys.path.append('..')
+import os
+import json
+import shutil
+import tempfile
 import unittest
+import numpy as np
+import pandas as pd
+import sncosmo
 from sprinkler import OM10Reader, GoldsteinSNeCatReader, DC2Reader
-from sprinkler import DC2Sprinkler
+from sprinkler import DC2Sprinkler, LensCandidateIndex, id_uniform
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_bipartite_matching
 
 class testDC2Sprinkler(unittest.TestCase):
 
@@ -32,5 +41,300 @@ class testDC2Sprinkler(unittest.TestCase):
         self.sl_sprinkler.sprinkle_sne()
 
 
+class ConstantFluxes():
+
+    # Stands in for PhotometryEngine with fluxes that depend on the inputs only
+    def calc_fluxes(self, sed_name, redshift, magnorm, av, rv):
+
+        flux_no_mw = np.outer(np.asarray(redshift) + np.asarray(magnorm), np.arange(1., 7.))
+        return flux_no_mw, flux_no_mw*np.exp(-np.asarray(av))[:, None]
+
+
+class testDC2TruthCatalogs(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        rand_state = np.random.RandomState(11)
+        n_sys = 50
+        cls.matched_lenses = pd.DataFrame({'galaxy_id': rand_state.randint(0, 10**10, size=n_sys),
+                                           'ra': rand_state.uniform(52.5, 53.7, size=n_sys),
+                                           'dec': rand_state.uniform(-28.6, -27.6, size=n_sys),
+                                           'gamma_1': rand_state.normal(0., 0.02, size=n_sys),
+                                           'gamma_2': rand_state.normal(0., 0.02, size=n_sys),
+                                           'kappa': rand_state.normal(0., 0.02, size=n_sys),
+                                           'size': rand_state.uniform(1., 2., size=n_sys),
+                                           'size_minor': rand_state.uniform(0.5, 1., size=n_sys),
+                                           'position_angle': rand_state.uniform(0., 360., size=n_sys),
+                                           'av_mw': rand_state.uniform(0., 0.1, size=n_sys),
+                                           'rv_mw': 3.1,
+                                           'fp_vel_disp': rand_state.uniform(150., 300., size=n_sys)},
+                                          index=rand_state.permutation(n_sys))
+        cls.matched_sys = pd.DataFrame({'z_lens': rand_state.uniform(0.1, 1., size=n_sys),
+                                        'gamma': rand_state.uniform(0., 0.1, size=n_sys),
+                                        'phi_gamma': rand_state.uniform(0., np.pi, size=n_sys),
+                                        'ellip_lens': rand_state.uniform(0., 0.5, size=n_sys),
+                                        'phie_lens': rand_state.uniform(-90., 90., size=n_sys),
+                                        'system_id': np.arange(n_sys) + 1000},
+                                       index=rand_state.permutation(n_sys))
+
+    def test_lens_truth_dataframe(self):
+
+        lens_df = DC2Sprinkler().create_lens_truth_dataframe(self.matched_lenses,
+                                                             self.matched_sys, 'GLAGN')
+
+        self.assertEqual(len(lens_df), len(self.matched_sys))
+        for i in [0, 17, 49]:
+            lens = self.matched_lenses.iloc[i]
+            lens_sys = self.matched_sys.iloc[i]
+            row = lens_df.iloc[i]
+            self.assertEqual(row['dc2_sys_id'], 'GLAGN_%i' % i)
+            self.assertEqual(row['unique_id'], lens['galaxy_id'])
+            self.assertEqual(row['lens_cat_sys_id'], lens_sys['system_id'])
+            self.assertEqual(row['sindex_lens'], 4)
+            self.assertAlmostEqual(row['shear_1_lenscat'],
+                                   lens_sys['gamma'] * np.cos(2 * lens_sys['phi_gamma']))
+            self.assertAlmostEqual(row['shear_2_lenscat'],
+                                   lens_sys['gamma'] * np.sin(2 * lens_sys['phi_gamma']))
+            self.assertAlmostEqual(row['ellip_cosmodc2'], 1. - lens['size_minor']/lens['size'])
+            self.assertAlmostEqual(row['phie_cosmodc2'], 0.5*lens['position_angle'] - 90)
+
+    def test_lensed_agn_truth(self):
+
+        rand_state = np.random.RandomState(13)
+        n_sys = len(self.matched_sys)
+        n_img = rand_state.choice([2, 4], size=n_sys)
+        agn_sys = pd.DataFrame({'system_id': np.arange(n_sys) + 1000, 'n_img': n_img,
+                                'x_src': rand_state.normal(size=n_sys),
+                                'y_src': rand_state.normal(size=n_sys),
+                                'z_src': rand_state.uniform(0.5, 3., size=n_sys)})
+        img_vals = {}
+        for key in ['x_img', 'y_img', 't_delay_img', 'magnification_img']:
+            img_vals[key] = np.where(np.arange(4) < n_img[:, None],
+                                     rand_state.normal(size=(n_sys, 4)), np.nan)
+            for img_num in range(4):
+                agn_sys['%s_%i' % (key, img_num)] = img_vals[key][:, img_num]
+        var_params = [{'seed': i, 'agn_tau_u': 10. + i, 'agn_sf_r': 0.01*i} for i in range(n_sys)]
+        for var_param in var_params:
+            for bp_name in ['u', 'g', 'r', 'i', 'z', 'y']:
+                var_param.setdefault('agn_sf_%s' % bp_name, 0.3)
+        agn_hosts = pd.DataFrame({'magNorm_agn': rand_state.uniform(18., 24., size=n_sys),
+                                  'varParamStr_agn': [json.dumps({'p': var_param})
+                                                      for var_param in var_params]})
+
+        out_dir = tempfile.mkdtemp(dir=os.path.abspath('.'))
+        try:
+            agn_df = DC2Sprinkler().output_lensed_agn_truth(agn_hosts, self.matched_lenses, agn_sys,
+                                                            os.path.join(out_dir, 'agn.db'),
+                                                            phot_engine=ConstantFluxes())
+        finally:
+            shutil.rmtree(out_dir)
+
+        self.assertEqual(len(agn_df), np.sum(n_img))
+        for i, j in [(0, 0), (0, 1), (17, n_img[17] - 1), (49, 1)]:
+            row = agn_df.query('dc2_sys_id == "GLAGN_%i" and image_number == %i' % (i, j)).iloc[0]
+            lens = self.matched_lenses.iloc[i]
+            self.assertEqual(row['unique_id'], 'GLAGN_agn_%i_%i' % (i, j))
+            self.assertEqual(row['x_img'], img_vals['x_img'][i, j])
+            self.assertEqual(row['t_delay'], img_vals['t_delay_img'][i, j])
+            self.assertEqual(row['magnification'], img_vals['magnification_img'][i, j])
+            self.assertAlmostEqual(row['dec'], lens['dec'] + img_vals['y_img'][i, j]/3600.)
+            self.assertEqual(row['lens_id'], lens['galaxy_id'])
+            self.assertEqual(row['lens_cat_sys_id'], 1000 + i)
+            self.assertEqual(row['seed'], i)
+            self.assertEqual(row['agn_sf_r'], 0.01*i)
+            self.assertAlmostEqual(row['flux_i_agn_noMW'],
+                                   4.*(agn_sys['z_src'][i] + agn_hosts['magNorm_agn'][i]))
+
+    def test_explode_image_column(self):
+
+        x_img = [[0.5, -0.5, 0., 0.], [1., 2., 3., 4.], [-1., 1.]]
+        n_img = np.array([2, 4, 2])
+
+        np.testing.assert_array_equal(DC2Sprinkler().explode_image_column(x_img, n_img),
+                                      [0.5, -0.5, 1., 2., 3., 4., -1., 1.])
+
+        x_img = np.array([[0.5, -0.5, np.nan, np.nan], [1., 2., 3., 4.], [-1., 1., np.nan, np.nan]])
+        np.testing.assert_array_equal(DC2Sprinkler().explode_image_column(x_img, n_img),
+                                      [0.5, -0.5, 1., 2., 3., 4., -1., 1.])
+        np.testing.assert_array_equal(DC2Sprinkler().explode_image_column(list(x_img), n_img),
+                                      [0.5, -0.5, 1., 2., 3., 4., -1., 1.])
+
+    def test_dense_image_values(self):
+
+        x_img = np.array([[0.5, -0.5, np.nan, np.nan], [1., 2., 3., 4.], [-1., 1., np.nan, np.nan]])
+        sys_df = pd.DataFrame(x_img, columns=['x_img_0', 'x_img_1', 'x_img_2', 'x_img_3'])
+        sys_df['n_img'] = [2, 4, 2]
+
+        np.testing.assert_array_equal(DC2Sprinkler().image_values(sys_df, 'x_img'), x_img)
+        np.testing.assert_array_equal(DC2Sprinkler().image_values(sys_df.iloc[[2, 0]], 'x_img'),
+                                      x_img[[2, 0]])
+        sys_df['y_img'] = list(x_img)
+        self.assertIsInstance(DC2Sprinkler().image_values(sys_df, 'y_img')[0], np.ndarray)
+        with self.assertRaises(KeyError):
+            DC2Sprinkler().image_values(sys_df, 't_delay_img')
+
+
+class testGlobalAssignment(unittest.TestCase):
+
+    def test_global_sne_match(self):
+
+        rand_state = np.random.RandomState(9)
+        vel_disp = np.power(10, rand_state.normal(2.2, 0.1, size=3000))
+        redshift = np.power(10, rand_state.normal(-0.3, 0.2, size=3000))
+        glsne_zl = np.power(10, rand_state.normal(-0.3, 0.15, size=2000))
+        glsne_sigma = np.power(10, rand_state.normal(2.3, 0.08, size=2000))
+        glsne_sysno = np.arange(2000) + 10
+        glsne_weights = np.ones(2000)
+
+        greedy = DC2Sprinkler().match_to_lenscat_sne(vel_disp, redshift, glsne_zl, glsne_sigma,
+                                                     glsne_sysno, glsne_weights, density=0.1,
+                                                     rng_mode='philox')
+        matched = DC2Sprinkler().match_to_lenscat_sne(vel_disp, redshift, glsne_zl, glsne_sigma,
+                                                      glsne_sysno, glsne_weights, density=0.1,
+                                                      rng_mode='philox', assignment='global')
+        glsne_idx, lens_gal_idx, matched_sysno = matched
+
+        self.assertGreaterEqual(len(glsne_idx), len(greedy[0]))
+        self.assertEqual(len(np.unique(lens_gal_idx)), len(lens_gal_idx))
+        np.testing.assert_array_equal(matched_sysno, glsne_sysno[glsne_idx])
+        self.assertTrue(np.all(np.abs(np.log10(glsne_sigma[glsne_idx]) -
+                                      np.log10(vel_disp[lens_gal_idx])) < 0.03))
+        self.assertTrue(np.all(np.abs(np.log10(glsne_zl[glsne_idx]) -
+                                      np.log10(redshift[lens_gal_idx])) < 0.03))
+
+        repeat = DC2Sprinkler().match_to_lenscat_sne(vel_disp, redshift, glsne_zl, glsne_sigma,
+                                                     glsne_sysno, glsne_weights, density=0.1,
+                                                     rng_mode='philox', assignment='global')
+        np.testing.assert_array_equal(repeat[1], lens_gal_idx)
+
+    def test_exact_maximum(self):
+
+        rand_state = np.random.RandomState(12)
+        vel_disp = np.power(10, rand_state.normal(2.3, 0.05, size=400))
+        redshift = np.power(10, rand_state.normal(-0.3, 0.05, size=400))
+        lens_sigma = np.power(10, rand_state.normal(2.3, 0.05, size=600))
+        lens_z = np.power(10, rand_state.normal(-0.3, 0.05, size=600))
+        try_idx = np.arange(600)
+
+        # Size of a maximum matching over every pair within tolerance
+        candidate_index = LensCandidateIndex(vel_disp, redshift, tolerance=0.03)
+        query_idx, match_idx = candidate_index.query_pairs(np.log10(lens_sigma), np.log10(lens_z))
+        graph = csr_matrix((np.ones(len(query_idx)), (query_idx, match_idx)), shape=(600, 400))
+        n_maximum = np.sum(maximum_bipartite_matching(graph, perm_type='column') >= 0)
+
+        exact = DC2Sprinkler().assign_global(candidate_index, lens_sigma, lens_z, try_idx,
+                                             max_candidates=None)
+        pruned = DC2Sprinkler().assign_global(candidate_index, lens_sigma, lens_z, try_idx,
+                                              max_candidates=2)
+        self.assertEqual(len(exact[0]), n_maximum)
+        self.assertLessEqual(len(pruned[0]), n_maximum)
+        self.assertEqual(len(np.unique(exact[1])), len(exact[1]))
+
+        seeded = DC2Sprinkler().assign_global(candidate_index, lens_sigma, lens_z, try_idx,
+                                              seed=5, max_candidates=None)
+        self.assertEqual(len(seeded[0]), n_maximum)
+
+
+class testTiledSNeMatch(unittest.TestCase):
+
+    def test_tiled_match_probability(self):
+
+        # Systems on a grid far enough apart that each can only match the
+        # galaxy placed on it, so a system is matched exactly when it is tried
+        log_sigma, log_z = np.meshgrid(2.0 + 0.1*np.arange(10), -1.0 + 0.1*np.arange(10))
+        glsne_sigma = np.power(10, log_sigma.ravel())
+        glsne_zl = np.power(10, log_z.ravel())
+        glsne_sysno = np.arange(100) + 500
+        # One heavy system so the tiles without it have a much lower maximum
+        glsne_weights = np.random.RandomState(3).uniform(0., 0.4, size=100)
+        glsne_weights[7] = 1.
+        weight_norm = np.max(glsne_weights)
+
+        untiled = DC2Sprinkler().match_to_lenscat_sne(glsne_sigma, glsne_zl, glsne_zl, glsne_sigma,
+                                                      glsne_sysno, glsne_weights, density=0.05,
+                                                      rng_mode='philox')
+
+        tiled_sysno = []
+        for tile_num in range(3):
+            tile = (glsne_sysno % 3) == tile_num
+            np.testing.assert_array_equal(DC2Sprinkler().sne_match_density(glsne_weights[tile],
+                                                                           density=0.05,
+                                                                           weight_norm=weight_norm),
+                                          DC2Sprinkler().sne_match_density(glsne_weights,
+                                                                           density=0.05)[tile])
+            tile_match = DC2Sprinkler().match_to_lenscat_sne(glsne_sigma, glsne_zl,
+                                                             glsne_zl[tile], glsne_sigma[tile],
+                                                             glsne_sysno[tile], glsne_weights[tile],
+                                                             density=0.05, rng_mode='philox',
+                                                             weight_norm=weight_norm)
+            tiled_sysno.append(tile_match[2])
+
+        self.assertGreater(len(untiled[2]), 0)
+        np.testing.assert_array_equal(np.sort(np.concatenate(tiled_sysno)), np.sort(untiled[2]))
+
+
+class testHostMatch(unittest.TestCase):
+
+    def test_host_choice_independent_of_match_prob(self):
+
+        # Systems that would pass a low density cut in the lens matcher
+        system_ids = np.arange(20000)
+        match_prob = id_uniform(system_ids)
+        system_ids = system_ids[match_prob < 0.1][:200]
+        match_prob = match_prob[match_prob < 0.1][:200]
+
+        # 100 identical hosts so every host is a candidate for every system
+        host_z = np.full(100, 1.)
+        host_i_mag = np.full(100, 22.)
+        host_size = np.full(100, 1.)
+
+        om10_picks = []
+        glsne_picks = []
+        for system_id in system_ids:
+            om10_system = {'system_id': np.array([system_id]), 'z_src': np.array([1.]),
+                           'mag_i_src': np.array([22.])}
+            om10_picks.append(DC2Sprinkler().match_hosts_om10(host_z, host_i_mag, om10_system,
+                                                              rng_mode='philox')[1][0])
+            glsne_picks.append(DC2Sprinkler().match_hosts_glsne(host_z, host_size, np.array([1.]),
+                                                                np.array([1.]),
+                                                                np.array([system_id]),
+                                                                rng_mode='philox')[1][0])
+
+        for host_picks in [np.array(om10_picks), np.array(glsne_picks)]:
+            # The picks cover all the hosts instead of only the first tenth
+            self.assertGreater(np.max(host_picks), 90)
+            self.assertGreater(np.mean(host_picks >= 10), 0.8)
+            self.assertLess(np.abs(np.corrcoef(host_picks, match_prob)[0, 1]), 0.2)
+
+
+class testSNCosmoParams(unittest.TestCase):
+
+    def test_batched_x0(self):
+
+        # Analytic source so the test does not need to download SALT2
+        phase = np.linspace(-20., 50., 71)
+        wave = np.linspace(2000., 9000., 300)
+        flux = (np.exp(-0.5*(phase[:, None]/10.)**2) *
+                np.exp(-0.5*((wave[None, :] - 4500.)/1500.)**2) * 1e-12)
+        source = sncosmo.TimeSeriesSource(phase, wave, flux)
+
+        rand_state = np.random.RandomState(4)
+        glsne_df = pd.DataFrame({'zs': rand_state.uniform(0.05, 1.4, size=50),
+                                 'MB': rand_state.normal(-19.3, 0.3, size=50)})
+
+        loop_df = DC2Sprinkler().add_sncosmo_params(glsne_df.copy(), batched=False,
+                                                    source=source)
+        batched_df = DC2Sprinkler().add_sncosmo_params(glsne_df.copy(), source=source)
+
+        np.testing.assert_allclose(batched_df['x0'], loop_df['x0'], rtol=1e-12)
+        np.testing.assert_array_equal(batched_df['x1'], 1.)
+        np.testing.assert_array_equal(batched_df['c'], 0.)
+
+        glsne_df.loc[0, 'zs'] = 0.
+        with self.assertRaises(ValueError):
+            DC2Sprinkler().add_sncosmo_params(glsne_df, source=source)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,13 @@
 import sys
 sys.path.append('..')
+import os
+import sqlite3
+import tempfile
+import shutil
 import unittest
+import numpy as np
 import pandas as pd
-from sprinkler import DC2Reader
+from sprinkler import DC2Reader, LocalGalaxyCatalog, CandidateFilter
 
 class testDC2Reader(unittest.TestCase):
 
@@ -12,5 +17,156 @@ class testDC2Reader(unittest.TestCase):
         dc2_cat = dc2_reader.load_catalog()
         print(pd.DataFrame(dc2_cat))
 
+
+class testDC2ReaderChunked(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        rand_state = np.random.RandomState(9)
+        n_gal = 5000
+        galaxy_cols = {quantity: rand_state.uniform(0.5, 1.5, size=n_gal)
+                       for quantity in DC2Reader('cosmoDC2_test').quantity_list}
+        galaxy_cols['galaxy_id'] = np.arange(n_gal)
+        galaxy_cols['ra'] = rand_state.uniform(50., 60., size=n_gal)
+        galaxy_cols['dec'] = rand_state.uniform(-35., -25., size=n_gal)
+        galaxy_cols['redshift_true'] = rand_state.uniform(0., 3., size=n_gal)
+        galaxy_cols['stellar_mass'] = rand_state.uniform(1e9, 1e11, size=n_gal)
+        galaxy_cols['stellar_mass_bulge'] = galaxy_cols['stellar_mass']*rand_state.choice([0.5, 0.995],
+                                                                                          size=n_gal)
+        cls.galaxy_df = pd.DataFrame(galaxy_cols)
+        cls.local_catalog = LocalGalaxyCatalog(cls.galaxy_df)
+
+    def test_chunks_match_full_load(self):
+
+        dc2_reader = DC2Reader('cosmoDC2_test', catalog=self.local_catalog)
+        catalog_filters = ['ra < 58.', 'ra > 52.', 'dec < -27.', 'dec > -33.']
+
+        full_df = dc2_reader.trim_catalog(dc2_reader.load_galaxy_catalog(catalog_filters))
+        chunk_list = list(dc2_reader.iter_galaxy_catalog(catalog_filters, ellipticals_only=True))
+        chunked_df = dc2_reader.load_galaxy_catalog(catalog_filters, chunked=True,
+                                                    ellipticals_only=True)
+
+        self.assertGreater(len(chunk_list), 1)
+        pd.testing.assert_frame_equal(chunked_df, full_df)
+        self.assertTrue(np.all(chunked_df['stellar_mass_bulge']/chunked_df['stellar_mass'] > 0.99))
+
+    def test_redshift_cut_and_native_filters(self):
+
+        dc2_reader = DC2Reader('cosmoDC2_test', catalog=self.local_catalog)
+        hpix = np.unique(self.local_catalog.healpix_pixel)[0]
+
+        host_df = dc2_reader.load_galaxy_catalog([], chunked=True, min_redshift=0.25,
+                                                 native_filters=['healpix_pixel == %i' % hpix])
+        in_hpix = self.local_catalog.healpix_pixel == hpix
+        expected_ids = self.galaxy_df['galaxy_id'].values[in_hpix &
+                                                          (self.galaxy_df['redshift_true'].values > 0.25)]
+        np.testing.assert_array_equal(host_df['galaxy_id'].values, expected_ids)
+
+
+    def test_exclude_ids(self):
+
+        dc2_reader = DC2Reader('cosmoDC2_test', catalog=self.local_catalog)
+        agn_ids = np.arange(0, 5000, 7)
+
+        lens_df = dc2_reader.load_galaxy_catalog([], chunked=True, ellipticals_only=True,
+                                                 exclude_ids=agn_ids)
+        trim_df = dc2_reader.trim_catalog(self.galaxy_df)
+        drop_gals = [idx for idx, gal_id in enumerate(trim_df['galaxy_id'])
+                     if gal_id in set(agn_ids)]
+        expected_df = trim_df.drop(drop_gals).reset_index(drop=True)
+
+        self.assertGreater(len(drop_gals), 0)
+        np.testing.assert_array_equal(np.sort(lens_df['galaxy_id'].values),
+                                      expected_df['galaxy_id'].values)
+        pd.testing.assert_frame_equal(CandidateFilter(trim_df).exclude_ids(agn_ids).apply(),
+                                      expected_df)
+
+
+class testDC2ReaderAGN(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.scratch_dir = tempfile.mkdtemp(dir=os.path.abspath('.'))
+        cls.agn_db = os.path.join(cls.scratch_dir, 'agn_test.db')
+        rand_state = np.random.RandomState(5)
+        n_agn = 20000
+        cls.agn_df = pd.DataFrame({'galaxy_id': np.arange(n_agn),
+                                   'ra': rand_state.uniform(0., 100., size=n_agn),
+                                   'dec': rand_state.uniform(-60., 0., size=n_agn),
+                                   'redshift': rand_state.uniform(0., 3., size=n_agn),
+                                   'magNorm': rand_state.uniform(18., 28., size=n_agn),
+                                   'varParamStr': ['{"p": {"seed": %i}}' % i
+                                                   for i in range(n_agn)]})
+        cls.agn_db_no_index = os.path.join(cls.scratch_dir, 'agn_test_no_index.db')
+        for agn_db in [cls.agn_db, cls.agn_db_no_index]:
+            conn = sqlite3.connect(agn_db)
+            cls.agn_df.to_sql('agn_params', conn, index=False)
+            conn.close()
+        conn = sqlite3.connect(cls.agn_db)
+        conn.execute('CREATE INDEX ix_agn_params_ra_dec ON agn_params (ra, dec)')
+        conn.commit()
+        conn.close()
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.scratch_dir)
+
+    def test_bounds_match_query(self):
+
+        dc2_reader = DC2Reader('cosmoDC2_test')
+        agn_df = dc2_reader.load_agn_catalog(self.agn_db, ra_range=(72.5, 75.),
+                                             dec_range=(-45., -42.5),
+                                             redshift_range=(0.25, None), chunk_size=100)
+        query_df = self.agn_df.query('ra > 72.5 and ra < 75. and dec > -45 and ' +
+                                     'dec < -42.5 and redshift > 0.25').reset_index(drop=True)
+
+        self.assertGreater(len(query_df), 0)
+        pd.testing.assert_frame_equal(agn_df, query_df)
+
+    def test_columns_and_trim_query(self):
+
+        dc2_reader = DC2Reader('cosmoDC2_test')
+        agn_df = dc2_reader.load_agn_catalog(self.agn_db, agn_trim_query='magNorm < 20.',
+                                             ra_range=(None, 50.), columns=['galaxy_id', 'magNorm'],
+                                             chunk_size=1000)
+        query_df = self.agn_df.query('ra < 50. and magNorm < 20.')
+
+        self.assertEqual(list(agn_df.columns), ['galaxy_id', 'magNorm'])
+        np.testing.assert_array_equal(agn_df['galaxy_id'].values, query_df['galaxy_id'].values)
+
+        with self.assertRaises(ValueError):
+            dc2_reader.load_agn_catalog(self.agn_db, columns=['galaxy_id', 'ra; DROP TABLE agn_params'])
+
+    def test_position_index(self):
+
+        dc2_reader = DC2Reader('cosmoDC2_test')
+        plan = dc2_reader.agn_query_plan(self.agn_db, ra_range=(72.5, 75.), dec_range=(-45., -42.5))
+        self.assertTrue(any('USING INDEX ix_agn_params_ra_dec' in step for step in plan))
+
+        # Without the index the bounds fall back to a table scan with a warning
+        with self.assertWarns(UserWarning):
+            scan_df = dc2_reader.load_agn_catalog(self.agn_db_no_index, ra_range=(72.5, 75.))
+        plan = dc2_reader.agn_query_plan(self.agn_db_no_index, ra_range=(72.5, 75.))
+        self.assertFalse(any('USING INDEX' in step for step in plan))
+        pd.testing.assert_frame_equal(scan_df, self.agn_df.query('ra > 72.5 and ra < 75.')
+                                      .reset_index(drop=True))
+
+        agn_df = dc2_reader.load_agn_catalog(self.agn_db_no_index, ra_range=(72.5, 75.),
+                                             create_index=True)
+        plan = dc2_reader.agn_query_plan(self.agn_db_no_index, ra_range=(72.5, 75.))
+        self.assertTrue(any('USING INDEX' in step for step in plan))
+        pd.testing.assert_frame_equal(agn_df, self.agn_df.query('ra > 72.5 and ra < 75.')
+                                      .reset_index(drop=True))
+
+    def test_empty_selection(self):
+
+        dc2_reader = DC2Reader('cosmoDC2_test')
+        agn_df = dc2_reader.load_agn_catalog(self.agn_db, ra_range=(200., 210.))
+        self.assertEqual(len(agn_df), 0)
+        self.assertEqual(list(agn_df.columns), list(self.agn_df.columns))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
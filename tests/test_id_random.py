@@ -0,0 +1,65 @@
+import sys
+sys.path.append('..')
+import unittest
+import numpy as np
+from sprinkler import philox4x32, id_uniform, id_normal, SystemRandomStream
+
+class testPhilox(unittest.TestCase):
+
+    def test_known_answers(self):
+
+        # Known answer tests distributed with Random123
+        words = philox4x32((0, 0, 0, 0), (0, 0))
+        self.assertEqual([int(w[0]) for w in words],
+                         [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8])
+
+        words = philox4x32((0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344),
+                           (0xa4093822, 0x299f31d0))
+        self.assertEqual([int(w[0]) for w in words],
+                         [0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1])
+
+    def test_keyed_on_id(self):
+
+        ids = np.arange(10**10, 10**10 + 1000)
+        order = np.random.RandomState(1).permutation(len(ids))
+
+        np.testing.assert_array_equal(id_uniform(ids)[order], id_uniform(ids[order]))
+        np.testing.assert_array_equal(id_normal(ids)[order], id_normal(ids[order]))
+        self.assertFalse(np.any(id_uniform(ids) == id_uniform(ids, draw=1)))
+
+        uniform = id_uniform(ids)
+        self.assertTrue(np.all((uniform >= 0.) & (uniform < 1.)))
+
+
+class testSystemRandomStream(unittest.TestCase):
+
+    def test_legacy_mode(self):
+
+        system_ids = np.array([12, 5000, 77, 123456])
+        candidates = np.arange(40, 60)
+        system_rng = SystemRandomStream(system_ids, rng_mode='legacy')
+        uniform = system_rng.uniform()
+
+        for i, system_id in enumerate(system_ids):
+            rand_state = np.random.RandomState(system_id)
+            self.assertEqual(uniform[i], rand_state.uniform())
+            self.assertEqual(system_rng.choice(i, candidates), rand_state.choice(candidates))
+
+    def test_philox_mode(self):
+
+        system_ids = np.arange(100)
+        candidates = np.arange(5)
+        system_rng = SystemRandomStream(system_ids, rng_mode='philox')
+
+        np.testing.assert_array_equal(system_rng.uniform(), id_uniform(system_ids))
+        for i in range(len(system_ids)):
+            self.assertIn(system_rng.choice(i, candidates), candidates)
+
+    def test_bad_mode(self):
+
+        with self.assertRaises(ValueError):
+            SystemRandomStream([1, 2], rng_mode='mersenne')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
 import sys
 sys.path.append('..')
+import os
+import tempfile
 import unittest
+import numpy as np
 import pandas as pd
-from sprinkler import OM10Reader, GoldsteinSNeCatReader
+from astropy.io import fits
+from sprinkler import OM10Reader, OM10Catalog, GoldsteinSNeCatReader, image_slot_columns
 
 class testOM10Reader(unittest.TestCase):
 
@@ -12,6 +16,59 @@ class testOM10Reader(unittest.TestCase):
         lensed_agn_cat = om10_reader.load_catalog()
         print(pd.DataFrame(lensed_agn_cat))
 
+class testOM10ReaderMemmap(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.scratch_dir = tempfile.mkdtemp()
+        cls.om10_file = os.path.join(cls.scratch_dir, 'om10_test.fits')
+
+        rng = np.random.RandomState(12)
+        n_sys = 20
+        om10_reader = OM10Reader(cls.om10_file)
+        fits_cols = []
+        for val in om10_reader.config.values():
+            if val in ['XIMG', 'YIMG', 'MAG', 'DELAY']:
+                fits_cols.append(fits.Column(name=val, format='4D',
+                                             array=rng.normal(size=(n_sys, 4))))
+            elif val in ['LENSID', 'NIMG']:
+                fits_cols.append(fits.Column(name=val, format='K',
+                                             array=rng.randint(2, 5, size=n_sys)))
+            else:
+                fits_cols.append(fits.Column(name=val, format='D',
+                                             array=rng.uniform(size=n_sys)))
+        fits.BinTableHDU.from_columns(fits_cols).writeto(cls.om10_file)
+
+    @classmethod
+    def tearDownClass(cls):
+
+        os.remove(cls.om10_file)
+        os.rmdir(cls.scratch_dir)
+
+    def test_memmap_matches_default(self):
+
+        om10_reader = OM10Reader(self.om10_file)
+        lensed_agn_cat = om10_reader.load_catalog()
+        om10_cat = om10_reader.load_catalog(memmap=True)
+
+        self.assertIsInstance(om10_cat, OM10Catalog)
+        self.assertEqual(om10_cat.n_systems, 20)
+        self.assertEqual(sorted(om10_cat.keys()), sorted(lensed_agn_cat.keys()))
+
+        for key, val in lensed_agn_cat.items():
+            cat_vals = om10_cat[key]
+            self.assertTrue(cat_vals.dtype.isnative)
+            if key in ['x_img', 'y_img', 't_delay_img', 'magnification_img']:
+                self.assertEqual(cat_vals.shape, (20, 4))
+                np.testing.assert_array_equal(cat_vals, np.array(val))
+            else:
+                np.testing.assert_array_equal(cat_vals, val)
+
+        # Columns are converted once and then reused
+        self.assertIs(om10_cat['x_img'], om10_cat['x_img'])
+        om10_cat.close()
+
 class testGoldsteinSNeCatReader(unittest.TestCase):
 
     def test_load_reader(self):
@@ -20,5 +77,38 @@ class testGoldsteinSNeCatReader(unittest.TestCase):
         lensed_sne_cat = glsne_reader.load_catalog()
         print(pd.DataFrame(lensed_sne_cat))
 
+class testGoldsteinSNeImageArrays(unittest.TestCase):
+
+    def test_image_arrays(self):
+
+        rng = np.random.RandomState(5)
+        n_img = np.array([2, 4, 2, 4, 4])
+        df_img = pd.DataFrame({'sysno': np.repeat(np.arange(5) + 100, n_img),
+                               'imno': np.concatenate([np.arange(n) for n in n_img])})
+        for col_name in ['x', 'y', 'td', 'mu']:
+            df_img[col_name] = rng.normal(size=len(df_img))
+        df_sys = pd.DataFrame({'sysno': [103, 100, 104, 101, 102]})
+
+        glsne_reader = GoldsteinSNeCatReader('glsne_test.h5')
+        sysno, img_mask, img_arrays = glsne_reader.image_arrays(df_img)
+        df_merged = glsne_reader.merge_catalog(df_sys, df_img)
+        img_row = pd.Index(sysno).get_indexer(df_merged['sysno'].values)
+
+        np.testing.assert_array_equal(np.sum(img_mask[img_row], axis=1), df_merged['n_img'])
+        for key in ['x_img', 'y_img', 't_delay_img', 'magnification_img']:
+            self.assertEqual(img_arrays[key].shape, (5, 4))
+            self.assertTrue(img_arrays[key].flags['C_CONTIGUOUS'])
+            np.testing.assert_array_equal(img_arrays[key][img_row],
+                                          np.array(list(df_merged[key])))
+
+        # The dense merge has the same systems with one column per image slot
+        df_dense = glsne_reader.merge_dense_catalog(df_sys, df_img)
+        np.testing.assert_array_equal(df_dense['sysno'], df_merged['sysno'])
+        np.testing.assert_array_equal(df_dense['n_img'], df_merged['n_img'])
+        for key in ['x_img', 'y_img', 't_delay_img', 'magnification_img']:
+            self.assertNotIn(key, df_dense.columns)
+            np.testing.assert_array_equal(df_dense[image_slot_columns(key, 4)].values,
+                                          np.array(list(df_merged[key])))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
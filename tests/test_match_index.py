@@ -0,0 +1,113 @@
+import sys
+sys.path.append('..')
+import unittest
+import numpy as np
+from sprinkler import LensCandidateIndex, HostRedshiftIndex, ClaimedMask, bipartite_assignment
+
+class testLensCandidateIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        rand_state = np.random.RandomState(42)
+        cls.vel_disp = np.power(10, rand_state.uniform(1.9, 2.5, size=20000))
+        cls.redshift = np.power(10, rand_state.uniform(-1.2, 0.2, size=20000))
+
+    def test_query_matches_full_scan(self):
+
+        lens_index = LensCandidateIndex(self.vel_disp, self.redshift)
+
+        rand_state = np.random.RandomState(7)
+        for lens_sigma, lens_z in zip(np.power(10, rand_state.uniform(1.8, 2.6, size=200)),
+                                      np.power(10, rand_state.uniform(-1.3, 0.3, size=200))):
+            log_lens_sigma = np.log10(lens_sigma)
+            log_lens_z = np.log10(lens_z)
+            full_scan = np.where((np.abs(log_lens_sigma - np.log10(self.vel_disp)) < 0.03) &
+                                 (np.abs(log_lens_z - np.log10(self.redshift)) < 0.03))[0]
+            np.testing.assert_array_equal(lens_index.query(log_lens_sigma, log_lens_z),
+                                          full_scan)
+
+    def test_query_pairs(self):
+
+        lens_index = LensCandidateIndex(self.vel_disp, self.redshift)
+
+        rand_state = np.random.RandomState(8)
+        log_lens_sigma = rand_state.uniform(1.8, 2.6, size=300)
+        log_lens_z = rand_state.uniform(-1.3, 0.3, size=300)
+        query_idx, match_idx = lens_index.query_pairs(log_lens_sigma, log_lens_z)
+
+        for i in range(300):
+            np.testing.assert_array_equal(np.sort(match_idx[query_idx == i]),
+                                          lens_index.query(log_lens_sigma[i], log_lens_z[i]))
+
+    def test_empty_index(self):
+
+        lens_index = LensCandidateIndex(np.array([]), np.array([]))
+        self.assertEqual(len(lens_index.query(2.3, -0.5)), 0)
+
+
+class testHostRedshiftIndex(unittest.TestCase):
+
+    def test_query_matches_full_scan(self):
+
+        rand_state = np.random.RandomState(43)
+        redshift = rand_state.uniform(0.2, 3., size=20000).astype(np.float32)
+        agn_i_mag = rand_state.normal(22., 1.5, size=20000)
+        host_index = HostRedshiftIndex(redshift, agn_i_mag)
+
+        for z_sys, imag_sys in zip(rand_state.uniform(0.2, 3., size=200),
+                                   rand_state.normal(22., 1.5, size=200)):
+            log_z_sys = np.log10(z_sys)
+            full_scan = np.where((np.abs(np.log10(redshift) - log_z_sys) < 0.05) &
+                                 (np.abs(agn_i_mag - imag_sys) < 0.05))[0]
+            np.testing.assert_array_equal(host_index.query(log_z_sys, imag_sys), full_scan)
+
+    def test_empty_index(self):
+
+        host_index = HostRedshiftIndex(np.array([]), np.array([]))
+        self.assertEqual(len(host_index.query(0.1, 22.)), 0)
+
+
+class testClaimedMask(unittest.TestCase):
+
+    def test_claim(self):
+
+        claimed = ClaimedMask(10)
+        claimed.claim(3)
+        claimed.claim(np.array([5, 7]))
+
+        self.assertEqual(len(claimed), 3)
+        np.testing.assert_array_equal(claimed.unclaimed(np.arange(2, 9)),
+                                      [2, 4, 6, 8])
+
+
+class testBipartiteAssignment(unittest.TestCase):
+
+    def test_assignment(self):
+
+        # System 0 can only use galaxy 0, so a greedy pass that gives galaxy 0
+        # to system 1 first would leave system 0 unmatched.
+        sys_idx = np.array([0, 1, 1, 2, 2, 3])
+        gal_idx = np.array([0, 0, 1, 1, 2, 2])
+        matched_sys, matched_gal = bipartite_assignment(sys_idx, gal_idx, 4, 3, seed=3)
+
+        self.assertEqual(len(matched_sys), 3)
+        self.assertEqual(len(np.unique(matched_gal)), 3)
+        pairs = set(zip(sys_idx, gal_idx))
+        for sys_num, gal_num in zip(matched_sys, matched_gal):
+            self.assertIn((sys_num, gal_num), pairs)
+        np.testing.assert_array_equal(np.sort(matched_sys), matched_sys)
+
+        repeat_sys, repeat_gal = bipartite_assignment(sys_idx, gal_idx, 4, 3, seed=3)
+        np.testing.assert_array_equal(matched_sys, repeat_sys)
+        np.testing.assert_array_equal(matched_gal, repeat_gal)
+
+    def test_empty(self):
+
+        matched_sys, matched_gal = bipartite_assignment([], [], 5, 5)
+        self.assertEqual(len(matched_sys), 0)
+        self.assertEqual(len(matched_gal), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import sys
+sys.path.append('..')
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from sprinkler import SedCache, PhotometryEngine, FluxLookup, DC2Sprinkler
+from sprinkler import BandpassRegistry, get_bandpass_registry
+
+class testSedCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.sed_dir = tempfile.mkdtemp()
+        wavelen = np.arange(100., 2000., 1.)
+        for sed_num in range(3):
+            flambda = np.exp(-((wavelen - 600.)/(300. + 100.*sed_num))**2) + 0.1
+            np.savetxt(os.path.join(cls.sed_dir, 'test_%i.sed' % sed_num),
+                       np.array([wavelen, flambda]).T)
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.sed_dir)
+
+    def test_hits_and_misses(self):
+
+        sed_cache = SedCache(sed_dir=self.sed_dir)
+        sed_obj, a_x, b_x = sed_cache.get_sed('test_0.sed')
+        self.assertEqual(len(a_x), len(sed_obj.wavelen))
+        self.assertIs(sed_cache.get_sed('test_0.sed')[0], sed_obj)
+
+        sed_z = sed_cache.get_redshifted_sed('test_0.sed', 0.5)
+        np.testing.assert_allclose(sed_z.wavelen, sed_obj.wavelen*1.5)
+        np.testing.assert_allclose(sed_z.flambda, sed_obj.flambda/1.5)
+        self.assertIs(sed_cache.get_redshifted_sed('test_0.sed', 0.5), sed_z)
+
+        cache_info = sed_cache.cache_info()
+        self.assertEqual(cache_info['sed_misses'], 1)
+        self.assertEqual(cache_info['sed_hits'], 2)
+        self.assertEqual(cache_info['redshifted_misses'], 1)
+        self.assertEqual(cache_info['redshifted_hits'], 1)
+
+    def test_bounded_size(self):
+
+        sed_cache = SedCache(max_seds=2, max_redshifted=2, sed_dir=self.sed_dir)
+        for sed_num in range(3):
+            for redshift in [0.1, 0.2, 0.3]:
+                sed_cache.get_redshifted_sed('test_%i.sed' % sed_num, redshift)
+
+        cache_info = sed_cache.cache_info()
+        self.assertEqual(cache_info['sed_size'], 2)
+        self.assertEqual(cache_info['redshifted_size'], 2)
+        # The least recently used SED was dropped
+        sed_cache.get_sed('test_0.sed')
+        self.assertEqual(sed_cache.cache_info()['sed_misses'], 4)
+
+
+class testBandpassRegistry(unittest.TestCase):
+
+    def test_shared_bandpasses(self):
+
+        bp_registry = get_bandpass_registry()
+        self.assertIs(get_bandpass_registry(), bp_registry)
+        self.assertIs(bp_registry.lsst_bandpasses, bp_registry.lsst_bandpasses)
+        self.assertIs(bp_registry.imsim_bandpass, bp_registry.imsim_bandpass)
+
+        bandpass_names, wavelen_match, wavelen_step, phi_array = bp_registry.lsst_arrays()
+        self.assertEqual(bandpass_names, ['u', 'g', 'r', 'i', 'z', 'y'])
+        self.assertEqual(phi_array.shape, (6, len(wavelen_match)))
+        self.assertTrue(phi_array.flags['C_CONTIGUOUS'])
+        self.assertFalse(phi_array.flags['WRITEABLE'])
+
+        # Engines share the registry arrays instead of loading their own
+        self.assertIs(PhotometryEngine().phi_array, phi_array)
+
+    def test_lazy_loading(self):
+
+        bp_registry = BandpassRegistry()
+        self.assertIsNone(bp_registry._lsst_bandpasses)
+        self.assertIsNone(bp_registry._imsim_bandpass)
+
+
+class testPhotometryEngine(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.sed_dir = tempfile.mkdtemp()
+        wavelen = np.arange(50., 3000., 0.7)
+        for sed_num in range(2):
+            flambda = np.exp(-((wavelen - 500.)/(400. + 200.*sed_num))**2) + 0.05
+            np.savetxt(os.path.join(cls.sed_dir, 'test_%i.sed' % sed_num),
+                       np.array([wavelen, flambda]).T)
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.sed_dir)
+
+    def test_matches_add_flux(self):
+
+        sed_cache = SedCache(sed_dir=self.sed_dir)
+        phot_engine = PhotometryEngine(sed_cache=sed_cache)
+        dc2_sprinkler = DC2Sprinkler()
+
+        rand_state = np.random.RandomState(3)
+        n_obj = 20
+        sed_names = ['test_%i.sed' % sed_num for sed_num in rand_state.randint(0, 2, size=n_obj)]
+        redshifts = rand_state.uniform(0.1, 2.5, size=n_obj)
+        magnorms = rand_state.uniform(18., 25., size=(n_obj, 6))
+        av = rand_state.uniform(0., 0.3, size=n_obj)
+        rv = np.full(n_obj, 3.1)
+
+        flux_no_mw, flux_mw = phot_engine.calc_fluxes(sed_names, redshifts, magnorms, av, rv)
+
+        for i in range(n_obj):
+            magnorm_dict = {bp_name: magnorms[i, band_num] for band_num, bp_name
+                            in enumerate(phot_engine.bandpass_names)}
+            add_flux_no_mw, add_flux_mw = dc2_sprinkler.add_flux(sed_names[i], redshifts[i],
+                                                                 magnorm_dict, av[i], rv[i],
+                                                                 sed_cache=sed_cache)
+            for band_num, bp_name in enumerate(phot_engine.bandpass_names):
+                np.testing.assert_allclose(flux_no_mw[i, band_num], add_flux_no_mw[bp_name], rtol=1e-10)
+                np.testing.assert_allclose(flux_mw[i, band_num], add_flux_mw[bp_name], rtol=1e-10)
+
+    def test_flux_lookup(self):
+
+        phot_engine = PhotometryEngine(sed_cache=SedCache(sed_dir=self.sed_dir))
+        grid_dir = os.path.join(self.sed_dir, 'grids')
+        flux_lookup = FluxLookup(grid_dir=grid_dir, phot_engine=phot_engine, max_rel_error=1e-3,
+                                 z_min=0.1, z_max=1.0, n_z=19, av_max=0.5, n_av=3)
+
+        rand_state = np.random.RandomState(5)
+        n_obj = 200
+        redshifts = rand_state.uniform(0.1, 1.2, size=n_obj)
+        magnorms = rand_state.uniform(18., 25., size=n_obj)
+        av = rand_state.uniform(0., 0.5, size=n_obj)
+        rv = np.full(n_obj, 3.1)
+        rv[:10] = 2.5
+
+        grid_no_mw, grid_mw = flux_lookup.calc_fluxes('test_0.sed', redshifts, magnorms, av, rv)
+        exact_no_mw, exact_mw = phot_engine.calc_fluxes('test_0.sed', redshifts, magnorms, av, rv)
+        np.testing.assert_allclose(grid_no_mw, exact_no_mw, rtol=3e-3)
+        np.testing.assert_allclose(grid_mw, exact_mw, rtol=3e-3)
+
+        # Objects outside the grid or with other R_v are calculated exactly
+        exact_rows = (redshifts > 1.0) | (rv != 3.1)
+        np.testing.assert_array_equal(grid_mw[exact_rows], exact_mw[exact_rows])
+
+        # Saved grids are read back instead of rebuilt
+        self.assertTrue(os.path.exists(os.path.join(grid_dir, 'test_0.sed.npz')))
+        flux_lookup_reread = FluxLookup(grid_dir=grid_dir, phot_engine=phot_engine, max_rel_error=1e-3,
+                                        z_min=0.1, z_max=1.0, n_z=19, av_max=0.5, n_av=3)
+        np.testing.assert_array_equal(flux_lookup_reread.get_grid('test_0.sed').log_flux,
+                                      flux_lookup.get_grid('test_0.sed').log_flux)
+
+        # A grid saved with other settings is rebuilt
+        flux_lookup_other = FluxLookup(grid_dir=grid_dir, phot_engine=phot_engine, max_rel_error=1e-3,
+                                       z_min=0.1, z_max=1.2, n_z=23, av_max=0.5, n_av=3)
+        self.assertEqual(flux_lookup_other.get_grid('test_0.sed').z_max, 1.2)
+
+    def test_flux_lookup_error_limit(self):
+
+        # A grid that cannot reach the error limit falls back to exact fluxes
+        phot_engine = PhotometryEngine(sed_cache=SedCache(sed_dir=self.sed_dir))
+        flux_lookup = FluxLookup(phot_engine=phot_engine, max_rel_error=1e-12,
+                                 z_min=0.1, z_max=1.0, n_z=5, av_max=0.5, n_av=2, max_refine=0)
+
+        rand_state = np.random.RandomState(6)
+        redshifts = rand_state.uniform(0.1, 1.0, size=50)
+        magnorms = rand_state.uniform(18., 25., size=50)
+        av = rand_state.uniform(0., 0.5, size=50)
+
+        grid_no_mw, grid_mw = flux_lookup.calc_fluxes('test_1.sed', redshifts, magnorms, av, 3.1)
+        exact_no_mw, exact_mw = phot_engine.calc_fluxes('test_1.sed', redshifts, magnorms, av, 3.1)
+        self.assertGreater(flux_lookup.get_grid('test_1.sed').rel_error, 1e-12)
+        np.testing.assert_array_equal(grid_no_mw, exact_no_mw)
+        np.testing.assert_array_equal(grid_mw, exact_mw)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import sys
+sys.path.append('..')
+import os
+import tempfile
+import shutil
+import unittest
+import numpy as np
+import pandas as pd
+from sprinkler import StagePipeline, content_hash
+
+stage_calls = []
+
+def load_catalog(n_rows=10):
+
+    stage_calls.append('load')
+    return pd.DataFrame({'galaxy_id': np.arange(n_rows), 'redshift': np.linspace(0.1, 1., n_rows)})
+
+def match_agn(catalog, density=0.5):
+
+    stage_calls.append('agn')
+    return catalog.iloc[:int(density*len(catalog))]
+
+def match_sne(catalog, agn_match, density=0.5):
+
+    stage_calls.append('sne')
+    return catalog.drop(agn_match.index).iloc[:int(density*len(catalog))]
+
+def output_truth(agn_match, sne_match):
+
+    stage_calls.append('output')
+    return len(agn_match) + len(sne_match)
+
+def redshift_factor():
+
+    return 2.
+
+def redshift_factor_edited():
+
+    return 3.
+
+def scale_redshift(redshift):
+
+    return redshift*redshift_factor()
+
+def scaled_redshift(catalog):
+
+    stage_calls.append('scale')
+    return scale_redshift(catalog['redshift'].values)
+
+class testStagePipeline(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cache_dir = tempfile.mkdtemp(dir=os.path.abspath('.'))
+        del stage_calls[:]
+
+    def tearDown(self):
+
+        shutil.rmtree(self.cache_dir)
+
+    def build_pipeline(self, agn_density=0.5, sne_density=0.3, n_rows=10):
+
+        pipeline = StagePipeline(cache_dir=self.cache_dir)
+        pipeline.add_stage('load', load_catalog, params={'n_rows': n_rows})
+        pipeline.add_stage('agn', match_agn, inputs=['load'], params={'density': agn_density})
+        pipeline.add_stage('sne', match_sne, inputs=['load', 'agn'],
+                           params={'density': sne_density})
+        pipeline.add_stage('output', output_truth, inputs=['agn', 'sne'])
+
+        return pipeline
+
+    def test_rerun_downstream_only(self):
+
+        self.assertEqual(self.build_pipeline().run()['output'], 8)
+        self.assertEqual(stage_calls, ['load', 'agn', 'sne', 'output'])
+
+        del stage_calls[:]
+        self.assertEqual(self.build_pipeline().run()['output'], 8)
+        self.assertEqual(stage_calls, [])
+
+        del stage_calls[:]
+        outputs = self.build_pipeline(sne_density=0.2).run(['output'])
+        self.assertEqual(outputs['output'], 7)
+        self.assertEqual(stage_calls, ['sne', 'output'])
+
+    def test_unchanged_output_stops_reruns(self):
+
+        self.build_pipeline(agn_density=0.5).run()
+
+        # A different density giving the same AGN matches reruns the AGN stage only
+        del stage_calls[:]
+        self.build_pipeline(agn_density=0.51).run()
+        self.assertEqual(stage_calls, ['agn'])
+
+    def test_helper_change_reruns(self):
+
+        def run_scaled():
+            pipeline = StagePipeline(cache_dir=self.cache_dir)
+            pipeline.add_stage('load', load_catalog)
+            pipeline.add_stage('scale', scaled_redshift, inputs=['load'])
+            return pipeline.run()['scale']
+
+        np.testing.assert_allclose(run_scaled(), 2.*np.linspace(0.1, 1., 10))
+        del stage_calls[:]
+        run_scaled()
+        self.assertEqual(stage_calls, [])
+
+        # Editing a helper called through another helper invalidates the stage
+        global redshift_factor
+        redshift_factor_orig = redshift_factor
+        redshift_factor = redshift_factor_edited
+        try:
+            np.testing.assert_allclose(run_scaled(), 3.*np.linspace(0.1, 1., 10))
+            self.assertEqual(stage_calls, ['scale'])
+        finally:
+            redshift_factor = redshift_factor_orig
+
+    def test_content_hash(self):
+
+        catalog = load_catalog()
+        self.assertEqual(content_hash(catalog), content_hash(catalog.copy()))
+        changed = catalog.copy()
+        changed.loc[3, 'redshift'] = 0.7
+        self.assertNotEqual(content_hash(catalog), content_hash(changed))
+        self.assertNotEqual(content_hash({'a': 1}), content_hash({'a': 2}))
+
+
+if __name__ == '__main__':
+    unittest.main()
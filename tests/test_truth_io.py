@@ -0,0 +1,155 @@
+import sys
+sys.path.append('..')
+import os
+import sqlite3
+import tempfile
+import shutil
+import unittest
+import numpy as np
+import pandas as pd
+from sprinkler import TruthCatalogWriter, TruthParquetWriter, TruthCatalogReader, lens_healpix
+from sprinkler import truth_catalog_path
+
+class testTruthCatalogWriter(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.scratch_dir = tempfile.mkdtemp(dir=os.path.abspath('.'))
+        cls.truth_df = pd.DataFrame({'unique_id': ['GLAGN_%i_%i' % (i//2, i % 2)
+                                                   for i in range(10)],
+                                     'ra': np.linspace(50., 51., 10),
+                                     'flux_i': np.append(np.arange(9.), np.nan),
+                                     'dc2_sys_id': np.arange(10)//2,
+                                     'lens_cat_sys_id': np.arange(10)//2 + 1000})
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.scratch_dir)
+
+    def test_round_trip(self):
+
+        out_file = os.path.join(self.scratch_dir, 'truth.db')
+        truth_writer = TruthCatalogWriter(out_file, overwrite_existing=True,
+                                          batch_size=3)
+        truth_writer.write({'lensed_agn': self.truth_df,
+                            'lensed_sne': self.truth_df.iloc[:4]})
+
+        conn = sqlite3.connect(out_file)
+        agn_df = pd.read_sql('select * from lensed_agn', conn, index_col='index')
+        sne_df = pd.read_sql('select * from lensed_sne', conn, index_col='index')
+        indexes = [row[0] for row in
+                   conn.execute("select name from sqlite_master where type='index'")]
+        journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        conn.close()
+
+        pd.testing.assert_frame_equal(agn_df, self.truth_df, check_index_type=False,
+                                      check_names=False, check_dtype=False)
+        self.assertEqual(len(sne_df), 4)
+        for col_name in ['index', 'unique_id', 'dc2_sys_id', 'lens_cat_sys_id']:
+            self.assertIn('ix_lensed_agn_%s' % col_name, indexes)
+        self.assertEqual(journal_mode, 'delete')
+
+    def test_overwrite(self):
+
+        out_file = os.path.join(self.scratch_dir, 'overwrite.db')
+        TruthCatalogWriter(out_file).write({'lensed_agn': self.truth_df})
+
+        with self.assertRaises(sqlite3.OperationalError):
+            TruthCatalogWriter(out_file).write({'lensed_agn': self.truth_df})
+
+        TruthCatalogWriter(out_file, overwrite_existing=True).write({'lensed_agn': self.truth_df})
+
+
+class testTruthParquet(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.scratch_dir = tempfile.mkdtemp(dir=os.path.abspath('.'))
+        rand_state = np.random.RandomState(11)
+        n_rows = 500
+        cls.host_df = pd.DataFrame({'unique_id': np.arange(n_rows)*1024 + 22,
+                                    'ra_lens': rand_state.uniform(50., 70., size=n_rows),
+                                    'dec_lens': rand_state.uniform(-45., -25., size=n_rows),
+                                    'sed_disk_host': ['galaxySED/d%i.gz' % (i % 3)
+                                                      for i in range(n_rows)],
+                                    'dc2_sys_id': ['GLAGN_%i' % i for i in range(n_rows)]})
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.scratch_dir)
+
+    def test_round_trip(self):
+
+        out_dir = os.path.join(self.scratch_dir, 'host_truth')
+        TruthParquetWriter(out_dir).write({'agn_hosts': self.host_df})
+        truth_reader = TruthCatalogReader(out_dir)
+        self.assertEqual(truth_reader.output_format, 'parquet')
+
+        host_df = truth_reader.read('agn_hosts').sort_values('index').reset_index(drop=True)
+        pd.testing.assert_frame_equal(host_df.drop(columns='index'), self.host_df,
+                                      check_dtype=False)
+
+        with self.assertRaises(ValueError):
+            TruthParquetWriter(out_dir).write({'agn_hosts': self.host_df})
+
+    def test_healpix_selection(self):
+
+        out_dir = os.path.join(self.scratch_dir, 'visit_truth')
+        TruthParquetWriter(out_dir).write({'agn_hosts': self.host_df})
+        truth_reader = TruthCatalogReader(out_dir)
+
+        healpix = truth_reader.healpix_in_disc('agn_hosts', 60., -35., 2.)
+        host_df = truth_reader.read('agn_hosts', columns=['unique_id', 'ra_lens'],
+                                    healpix=healpix)
+
+        self.assertEqual(list(host_df.columns), ['unique_id', 'ra_lens'])
+        in_pix = np.isin(lens_healpix(self.host_df['ra_lens'], self.host_df['dec_lens']),
+                         healpix)
+        self.assertGreater(np.sum(in_pix), 0)
+        self.assertLess(np.sum(in_pix), len(self.host_df))
+        np.testing.assert_array_equal(np.sort(host_df['unique_id'].values),
+                                      np.sort(self.host_df['unique_id'].values[in_pix]))
+
+    def test_sqlite_reader(self):
+
+        out_file = os.path.join(self.scratch_dir, 'host_truth.db')
+        TruthCatalogWriter(out_file).write({'agn_hosts': self.host_df})
+        truth_reader = TruthCatalogReader(out_file)
+
+        host_df = truth_reader.read('agn_hosts', columns=['unique_id', 'dc2_sys_id'])
+        pd.testing.assert_frame_equal(host_df, self.host_df[['unique_id', 'dc2_sys_id']],
+                                      check_dtype=False)
+        with self.assertRaises(ValueError):
+            truth_reader.read('agn_hosts', healpix=[10])
+
+    def test_catalog_path(self):
+
+        truth_dir = os.path.join(self.scratch_dir, 'path_test')
+        os.makedirs(truth_dir)
+        self.assertEqual(truth_catalog_path(truth_dir, 'lens_truth', output_format='parquet'),
+                         os.path.join(truth_dir, 'lens_truth'))
+        # Nothing written yet so the default is sqlite
+        self.assertEqual(truth_catalog_path(truth_dir, 'lens_truth'),
+                         os.path.join(truth_dir, 'lens_truth.db'))
+
+        TruthParquetWriter(truth_catalog_path(truth_dir, 'host_truth',
+                                              output_format='parquet')).write({'agn_hosts': self.host_df})
+        TruthCatalogWriter(truth_catalog_path(truth_dir, 'lens_truth',
+                                              output_format='sqlite')).write({'agn_hosts': self.host_df})
+        # Both formats read back with the written index
+        for truth_name in ['host_truth', 'lens_truth']:
+            host_df = TruthCatalogReader(truth_catalog_path(truth_dir, truth_name)).read('agn_hosts',
+                                                                                       index_col='index')
+            pd.testing.assert_frame_equal(host_df.sort_index(), self.host_df,
+                                          check_dtype=False, check_names=False)
+
+        with self.assertRaises(ValueError):
+            truth_catalog_path(truth_dir, 'lens_truth', output_format='fits')
+
+
+if __name__ == '__main__':
+    unittest.main()